@@ -41,6 +41,16 @@ class UserConfiguration(configuration.Configuration):
                 'check' : lambda x: x>0,
                 'command_line' : ('-p', '--port')
             },
+        'socket_path':
+            {
+                'descr' : "Path of a Unix domain socket for local clients (empty for none)",
+                'doc' : """Clients on the same machine can connect through this socket
+                instead of TCP, which saves the TCP overhead on every command. The server
+                still listens on the TCP port too.""",
+                'type' : str,
+                'default' : "",
+                'command_line' : ('', '--socket-path')
+            },
         'max_simultaneous_connections':
             {
                 'descr' : "Maximum number of simultaneous connections",
@@ -52,6 +62,29 @@ class UserConfiguration(configuration.Configuration):
                 'default' : 5,
                 'check' : lambda x: x>0
             },
+        'server_mode':
+            {
+                'descr' : "How to serve clients: 'threads' or 'events'",
+                'doc' : """In the 'threads' mode, a new thread is started for each
+                client connection. In the 'events' mode, all client connections are
+                served from a single thread waiting for activity on all client sockets
+                at once (epoll or poll), which is much cheaper when many clients
+                are connected.""",
+                'type' : str,
+                'default' : 'threads',
+                'check' : lambda x: x in ('threads', 'events'),
+                'command_line' : ('', '--server-mode')
+            },
+        'max_message_size':
+            {
+                'descr' : "Maximal size of message text in bytes (0 for no limit)",
+                'doc' : """Text of SAY TEXT messages larger than this is discarded
+                already while it is being received and the client gets an error.""",
+                'type' : int,
+                'default' : 16*1024*1024,
+                'check' : lambda x: x>=0,
+                'command_line' : ('', '--max-message-size')
+            },
         'log_dir':
             {
                 'descr' : "Directory to store logfiles",
@@ -120,6 +153,55 @@ class UserConfiguration(configuration.Configuration):
                 'check' : lambda x: x>0,
                 'command_line' : ('-a', '--audio-port')
             },
+        'audio_buffer_pool_size':
+            {
+                'descr' : "Maximal number of unused audio buffers kept for each message",
+                'doc' : """Audio buffers are reused for new data once they are played.
+                Played buffers beyond this number are freed.""",
+                'type' : int,
+                'default' : 16,
+                'check' : lambda x: x>=0,
+                'command_line' : ('', '--audio-buffer-pool-size')
+            },
+        'audio_cache_size':
+            {
+                'descr' : "Maximal size of the audio cache in bytes (0 to disable)",
+                'doc' : """Audio of short messages, keys, characters and icons retrieved
+                from drivers is kept for all clients and played again without synthesis when
+                the same text is requested with the same driver settings. The least recently
+                used audio is dropped when the cache is full.""",
+                'type' : int,
+                'default' : 8*1024*1024,
+                'check' : lambda x: x>=0,
+                'command_line' : ('', '--audio-cache-size')
+            },
+        'audio_cache_max_text_length':
+            {
+                'descr' : "Longest text of messages kept in the audio cache",
+                'type' : int,
+                'default' : 100,
+                'check' : lambda x: x>=0
+            },
+        'prerender_keyboard':
+            {
+                'descr' : "Synthesize characters and keys into the audio cache in advance",
+                'doc' : """Letters, digits, punctuation and SSIP key names are synthesized
+                in the background for the current voice and settings of each client, so that
+                keyboard echo is played from memory. Needs the audio cache.""",
+                'type' : bool,
+                'default' : False,
+                'command_line' : ('--prerender-keyboard',)
+            },
+        'audio_socket_path':
+            {
+                'descr' : "Path of a Unix domain socket for audio retrieval (empty for none)",
+                'doc' : """If set, drivers are asked to send audio to this socket instead
+                of audio_host and audio_port. The path must not contain spaces and
+                the drivers must support Unix domain sockets (festival does).""",
+                'type' : str,
+                'default' : "",
+                'command_line' : ('', '--audio-socket-path')
+            },
         'available_drivers':
             {
                 'descr': "List of driver names and their executables",
@@ -154,6 +236,29 @@ class UserConfiguration(configuration.Configuration):
                           #   }
                             ]
             },
+        'driver_pool_size':
+            {
+                'descr': "Number of processes started for each driver",
+                'doc': """Driver processes are started once when the server starts
+                and shared by all clients. Each new client is assigned to the driver process
+                with the least clients. Settings of each client are restored in the driver
+                before its requests are processed.""",
+                'type': int,
+                'default': 1,
+                'check': lambda x: x>0,
+                'command_line': ('', '--driver-pool-size')
+            },
+        'say_text_chunk_size':
+            {
+                'descr': "Minimal size of chunks of long messages sent to drivers (0 to disable)",
+                'doc': """Messages longer than this many characters are split at sentence
+                boundaries and sent to the driver in chunks of at least this size, so that
+                synthesis starts before the driver has processed the whole message.""",
+                'type': int,
+                'default': 0,
+                'check': lambda x: x>=0,
+                'command_line': ('', '--say-text-chunk-size')
+            },
         'default_driver':
             {
                 'descr': "Default driver",
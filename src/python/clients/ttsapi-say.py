@@ -27,6 +27,10 @@ options_definition = {
               'long': 'port',
               'help': "Server port",
               'type': "int"},
+    'socket_path' : {'short': None,
+                     'long': 'socket-path',
+                     'help': "Unix domain socket of a local server",
+                     'type': "string"},
     'absolute_rate' : {'short': None,
                        'long': 'rate',
                        'help': "Speech rate (absolute)",
@@ -105,7 +109,11 @@ if len(args) == 0:
     sys.exit(1)
 
 log.debug("Initializing connection")
-speech_client = ttsapi.client.TCPConnection()
+connection_arguments = {}
+for name in ('host', 'port', 'socket_path'):
+    if getattr(options, name) != None:
+        connection_arguments[name] = getattr(options, name)
+speech_client = ttsapi.client.TCPConnection(**connection_arguments)
 
 log.debug("Setting options")
 set_options(speech_client, options)
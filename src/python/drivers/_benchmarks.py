@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+#
+# _benchmarks.py - Performance measurements of the driver library
+#
+# Copyright (C) 2008 Brailcom, o.p.s.
+#
+# This is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this package; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+
+"""Micro-benchmarks of the driver library. They don't need a running
+provider or synthesizer. Importing the drivers package starts the
+drivers, so run this file directly with src/python in PYTHONPATH
+
+    python drivers/_benchmarks.py [options] [benchmark ...]
+
+When no benchmark is named, all of them are run."""
+
+import sys
+import time
+import socket
+import threading
+import optparse
+
+import driver
+import festival_protocol
+import lisp
+import ttsapi.retrieval
+from ttsapi.structures import AudioEvent
+
+MEGABYTE = 1024 * 1024
+
+class _NullLogger(object):
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+def _report(name, count, unit, seconds):
+    if seconds > 0:
+        rate = count / seconds
+    else:
+        rate = float('inf')
+    print "%-40s %8d %s in %8.3f s  (%10.1f %s/s)" % (name, count, unit,
+                                                      seconds, rate, unit)
+
+def _serve_retrieval(expected):
+    """Start a thread parsing one audio retrieval connection until
+    expected bytes of audio arrive, return its port and the thread"""
+    listening = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listening.bind(("127.0.0.1", 0))
+    listening.listen(1)
+    received = [0]
+    def on_events(message_id, events):
+        pass
+    def on_data(message_id, data, parameters):
+        received[0] += len(data)
+    def serve():
+        client_socket, address = listening.accept()
+        listening.close()
+        parser = ttsapi.retrieval.RetrievalParser(on_events, on_data,
+            on_framing=lambda: client_socket.sendall(ttsapi.retrieval.FRAMING_REPLY))
+        while received[0] < expected:
+            data = client_socket.recv(65536)
+            if len(data) == 0:
+                break
+            parser.feed(data)
+        client_socket.close()
+    server_thread = threading.Thread(target=serve, name="Benchmark retrieval server")
+    server_thread.start()
+    return listening.getsockname()[1], server_thread
+
+def bench_retrieval_framing(options):
+    """Send audio blocks of --block-size bytes with a few events through
+    driver.RetrievalSocket with text and with binary framing"""
+    audio_data = "\0" * options.block_size
+    count = options.megabytes * MEGABYTE / len(audio_data)
+    events = [AudioEvent(type='word_start', n=1, pos_text=0, pos_audio=0),
+              AudioEvent(type='index_mark', name='mark', pos_text=10, pos_audio=500),
+              AudioEvent(type='word_end', n=1, pos_text=20, pos_audio=800)]
+    for framing in ('text', 'binary'):
+        port, server_thread = _serve_retrieval(count * len(audio_data))
+        retrieval_socket = driver.RetrievalSocket("127.0.0.1", port, framing=framing)
+        assert retrieval_socket.framing == framing
+        start = time.time()
+        for i in range(count):
+            retrieval_socket.send_data_block(
+                msg_id=1, block_number=i, data_format="raw",
+                audio_length=len(audio_data) / 32, audio_data=audio_data,
+                sample_rate=16000, channels=1, encoding="S16_LE",
+                event_list=events)
+        server_thread.join()
+        _report("%s framing, blocks of %d bytes" % (framing, len(audio_data)),
+                count * len(audio_data) / MEGABYTE, "MB", time.time() - start)
+        retrieval_socket.close()
+
+def bench_festival_reply(options):
+    """Parse Festival replies with a waveform of one megabyte each received
+    in pieces of --block-size bytes, collecting the waveform and passing
+    it on in pieces"""
+    reply = ("LP\nnilft_StUfF_key" + "WV\n" + "\1" * MEGABYTE
+             + festival_protocol.TERMINATOR + "OK\n")
+    pieces = [reply[i:i+options.block_size]
+              for i in range(0, len(reply), options.block_size)]
+    def on_waveform(data, complete):
+        pass
+    for name, callback in (('collected', None), ('streamed', on_waveform)):
+        start = time.time()
+        for i in range(options.megabytes):
+            parser = festival_protocol.ReplyParser(callback)
+            for piece in pieces:
+                parser.feed(piece)
+            assert parser.code == 'OK'
+        _report("Festival reply, waveform %s" % name, options.megabytes,
+                "MB", time.time() - start)
+
+def bench_lisp_voices(options):
+    """Parse the reply to voice-list and the voice descriptions
+    of --voices Festival voices"""
+    names = ['voice_%d_diphone' % i for i in range(options.voices)]
+    voice_list = "(" + " ".join(names) + ")\n"
+    descriptions = ['(%s ((language english) (gender male) (dialect american) '
+                    '(description "A voice with a \\"long\\" description, %s") '
+                    '(age 30) (coding ISO-8859-1)))\n' % (name, "x" * 200)
+                    for name in names]
+    rounds = 50
+    start = time.time()
+    for i in range(rounds):
+        assert len(lisp.parse(voice_list)) == options.voices
+        for description in descriptions:
+            lisp.assoc(lisp.parse(description)[1])
+    _report("Voice descriptions of %d voices" % options.voices,
+            rounds * options.voices, "voices", time.time() - start)
+
+benchmarks = {
+    'festival_reply': bench_festival_reply,
+    'lisp_voices': bench_lisp_voices,
+    'retrieval_framing': bench_retrieval_framing,
+    }
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] [benchmark ...]")
+    parser.add_option('-m', '--megabytes', dest='megabytes', type='int', default=256,
+                      help="Amount of audio sent")
+    parser.add_option('-b', '--block-size', dest='block_size', type='int',
+                      default=4096, help="Size of audio blocks")
+    parser.add_option('-v', '--voices', dest='voices', type='int', default=100,
+                      help="Number of Festival voices")
+    (options, args) = parser.parse_args()
+
+    driver.log = _NullLogger()
+    for name in args or sorted(benchmarks.keys()):
+        if not benchmarks.has_key(name):
+            print "Unknown benchmark " + name
+            return 1
+        benchmarks[name](options)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
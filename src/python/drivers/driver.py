@@ -30,6 +30,7 @@ import logging
 import socket
 import signal
 import ttsapi
+import ttsapi.retrieval
 from copy import copy
 
 import provider.event as event
@@ -52,33 +53,81 @@ class CtrlRequest(event.Event):
         'character': ("Character position", ("say_text", "say_deferred")),
         'message_id': ("ID of the message", ("say_text", "say_deferred", "say_char",
                                              "say_key", "say_icon", "cancel", "defer",
-                                             "discard"))
+                                             "discard")),
+        'settings': ("Settings when the message was requested, see Core.settings()",
+                     ("say_text", "say_char", "say_key", "say_icon"))
     }
 
 
 # Log, initialized in main_loop or by the driver
 log = None
 
+# Priorities of controller requests, lower first
+_REQUEST_PRIORITIES = {'quit': 0, 'cancel': 0, 'defer': 1, 'discard': 1}
+_SAY_REQUESTS = ('say_text', 'say_deferred', 'say_char', 'say_key', 'say_icon')
+
+def _request_priority(request):
+    """Control requests overtake the synthesis requests"""
+    return _REQUEST_PRIORITIES.get(request.type, 2)
+
+def _request_supersedes(new, queued):
+    """Return True if the queued request is useless after the new one:
+    a discard drops the synthesis of its message waiting for the
+    controller. Requests of other messages are never dropped, each
+    of them was already accepted for a client waiting for its events."""
+    return new.type == 'discard' and queued.type in _SAY_REQUESTS \
+        and queued.message_id == new.message_id
 
 class RetrievalSocket(object):
     """Class for handling the TTS API audio retrieval socket from inside the driver."""
     host = None
     port = None
     
-    def __init__(self, host, port):
+    def __init__(self, host, port, framing='text'):
         """Open socket to target or raise exception if impossible
-        host -- host name or IP address as a string
-        port -- a number representing the desired port"""
+        host -- host name or IP address as a string or path
+        of a Unix domain socket (starting with '/')
+        port -- a number representing the desired port (ignored
+        for Unix domain sockets)
+        framing -- 'text' or 'binary', see ttsapi.retrieval. If the
+        server doesn't support binary framing, text is used."""
         assert isinstance(host, str)
         assert isinstance(port, int)
+        assert framing in ('text', 'binary')
         self.host = host
         self.port = port
 
         self._lock = thread.allocate_lock()
 
+        self._connect()
+        self.framing = 'text'
+        if framing == 'binary':
+            if self._request_binary_framing():
+                self.framing = 'binary'
+            else:
+                log.info("Binary framing refused on the retrieval socket, using text")
+                self._socket.close()
+                self._connect()
+
+    def _connect(self):
+        if self.host.startswith('/'):
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._socket.connect(self.host)
+            return
         self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self._socket.connect((socket.gethostbyname(host), port))
+        self._socket.connect((socket.gethostbyname(self.host), self.port))
+
+    def _request_binary_framing(self):
+        """Ask the server for binary framing, return True if it agreed"""
+        self._socket.sendall(ttsapi.retrieval.FRAMING_REQUEST)
+        reply = ''
+        while not reply.endswith(ttsapi.retrieval.NEWLINE):
+            data = self._socket.recv(len(ttsapi.retrieval.FRAMING_REPLY) - len(reply))
+            if len(data) == 0:
+                break
+            reply += data
+        return reply == ttsapi.retrieval.FRAMING_REPLY
 
     def close(self):
         """Close the socket"""
@@ -94,6 +143,8 @@ class RetrievalSocket(object):
         if audio_data != None:
             data_length = len(audio_data)
             assert isinstance(data_length, int)
+        else:
+            data_length = None
 
         assert isinstance(msg_id, int) and msg_id >= 0
         assert isinstance(block_number, int) and block_number >= 0
@@ -103,54 +154,74 @@ class RetrievalSocket(object):
         assert isinstance(channels, int) or channels == None
         assert isinstance(encoding, str) or encoding == None
         assert isinstance(event_list, list) or event_list == None
-        
+
+        if self.framing == 'binary':
+            # The binary format has no data_format, audio_length and encoding,
+            # only raw 16 bit samples are sent anyway
+            header = ttsapi.retrieval.format_binary_block(
+                msg_id, block_number, data_length=data_length,
+                sample_rate=sample_rate, channels=channels,
+                events=event_list or ())
+            footer = None
+        else:
+            header, footer = self._format_text_block(msg_id, block_number,
+                data_format, audio_length, audio_data, sample_rate,
+                channels, encoding, event_list)
+
+        # Send the header and the audio separately, the audio data are
+        # never copied into a combined message
+        self._lock.acquire()
+        try:
+            self._socket.sendall(header)
+            if audio_data != None:
+                self._socket.sendall(buffer(audio_data))
+                if footer != None:
+                    self._socket.sendall(footer)
+                log.debug("Sent block of " + str(len(header) + data_length)
+                          + " bytes, data len " + str(data_length))
+            else:
+                log.debug("Sent " + str(len(header)) + " bytes")
+        finally:
+            self._lock.release()
+
+    def _format_text_block(self, msg_id, block_number, data_format,
+                           audio_length, audio_data, sample_rate, channels,
+                           encoding, event_list):
+        """Return the text protocol block up to the audio data
+        and the text following the audio data"""
         ENDLINE = "\r\n"
 
         # BLOCK identification and PARAMETERS block
-        message = "BLOCK " + str(msg_id) + " " + str(block_number) + ENDLINE
+        message = ["BLOCK " + str(msg_id) + " " + str(block_number) + ENDLINE]
 
         if audio_data != None:
-            message += "PARAMETERS" + ENDLINE \
+            message.append("PARAMETERS" + ENDLINE \
                 + "data_format "+str(data_format)+ENDLINE \
-                + "data_length "+str(data_length)+ENDLINE \
-                + "audio_lenth "+str(audio_length)+ENDLINE 
+                + "data_length "+str(len(audio_data))+ENDLINE \
+                + "audio_lenth "+str(audio_length)+ENDLINE)
             
             if sample_rate:
-                message += "sample_rate "+str(sample_rate)+ENDLINE
+                message.append("sample_rate "+str(sample_rate)+ENDLINE)
             if channels:
-                message += "channels "+str(channels)+ENDLINE
+                message.append("channels "+str(channels)+ENDLINE)
             if encoding:
-                message += "encoding "+encoding+ENDLINE
-            message += "END OF PARAMETERS" + ENDLINE
+                message.append("encoding "+encoding+ENDLINE)
+            message.append("END OF PARAMETERS" + ENDLINE)
         
         # EVENTS block
         if event_list != None and len(event_list)!=0:
-            message += "EVENTS"+ENDLINE
+            message.append("EVENTS"+ENDLINE)
             for event in event_list:
                 code, event_line = \
                       ttsapi.server.tcp_format_event(event)
-                message += event_line+ENDLINE
-            message += "END OF EVENTS" + ENDLINE
+                message.append(event_line+ENDLINE)
+            message.append("END OF EVENTS" + ENDLINE)
             
         if (audio_data != None):
             # DATA block
-            message += "DATA"+ENDLINE
-            message += audio_data
-            message += "END OF DATA"+ENDLINE
-        
-        # send it
-        self._lock.acquire()
-        total_bytes = len(message)
-        bytes_sent = 0
-        try:
-            while bytes_sent < total_bytes:
-                bytes_sent += self._socket.send(message[bytes_sent:])
-                if audio_data != None:
-                    log.debug("Sent " + str(bytes_sent) + " out of " + str(total_bytes) + " data len" + str(len(audio_data)))
-                else:
-                    log.debug("Sent " + str(bytes_sent) + " bytes")
-        finally:
-            self._lock.release()
+            message.append("DATA"+ENDLINE)
+            return ''.join(message), "END OF DATA"+ENDLINE
+        return ''.join(message), None
     
 class Core(object):
     """Core of the driver, takes care of TTS API communication etc."""
@@ -248,7 +319,7 @@ class Core(object):
         ctrl_thread_requests.push(
             CtrlRequest(type='say_text', text=text, format=format, position=position,
             position_type=position_type, index_mark = index_mark, character = character,
-                  message_id=self._message_id))
+                  message_id=self._message_id, settings=self.settings()))
         #self._message_id = None
         
         return self._message_id
@@ -292,7 +363,8 @@ class Core(object):
             raise ErrorNotSupportedByDriver
         
         ctrl_thread_requests.push(
-            CtrlRequest(type='say_key', text=key, message_id=self._message_id))
+            CtrlRequest(type='say_key', text=key, message_id=self._message_id,
+                        settings=self.settings()))
         #self._message_id = None
         
         return self._message_id
@@ -308,7 +380,8 @@ class Core(object):
             raise ErrorNotSupportedByDriver
         
         ctrl_thread_requests.push(
-            CtrlRequest(type='say_char', text=character, message_id=self._message_id))
+            CtrlRequest(type='say_char', text=character, message_id=self._message_id,
+                        settings=self.settings()))
         #self._message_id = None
         
         return self._message_id
@@ -325,11 +398,19 @@ class Core(object):
             raise ErrorNotSupportedByDriver
         
         ctrl_thread_requests.push(
-            CtrlRequest(type='say_icon', text=icon, message_id=self._message_id))
+            CtrlRequest(type='say_icon', text=icon, message_id=self._message_id,
+                        settings=self.settings()))
         #self._message_id = None
         
         return self._message_id
         
+    def settings(self):
+        """Return the settings a message requested now is to be synthesized
+        with. It is passed to the controller thread with the request (see
+        Controller.request), so that settings made later don't change
+        messages waiting for synthesis. None if the driver doesn't need it."""
+        return None
+
     # Speech Controll commands
 
     def cancel (self):
@@ -538,10 +619,12 @@ class Core(object):
         Arguments:
         host -- IP address of the host machine as a string
         containing groups of three digits separated by a dot
-        port -- a positive number specifying the host port          
+        or path of a Unix domain socket (starting with '/')
+        port -- a positive number specifying the host port
+        (ignored for Unix domain sockets)
         """
         assert isinstance(host, str)
-        assert isinstance(port, int) and port > 0
+        assert isinstance(port, int) and (port > 0 or host.startswith('/'))
         raise ErrorNotSupportedByDriver
 
     def register_callback(self, connection, function):
@@ -555,10 +638,14 @@ class Core(object):
 class Controller(threading.Thread):
     """Controlls the speech synthesis process in a separate thread"""
 
+    # CtrlRequest being handled
+    request = None
+
     def __init__(self):
         global ctrl_thread_requests
 
-        ctrl_thread_requests = event.EventPot()
+        ctrl_thread_requests = event.EventPot(priority=_request_priority,
+                                              supersedes=_request_supersedes)
         threading.Thread.__init__(self, name="Controller")
         self.start()
         
@@ -566,6 +653,7 @@ class Controller(threading.Thread):
         log.debug("Driver thread running!")
         while True:
             e = ctrl_thread_requests.pop()
+            self.request = e
             if e.type == 'say_text':
                 self.say_text(e.text, e.format, e. position, e.position_type,
                               e.index_mark, e.character, e.message_id)
@@ -687,13 +775,14 @@ class Controller(threading.Thread):
         raise ErrorNotSupportedByDriver
         
     def discard (self, message_id):
-        """Discard a previously deferred message.
+        """Discard a previously deferred or a cancelled message.
+        Its requests waiting for the controller were already dropped,
+        drivers which can stop a synthesis in progress override this.
 
         Arguments:
         message_id -- unique identification of the message to discard          
         """
         assert isinstance(message_id, int)
-        raise ErrorNotSupportedByDriver
         
     # Parameter settings
 
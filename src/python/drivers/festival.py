@@ -1,44 +1,53 @@
 #!/usr/bin/python
 
 import sys
+import errno
 import select
 import socket
 import time
 import thread
+import threading
+import Queue
+import itertools
 
 import driver
+import lisp
+from festival_protocol import *
+import provider.clock as clock
 
 from ttsapi.structures import *
 from ttsapi.errors import *
 
 retrieval_socket = None
+block_sender = None
+# Queue of SynthesisJob objects waiting for a SynthesisWorker
+synthesis_jobs = Queue.Queue()
 
 class Configuration(driver.Configuration):
     """Configuration class for Festival"""
     # public
     server_host = 'localhost'
     server_port = 1314
+    # List of (host, port) pairs of Festival servers to connect to,
+    # server_host and server_port if None
+    servers = None
+    # Number of connections to the servers, and so of messages
+    # synthesized at the same time, distributed among the servers
+    connections = 1
     debug_save_output = False
     recode_fallback = '?'
     data_block = 4096
+    # Number of audio blocks waiting to be sent to the retrieval socket
+    # before reading from Festival stops
+    retrieval_queue_size = 8
+    # 'text' or 'binary' framing of audio blocks on the retrieval socket
+    retrieval_framing = 'text'
     # private
     retrieval_host = '127.0.0.1'
     retrieval_port = 6576
     
 conf = Configuration()
 
-class FestivalError(Exception):
-    """Error in Festival"""
-
-    def __init__(self, description=None):
-        self.description = description
-    
-class FestivalCommunicationError(FestivalError):
-    """Bad reply from Festival"""
-
-class FestivalReplyError(FestivalError):
-    """Festival returned the 'ER' reply"""
-    
 class FestivalConnection(object):
     """Connection to festival"""
 
@@ -49,6 +58,9 @@ class FestivalConnection(object):
         # TODO: Handle festival crashes
         
         self._lock = thread.allocate_lock()
+        # Dictionary of key:version of the settings of FestivalPool
+        # applied in this connection
+        self.settings = {}
 
         self._festival_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._festival_socket.connect((socket.gethostbyname(host), port))
@@ -85,151 +97,61 @@ class FestivalConnection(object):
         self._festival_socket.send(data)
         driver.log.debug("Data sent to Festival")
         
-    def _read_to_buffer(self):
-        """If there are any data on the socket, read them
-        to the buffer. Otherwise wait until there is something
-        and read it.'"""
-
-        driver.log.debug("Reading to buffer from Festival")
+    def _receive(self, parser):
+        """Feed parser with the data received from Festival
+        until the reply is complete"""
         fd_tuple = [self._festival_socket,]
-        sel = select.select(fd_tuple, [],  fd_tuple) # wait for output ready and exceptions
-        new_data = self._festival_socket.recv(conf.data_block)
-        if len(new_data) == 0:
-            driver.log.debug("Raising IO Error 1")
-            driver.log.debug("Select returned:" + str(sel))
-            driver.log.debug("Data read: |" + new_data + "|")
-            # Very mysterious, but this sometimes happens...
-            raise IOError
-        self._com_buffer += new_data
-
-        driver.log.debug("Now we are sure there is something to read ("+str(self._festival_socket)+")")
+        if len(self._com_buffer) > 0 and parser.feed(self._com_buffer):
+            self._com_buffer = parser.unparsed()
+            return
         while True:
-            sel = select.select(fd_tuple, [], fd_tuple, 0) # non-blocking now
-            if sel == ([], [], []):
-                return
-            driver.log.debug("Reading something from Festival socket in a loop " + str(sel))
-            new_data = self._festival_socket.recv(conf.data_block)
+            select.select(fd_tuple, [], fd_tuple) # wait for output ready and exceptions
+            try:
+                new_data = self._festival_socket.recv(conf.data_block)
+            except socket.error, (code, message):
+                if code in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    continue
+                raise
             if len(new_data) == 0:
-                # I don't know why, but sometimes select returns activity
-                # on the socket when in fact there is nothing, and we
-                # end up in an infinite loop
-                driver.log.debug("Raising IO Error 2")
-                driver.log.debug("Select returned:" + str(sel))
-                driver.log.debug("Data read: |" + new_data + "|")
+                driver.log.debug("Festival closed the connection")
                 raise IOError
-            self._com_buffer += new_data    
+            if parser.feed(new_data):
+                self._com_buffer = parser.unparsed()
+                return
+
+    def receive_reply(self, on_waveform=None):
+        """Receive a reply from festival, including reply identification,
+        reply data and the trailing reply status information.
+
+        It returns a tuple (reply_code, reply_data, audio_data). If reply_code is 'ER', it
+        raises the FestivalReplyError exception instead.
 
-    def _read_identifier(self):
-        """Read a Festival communication identifier: LP, OK or ER
-        from the buffer"""
-        
-        if len(self._com_buffer) < 3:
-            self._read_to_buffer()
-        identifier = self._com_buffer[:3]
-        self._com_buffer = self._com_buffer[3:]
-
-        driver.log.debug("Received identifier "+identifier)
-
-        if (identifier == 'ER\n'):
-            raise FestivalReplyError;
-            return 'ER'
-        elif (identifier == 'LP\n'):
-            return 'LP'
-        elif (identifier == 'WV\n'):
-            return 'WV'
-        elif (identifier == 'OK\n'):
-            return 'OK'
-        else:
-            raise FestivalCommunicationError("Unknown reply identifier " + identifier) 
-    
-    def receive_reply(self):
-        """Read data (at least one byte or block) and receive a reply from festival,
-        including reply identification, reply data and the trailing reply
-        status information.
-        
-        It returns a tuple (reply_code, reply_data, audio_data). If reply_code is 'ER', it also
-        raises te FestivalReplyError exception.""" 
-        id, audio_data, reply_data = None, None, None
-        
-        driver.log.debug("Receiving reply from Festival")
-        self._read_to_buffer()
-        driver.log.debug("Reply read from Festival")
-        id = self._read_identifier() # Read LP, OK, or ER
-        if (id == 'OK') or (id == 'ER'):
-            driver.log.debug("Received from Festival:" + id)
-            return (id, None, None)
-        
-        while (id == 'LP') or (id == 'WV'):
-            driver.log.debug("Received from Festival:" + id)
-            pointer = self._com_buffer.find('ft_StUfF_key')
-            last_id = id
-            while pointer == -1:
-                self._read_to_buffer()
-                pointer = self._com_buffer.find('ft_StUfF_key')
-            if id == 'LP':
-                reply_data = self._com_buffer[:pointer]
-            elif id == 'WV':
-                audio_data = self._com_buffer[:pointer]
-                
-            self._com_buffer = self._com_buffer[pointer+len('ft_StUfF_key') : ]
-            id = self._read_identifier()
-                
-        if (id == 'OK') or (id == 'ER'):
-            driver.log.debug("Received data from Festival:" + reply_data)
-            if audio_data != None:
-                driver.log.debug("Received audio data from Festival: (not listed)")
-            driver.log.debug("Received from Festival:" + id)
-            return (id, reply_data, audio_data)
-        else:
-            driver.log.debug("Received from Festival:" + id)
-            raise FestivalCommunicationError("Expected ER or OK but got " + id)
-        
-    def parse_lisp_list(self, lisp_list):
-        """Parse a lisp list returned from Festival as a string into a python
-        list of individual items.
-        
         Arguments:
-        lisp_list -- a string containing the lisp list
+        on_waveform -- if given, audio_data is always None and on_waveform(data, complete)
+        is called with the pieces of each waveform as they arrive instead, see ReplyParser
         """
-        result = []
-        temp = lisp_list.strip()
-        if len(temp) == 0: return
-        if temp[0] == '(':
-            temp = temp[1:]
-            if temp[-1] == ')':
-                temp = temp[:-1]
-            else:
-                raise "Syntax error in parse_lisp_list"
-        else: # an atom already
-            return lisp_list
-        
-        level, last_pos = 0, 0
-        quotes = False
-        for i in range(0, len(temp)-1):
-            if (temp[i] == '"'):
-                quotes = not quotes
-            if level == 0 and not quotes and (temp[i] == ' '
-                    or  (i>0 and temp[i-1]==')' and temp[i] == '(')):
-                result += [self.parse_lisp_list(temp[last_pos:i].strip())]
-                last_pos = i
-            elif temp[i] == '(':
-                level+=1
-            elif temp[i] == ')':
-                level -=1
-            if level < 0:
-                raise "Syntax error in parse_lisp_list, unbalanced parenthesis"
-        result += [self.parse_lisp_list(temp[last_pos:].strip())]
-        return result
-        
-    def command(self, command, *arg_list):
+        driver.log.debug("Receiving reply from Festival")
+        parser = ReplyParser(on_waveform)
+        self._receive(parser)
+        driver.log.debug("Received from Festival:" + parser.code)
+        if parser.code == 'ER':
+            raise FestivalReplyError(parser.reply_data)
+        if parser.reply_data != None:
+            driver.log.debug("Received data from Festival:" + parser.reply_data)
+        if parser.audio_data != None:
+            driver.log.debug("Received audio data from Festival: (not listed)")
+        return (parser.code, parser.reply_data, parser.audio_data)
+        
+    def command(self, command, *arg_list, **keywords):
         """Send the specified command with the given arguments
-           and return the reply as a tuple (reply_data, reply_code).
+           and return the reply as a tuple (reply_code, reply_data, audio_data).
             
         Arguments:
         command -- a string with the command to execute
         arg_list -- a tuple with arguments as strings or numbers or tuples.
                         If the argument is a tuple, it has the form (arg, type) where
-                        type is 's' for symbols."""
+                        type is 's' for symbols.
+        on_waveform -- (keyword only) passed to receive_reply()"""
             
         cmd  = "(" + command
         for a in arg_list:
@@ -243,35 +165,159 @@ class FestivalConnection(object):
         cmd += ")\n"
         
         self._lock.acquire()
-        self._send(cmd)
-        reply = self.receive_reply()
-        self._lock.release()
+        try:
+            self._send(cmd)
+            reply = self.receive_reply(on_waveform=keywords.get('on_waveform'))
+        finally:
+            self._lock.release()
         
         return reply
 
+class FestivalPool(object):
+    """Connections to one or more Festival servers.
+
+    Each connection keeps its own voice and prosody settings in Festival.
+    A setting is checked on one connection and recorded in the pool by
+    set(), the other connections are brought up to date with it whenever
+    they are acquired. A message is
+    synthesized with the settings in effect when it was requested, as
+    returned by settings(), even if they changed in the meantime."""
+
+    def __init__(self):
+        self._connections = []
+        self._free = []
+        self._condition = threading.Condition(threading.Lock())
+        # Dictionary of key:(version, command, arg_list)
+        self._settings = {}
+        self._versions = itertools.count(1)
+
+    def open(self, servers, size):
+        """Open size connections distributed among servers, a list
+        of (host, port) pairs"""
+        for i in range(size):
+            host, port = servers[i % len(servers)]
+            connection = FestivalConnection()
+            connection.open(host=host, port=port)
+            self._connections.append(connection)
+            self._free.append(connection)
+
+    def close(self):
+        for connection in self._connections:
+            connection.close()
+
+    def set(self, key, command, *arg_list):
+        """Apply a setting by command with arg_list on one connection,
+        raise FestivalReplyError if Festival rejects it. Otherwise record
+        it to be applied in all connections, replacing the previous
+        setting of key."""
+        connection = self.acquire()
+        try:
+            connection.command(command, *arg_list)
+            self._condition.acquire()
+            try:
+                version = self._versions.next()
+                self._settings[key] = (version, command, arg_list)
+            finally:
+                self._condition.release()
+            connection.settings[key] = version
+        finally:
+            self.release(connection)
+
+    def settings(self):
+        """Return the current settings for acquire()"""
+        self._condition.acquire()
+        try:
+            return self._settings.copy()
+        finally:
+            self._condition.release()
+
+    def acquire(self, settings=None):
+        """Return a free connection with settings (the current
+        settings by default) applied, wait for one if all are in use"""
+        self._condition.acquire()
+        try:
+            while len(self._free) == 0:
+                self._condition.wait()
+            connection = self._free.pop()
+            if settings == None:
+                settings = self._settings.copy()
+        finally:
+            self._condition.release()
+        try:
+            self._apply(connection, settings)
+        except:
+            self.release(connection)
+            raise
+        return connection
+
+    def release(self, connection):
+        self._condition.acquire()
+        try:
+            self._free.append(connection)
+            self._condition.notify()
+        finally:
+            self._condition.release()
+
+    def _apply(self, connection, settings):
+        """Send the settings which differ in connection in the order
+        they were made"""
+        entries = settings.items()
+        entries.sort(key=lambda entry: entry[1][0])
+        for key, (version, command, arg_list) in entries:
+            if connection.settings.get(key) == version:
+                continue
+            connection.settings[key] = version
+            try:
+                connection.command(command, *arg_list)
+            except FestivalReplyError:
+                driver.log.error("Festival can't apply " + command + " " + str(arg_list))
+
+    def command(self, command, *arg_list, **keywords):
+        """Send command on any of the connections,
+        see FestivalConnection.command()"""
+        connection = self.acquire()
+        try:
+            return connection.command(command, *arg_list, **keywords)
+        finally:
+            self.release(connection)
+
 class Core(driver.Core):
 
     def __init__(self):
         """Create Festival driver core object"""
         global festival
-        festival = FestivalConnection()
+        festival = FestivalPool()
+        # List of VoiceDescription objects, None until queried
+        self._voices = None
 
     def init(self):
         """Initialize Festival core, connect to Festival server and prepare for speaking"""
+        self._voices = None
         try:
-            festival.open(host=conf.server_host, port=conf.server_port)
+            festival.open(conf.servers or [(conf.server_host, conf.server_port)],
+                          conf.connections)
         except:
             # TODO: Log exception AND notify the caller (Provider) about the reason why
             # the module wasn't started
             raise ErrorInitFailed("Cant initialize Festival")
+        global block_sender
+        block_sender = BlockSender()
+        block_sender.start()
+        for i in range(conf.connections):
+            SynthesisWorker(i).start()
 
     def quit(self):
         """Terminate connection to festival and quit"""
-        driver.log.info("Closing connection to Festival")
+        if block_sender != None:
+            block_sender.quit()
+            driver.log.info("Festival message latencies: " + str(block_sender.statistics()))
+        for i in range(conf.connections):
+            synthesis_jobs.put(None)
+        driver.log.info("Closing connections to Festival")
         try:
             festival.close()
         except socket.error, IOError:
-            driver.log.error("Couldn't close Festival connection")
+            driver.log.error("Couldn't close Festival connections")
 
         super(Core, self).quit()
 
@@ -284,29 +330,57 @@ class Core(driver.Core):
             synthesizer_version = None
             )
     
+    def settings(self):
+        """Return a snapshot of the settings for a SynthesisJob"""
+        return festival.settings()
+
+    def _set(self, key, command, *arg_list):
+        """Set key by command with arg_list in Festival, see FestivalPool.set().
+        Raise ErrorInvalidArgument if Festival rejects it."""
+        try:
+            festival.set(key, command, *arg_list)
+        except FestivalReplyError:
+            driver.log.error("Festival can't apply " + command + " " + str(arg_list))
+            raise ErrorInvalidArgument
+
     def voices(self):
-        """Return list of voices"""
+        """Return list of voices. The voices of a Festival server don't
+        change while it runs, they are only queried the first time after
+        the driver connects. The list is kept until the driver restarts."""
+        if self._voices == None:
+            connection = festival.acquire()
+            try:
+                self._voices = self._query_voices(connection)
+            finally:
+                festival.release(connection)
+        return self._voices
+
+    def _query_voices(self, festival):
         code, voices_string, data = festival.command('voice-list')
-        voice_list = voices_string.strip('()\n').split()
+        voice_list = lisp.parse(voices_string)
+        if not isinstance(voice_list, list):
+            voice_list = []
         driver.log.debug(str(voice_list))
         reply = []
         for voice_name in voice_list:
             voice = VoiceDescription()
             code, voice_details, data = festival.command('voice.description', (voice_name, 's'))
             voice.name = voice_name
-            if voice_details.strip("\n\r ") != 'nil':
-                driver.log.debug("'"+str(voice_details)+"'")
-                driver.log.debug(str(festival.parse_lisp_list(voice_details)))
-                driver.log.debug(str(festival.parse_lisp_list(voice_details)[1]))
-                for  entry, value in festival.parse_lisp_list(voice_details)[1]:
-                    if entry == 'language':
-                        voice.language = value
-                    elif entry == 'dialect':
-                        voice.dialect = value
-                    elif entry == 'gender':
-                        voice.gender = value
-                    elif entry == 'age':
-                        voice.age = int(age)
+            try:
+                description = lisp.parse(voice_details)
+            except lisp.LispSyntaxError:
+                description = None
+            if isinstance(description, list) and len(description) > 1:
+                driver.log.debug(str(description))
+                entries = lisp.assoc(description[1])
+                for entry in ('language', 'dialect', 'gender'):
+                    if isinstance(entries.get(entry), str):
+                        setattr(voice, entry, entries[entry])
+                if entries.has_key('age'):
+                    try:
+                        voice.age = int(entries['age'])
+                    except ValueError:
+                        driver.log.warning("Invalid age of voice " + voice_name)
             else:
                 driver.log.warning("Voice description for voice " + voice_name +
                     "missing in Festival reply!");
@@ -340,7 +414,7 @@ class Core(driver.Core):
         voice_name -- name of a voice as obtained by voices()          
         """
         assert isinstance(voice_name, str)
-        festival.command("speechd-set-voice", voice_name)
+        self._set('voice', "speechd-set-voice", voice_name)
     
     def set_voice_by_properties(self, voice_description, variant):
         """Choose and set a voice best matching the given description.
@@ -375,7 +449,7 @@ class Core(driver.Core):
         args = _add_args(args, variant)
         args = _add_args(args, voice_description.name)
     
-        festival.command("speechd-select-voice", *args)
+        self._set('voice', "speechd-select-voice", *args)
     
     def current_voice(self):
         """Return VoiceDescription of the current voice."""
@@ -396,15 +470,12 @@ class Core(driver.Core):
         if method == 'absolute':
             raise ErrorNotSupportedByDriver
         elif method == 'relative':
-            try:
-                # TODO: black magic, needs support in Festival
-                frate = rate
-                if frate >= 500: frate = 500
-                if frate <= -500: frate = -500
-                # frate in (-500:500)
-                festival.command("speechd-set-rate", frate/5)
-            except FestivalReplyError:
-                driver.log.error("Festival can't set desired " + method + "TTS API rate " + str(rate))
+            # TODO: black magic, needs support in Festival
+            frate = rate
+            if frate >= 500: frate = 500
+            if frate <= -500: frate = -500
+            # frate in (-500:500)
+            self._set('rate', "speechd-set-rate", frate/5)
         else:
             raise ErrorInvalidArgument
             
@@ -421,15 +492,12 @@ class Core(driver.Core):
         if method == 'absolute':
             raise ErrorNotSupportedByDriver
         elif method == 'relative':
-            try:
-                # TODO: black magic, needs support in Festival
-                fpitch = pitch
-                if fpitch >= 500: fpitch = 500
-                if fpitch <= -500: fpitch = -500
-                # fpitch in (-500:500)
-                festival.command("speechd-set-pitch", fpitch/5)
-            except FestivalReplyError:
-                driver.log.error("Festival can't set desired " + method + "TTS API pitch " + str(pitch))
+            # TODO: black magic, needs support in Festival
+            fpitch = pitch
+            if fpitch >= 500: fpitch = 500
+            if fpitch <= -500: fpitch = -500
+            # fpitch in (-500:500)
+            self._set('pitch', "speechd-set-pitch", fpitch/5)
         else:
             raise ErrorInvalidArgument
                 
@@ -442,10 +510,7 @@ class Core(driver.Core):
         mode -- one of 'none', 'all', 'some'          
         """
         assert mode in ('none', 'all', 'some')
-        try:
-            festival.command("speechd-set-punctuation-mode",  (mode, 's'))
-        except:
-            driver.log.error("Festival can't set desired punctuation mode" + mode)
+        self._set('punctuation_mode', "speechd-set-punctuation-mode",  (mode, 's'))
             
     def set_capital_letters_mode(self, mode):
         """Set mode for reading capital letters.
@@ -458,11 +523,8 @@ class Core(driver.Core):
         fmode = mode
         if fmode == 'no':
             fmode = 'none'
-        try:
-            festival.command("speechd-set-capital-character-recognition-mode",
-                (mode, 's'))
-        except:
-            driver.log.error("Festival can't set desired punctuation mode" + mode)
+        self._set('capital_letters_mode',
+                  "speechd-set-capital-character-recognition-mode", (mode, 's'))
 
     def set_audio_output(self, method='playback'):
         """Set audio output method as described in TTS API.
@@ -484,116 +546,359 @@ class Core(driver.Core):
         Arguments:
         host -- IP address of the host machine as a string
         containing groups of three digits separated by a dot
-        port -- a positive number specifying the host port          
+        or path of a Unix domain socket (starting with '/')
+        port -- a positive number specifying the host port
+        (ignored for Unix domain sockets)
         """
         global retrieval_socket
         assert isinstance(host, str)
-        assert isinstance(port, int) and port > 0
+        assert isinstance(port, int) and (port > 0 or host.startswith('/'))
 
 #        if (retrieval_socket == None
  #           or retrieval_socket.host != host or retrieval_socket.port != port):
         conf.retrieval_host = host
-        conf.retrival_port = port
+        conf.retrieval_port = port
         if retrieval_socket != None:
             retrieval_socket.close()
         retrieval_socket = driver.RetrievalSocket(host=conf.retrieval_host, \
-                                                      port=conf.retrieval_port)
-        
-class Controller(driver.Controller):
-    
-    def retrieve_data(self, message_id):
-    
-        def read_item(header, data, type):
-            pos = header.find(data)
-            nist_type = header[pos+len(data)+2];
-            pos_data_begin = header.find(" ", pos+len(data)+2)
-            pos_data_end = header.find("\n", pos+len(data)+2)                    
-            pos_data = header[pos_data_begin:pos_data_end]
-            if nist_type == 'i':
-                return int(pos_data)
-            elif nist_type == 's':
-                return pos_data
-    
-        block_number = 0
-        total_samples = 0
-        code, reply_data, audio_data = festival.command('speechd-next')
-        last_block = False
+                                                      port=conf.retrieval_port, \
+                                                      framing=conf.retrieval_framing)
+        
+# Length of the NIST header of the waveforms sent by Festival
+NIST_HEADER_LENGTH = 1024
+
+def _nist_item(header, name):
+    """Return the value of the item name of a NIST header as
+    an integer or a string, None if the item is missing"""
+    pos = header.find(name)
+    if pos == -1:
+        return None
+    nist_type = header[pos+len(name)+2]
+    pos_data_begin = header.find(" ", pos+len(name)+2)
+    pos_data_end = header.find("\n", pos+len(name)+2)
+    pos_data = header[pos_data_begin:pos_data_end]
+    if nist_type == 'i':
+        return int(pos_data)
+    elif nist_type == 's':
+        return pos_data.strip()
+
+class BlockSender(threading.Thread):
+    """Thread sending the audio blocks of SynthesisJobs to the retrieval
+    socket, so that the next waveforms are read from Festival while the
+    previous ones are sent. The blocks of each job are sent after the
+    blocks of the jobs added before it."""
+
+    def __init__(self):
+        threading.Thread.__init__(self, name="Festival block sender")
+        self.setDaemon(True)
+        self._jobs = Queue.Queue()
+        self._lock = thread.allocate_lock()
+        # Jobs added and not sent completely yet
+        self._pending = []
+        # Time the last block of each message in progress was sent
+        self._last_block = {}
+        # Time from the synthesis request to the end of the message
+        # and between the blocks of a message in miliseconds
+        self._latencies = {'count': 0, 'total': 0.0, 'max': 0.0}
+        self._gaps = {'count': 0, 'total': 0.0, 'max': 0.0}
+
+    def add(self, job):
+        """Send the blocks of job after those of the previous jobs"""
+        self._lock.acquire()
+        try:
+            self._pending.append(job)
+        finally:
+            self._lock.release()
+        self._jobs.put(job)
+
+    def cancel(self, message_id=None):
+        """Cancel all jobs not sent completely, or only those of
+        message_id, their remaining blocks are dropped"""
+        self._lock.acquire()
+        try:
+            for job in self._pending:
+                if message_id == None or job.message_id == message_id:
+                    job.cancelled = True
+        finally:
+            self._lock.release()
+
+    def quit(self):
+        """Send the blocks of the jobs added and terminate the thread"""
+        self._jobs.put(None)
+        self.join()
 
-        driver.log.info("speechd-next returned code: " + code)
-        driver.log.info("speechd-next returned data: " + reply_data)
+    def run(self):
         while True:
-            #driver.log.info("speechd-next returned audio data: " + audio_data)
+            job = self._jobs.get()
+            if job == None:
+                return
+            while True:
+                block = job.blocks.get()
+                if block == None:
+                    break
+                if job.cancelled:
+                    continue
+                try:
+                    retrieval_socket.send_data_block(**block)
+                except socket.error, error:
+                    driver.log.error("Couldn't send audio block: " + str(error))
+                self._measure(block, job.start_time)
+            self._lock.acquire()
+            try:
+                self._pending.remove(job)
+            finally:
+                self._lock.release()
 
-            if (audio_data == None) or (len(audio_data) == 1024):
-                driver.log.info("No audio data for this message, last block")
-                last_block = True
-            else:
+    def _measure(self, block, start_time):
+        now = clock.monotonic()
+        message_id = block['msg_id']
+        self._lock.acquire()
+        try:
+            if self._last_block.has_key(message_id):
+                self._add(self._gaps, now - self._last_block[message_id])
+            self._last_block[message_id] = now
+            if [event for event in block['event_list'] or ()
+                if event.type == 'message_end']:
+                del self._last_block[message_id]
+                self._add(self._latencies, now - start_time)
+        finally:
+            self._lock.release()
+
+    def _add(self, values, seconds):
+        miliseconds = seconds * 1000
+        values['count'] += 1
+        values['total'] += miliseconds
+        if miliseconds > values['max']:
+            values['max'] = miliseconds
+
+    def statistics(self):
+        """Return a dictionary with the number, the average and the
+        largest message latency and gap between blocks in miliseconds
+        ('messages', 'average_latency', 'max_latency', 'gaps',
+        'average_gap', 'max_gap')"""
+        def average(values):
+            if values['count'] > 0:
+                return values['total'] / values['count']
+            return 0.0
+        self._lock.acquire()
+        try:
+            return {'messages': self._latencies['count'],
+                    'average_latency': average(self._latencies),
+                    'max_latency': self._latencies['max'],
+                    'gaps': self._gaps['count'],
+                    'average_gap': average(self._gaps),
+                    'max_gap': self._gaps['max']}
+        finally:
+            self._lock.release()
+
+class SynthesisJob(object):
+    """Synthesis of one message by a Festival command, run by
+    a SynthesisWorker with settings, the snapshot of the settings taken
+    by Core.settings() when the message was requested. It stops reading
+    waveforms when it is cancelled.
+
+    The blocks of the message wait in a queue of at most
+    Configuration.retrieval_queue_size blocks until BlockSender sends
+    them, the worker waits while the queue is full."""
+
+    def __init__(self, message_id, command, arg_list, settings):
+        self.message_id = message_id
+        self.command = command
+        self.arg_list = arg_list
+        # clock.monotonic() time of the request
+        self.start_time = clock.monotonic()
+        self.settings = settings
+        self.cancelled = False
+        # Arguments of retrieval_socket.send_data_block() for each block,
+        # None after the last one
+        self.blocks = Queue.Queue(conf.retrieval_queue_size)
+
+    def send(self, **block):
+        """Queue a block, block are the arguments of
+        retrieval_socket.send_data_block()"""
+        if not self.cancelled:
+            self.blocks.put(block)
+
+    def run(self, connection):
+        """Send the command on connection, then ask Festival for the
+        waveforms of the message one by one and queue them as they arrive"""
+        driver.log.timestamp("Sending synthesis request to Festival")
+        try:
+            connection.command(self.command, *self.arg_list)
+        except FestivalReplyError:
+            driver.log.error(self.command + " unsuccessful with: |"
+                             + str(self.arg_list) + "|")
+
+        block_number = 0
+        total_samples = 0
+        event_list = [AudioEvent(type='message_start', pos_text=0, pos_audio=0)]
+        while not self.cancelled:
+            stream = WaveformStream(self, block_number, event_list)
+            code, reply_data, audio_data = connection.command('speechd-next',
+                                                              on_waveform=stream.feed)
+            driver.log.debug("speechd-next returned code: " + code)
+            block_number, event_list = stream.block_number, stream.event_list
+            if stream.samples > 0:
                 driver.log.timestamp("Received audio data from Festival")
-                if audio_data[:4] != "NIST":
-                    driver.log.error("NIST header missing in audio block from festival, skipping")
-                    # TODO: Maybe return?
-                    continue
-                
-                audio_NIST_header = audio_data[:1024]
-                audio_data_raw = audio_data[1024:]
-                #driver.log.info("Audio NIST header follows:\n"+audio_NIST_header)
-                sample_rate = read_item(audio_NIST_header, "sample_rate", int)
-                sample_count = read_item(audio_NIST_header, "sample_count", int)
-                total_samples += sample_count
-                sample_byte_format = read_item(audio_NIST_header, "sample_byte_format", str)
-                sample_n_bytes = read_item(audio_NIST_header, "sample_n_bytes", int)
-                channel_count = read_item(audio_NIST_header, "channel_count", int)
-            
-            if sample_byte_format == '01':
-                endian = 'LE'
-            elif sample_byte_format == '10':
-                endian = 'BE'
-            else:
-                driver.log.error("Unknown byte format from Festival, supposing little endian")
-                endian = 'LE'
-            
-            encoding = 'S'+str(8*sample_n_bytes) + '_' + endian
-
-            global retrieval_socket
-
-            if not last_block:
-                driver.log.info("Sending " + str(len(audio_data_raw)) + " bytes of audio data for playback")
-                event_list = []
-
-            if block_number == 0:
-                event_list.append(AudioEvent(type='message_start', pos_text=0,
-                                             pos_audio=0))
-                                                         
-            # Sending datablock to retrieval socket
-            retrieval_socket.send_data_block(
-                msg_id = message_id, block_number = block_number,
-                data_format = "raw",
-                audio_length = sample_count/sample_rate*1000,
-                audio_data=audio_data_raw,
-                sample_rate = sample_rate,
-                channels = channel_count,
-                encoding = encoding,
-                event_list = event_list)
-            block_number += 1
-
-            code, reply_data, audio_data = festival.command('speechd-next')
-            if (audio_data == None) or (len(audio_data) == 1024):
-                driver.log.info("No more data, appending message_end to event list")
-                event_list=[]
-                event_list.append(AudioEvent(type='message_end', pos_text = 0,
-                                             pos_audio = float(total_samples)/sample_rate*1000))
-                retrieval_socket.send_data_block(
-                    msg_id = message_id, block_number = block_number,
-                    data_format = "raw",
-                    audio_length = sample_count/sample_rate*1000,
-                    audio_data=None,
-                    sample_rate = sample_rate,
-                    channels = channel_count,
-                    encoding = encoding,
-                    event_list = event_list)
+                total_samples += stream.samples
+                sample_rate = stream.sample_rate
+            elif not stream.invalid:
+                # No more waveforms (or an empty one) for this message
+                break
+        if self.cancelled:
+            driver.log.debug("Synthesis of message " + str(self.message_id)
+                             + " cancelled")
+            return
+
+        driver.log.info("No more data, appending message_end to event list")
+        if total_samples > 0:
+            pos_audio = total_samples * 1000 / sample_rate
+        else:
+            pos_audio = 0
+        event_list.append(AudioEvent(type='message_end', pos_text = 0,
+                                     pos_audio = pos_audio))
+        self.send(
+            msg_id = self.message_id, block_number = block_number,
+            data_format = "raw",
+            audio_length = None,
+            audio_data = None,
+            event_list = event_list)
+
+class SynthesisWorker(threading.Thread):
+    """Thread running the jobs from synthesis_jobs on a connection
+    from the pool, one at a time"""
+
+    def __init__(self, number):
+        threading.Thread.__init__(self, name="Festival synthesis " + str(number))
+        self.setDaemon(True)
+
+    def run(self):
+        while True:
+            job = synthesis_jobs.get()
+            if job == None:
                 return
+            try:
+                if not job.cancelled:
+                    connection = festival.acquire(job.settings)
+                    try:
+                        job.run(connection)
+                    finally:
+                        festival.release(connection)
+            except (FestivalError, IOError, socket.error):
+                driver.log.error("Couldn't retrieve audio data.")
+            # The end of the job for BlockSender
+            job.blocks.put(None)
+
+class WaveformStream(object):
+    """Forwards the waveforms received from Festival to the retrieval
+    socket through a SynthesisJob as they arrive, pass feed() as
+    on_waveform to FestivalConnection.command()"""
+
+    def __init__(self, job, block_number, event_list):
+        self._job = job
+        # Number of the next block to send
+        self.block_number = block_number
+        # Events to send with the next block
+        self.event_list = event_list
+        # Number of samples sent
+        self.samples = 0
+        # A waveform without a valid NIST header was received
+        self.invalid = False
+        self.sample_rate = None
+        self.channels = None
+        self.encoding = None
+        # Bytes per frame of the current waveform, None until
+        # its header is received
+        self._frame_size = None
+        # The rest of the current waveform is skipped
+        self._skipping = False
+        # Data received and not sent yet: the header of the waveform
+        # or less than a block
+        self._pending = []
+        self._pending_length = 0
+
+    def feed(self, data, complete):
+        """Receive a piece of a waveform, complete is True for its last piece"""
+        if not self._skipping:
+            self._pending.append(data)
+            self._pending_length += len(data)
+            if self._frame_size == None and (complete or
+                                             self._pending_length >= NIST_HEADER_LENGTH):
+                pending = ''.join(self._pending)
+                if self._read_header(pending[:NIST_HEADER_LENGTH]):
+                    self._pending = [pending[NIST_HEADER_LENGTH:]]
+                    self._pending_length = len(self._pending[0])
+                else:
+                    self.invalid = True
+                    self._skipping = True
+            if self._frame_size != None and (complete or
+                                             self._pending_length >= conf.data_block):
+                self._send(''.join(self._pending))
+        if complete:
+            self._frame_size = None
+            self._skipping = False
+            self._pending = []
+            self._pending_length = 0
+
+    def _read_header(self, header):
+        """Read the audio parameters from the NIST header,
+        return False if it is not valid"""
+        if header[:4] != "NIST":
+            driver.log.error("NIST header missing in audio block from festival, skipping")
+            return False
+        try:
+            self.sample_rate = _nist_item(header, "sample_rate")
+            sample_byte_format = _nist_item(header, "sample_byte_format")
+            sample_n_bytes = _nist_item(header, "sample_n_bytes")
+            self.channels = _nist_item(header, "channel_count")
+        except (ValueError, IndexError):
+            driver.log.error("Invalid NIST header in audio block from festival, skipping")
+            return False
+        if not self.sample_rate or not sample_n_bytes or not self.channels:
+            driver.log.error("Incomplete NIST header in audio block from festival, skipping")
+            return False
+        if sample_byte_format == '01':
+            endian = 'LE'
+        elif sample_byte_format == '10':
+            endian = 'BE'
+        else:
+            driver.log.error("Unknown byte format from Festival, supposing little endian")
+            endian = 'LE'
+        self.encoding = 'S'+str(8*sample_n_bytes) + '_' + endian
+        self._frame_size = sample_n_bytes * self.channels
+        return True
 
+    def _send(self, data):
+        """Send the whole frames of data, keep the rest pending"""
+        length = len(data) - len(data) % self._frame_size
+        self._pending = [data[length:]]
+        self._pending_length = len(data) - length
+        if length == 0:
+            return
+        samples = length / self._frame_size
+        driver.log.debug("Sending " + str(length) + " bytes of audio data for playback")
+        self._job.send(
+            msg_id = self._job.message_id, block_number = self.block_number,
+            data_format = "raw",
+            audio_length = samples * 1000 / self.sample_rate,
+            audio_data = data[:length],
+            sample_rate = self.sample_rate,
+            channels = self.channels,
+            encoding = self.encoding,
+            event_list = self.event_list)
+        self.block_number += 1
+        self.event_list = []
+        self.samples += samples
 
+class Controller(driver.Controller):
+
+    def _synthesize(self, message_id, command, *arg_list):
+        """Queue the synthesis of message_id by the Festival command,
+        it runs in a SynthesisWorker as soon as a connection is free"""
+        job = SynthesisJob(message_id, command, arg_list, self.request.settings)
+        block_sender.add(job)
+        synthesis_jobs.put(job)
+        return message_id
 
     def say_text (self, text, format='ssml',
                  position = None, position_type = None,
@@ -607,22 +912,7 @@ class Controller(driver.Controller):
     
         escaped_text = text.replace('\\','\\\\').replace('"', '\\\"')
         
-        driver.log.timestamp("Sending synthesis request to Festival")
-
-        # Ask for synthesis
-        try:
-            festival.command("speechd-speak-ssml", escaped_text)
-        except:
-            driver.log.error("SayText unsuccessful with text: |" + text + "|")
-            return
-
-        # Retrieve data and listen for stop events
-        try:
-            self.retrieve_data(message_id = message_id)
-        except FestivalError:
-            driver.log.error("Couldn't retrieve audio data.");
-        
-        return message_id
+        return self._synthesize(message_id, "speechd-speak-ssml", escaped_text)
         
     def say_key (self, key, message_id=None):
         """Synthesize a key event.
@@ -633,18 +923,7 @@ class Controller(driver.Controller):
         """
         if message_id == None:
             raise """Invalid message_id None"""        
-        try:
-            festival.command("speechd-key", key)
-        except:
-            driver.log.error("speechd-key unsuccessful with key: |" + key + "|")
-
-        # Retrieve data and listen for stop events
-        try:
-            self.retrieve_data(message_id = message_id)
-        except:
-            driver.log.error("Couldn't retrieve audio data.");
-        
-        return message_id
+        return self._synthesize(message_id, "speechd-key", key)
         
     def say_char (self, character, message_id=None):
         """Synthesize a character event.
@@ -654,18 +933,7 @@ class Controller(driver.Controller):
         """
         if message_id == None:
             raise """Invalid message_id None"""        
-        try:
-            festival.command("speechd-character", character)
-        except:
-            driver.log.error("speechd-character unsuccessful with: |" + character + "|")
-
-        # Retrieve data and listen for stop events
-        try:
-            self.retrieve_data(message_id = message_id)
-        except:
-            driver.log.error("Couldn't retrieve audio data.");
-        
-        return message_id
+        return self._synthesize(message_id, "speechd-character", character)
         
     def say_icon (self, icon, message_id=None):
         """Synthesize a sound icon.
@@ -676,38 +944,27 @@ class Controller(driver.Controller):
         assert isinstance(icon, str)
         if message_id == None:
             raise """Invalid message_id None"""        
-        try:
-            festival.command("speechd-sound-icon", (icon, 's'))
-        except:
-            driver.log.error("speechd-sound-icon unsuccessful with: |" + icon + "|")
-
-        # Retrieve data and listen for stop events
-        try:
-            self.retrieve_data(message_id = message_id)
-        except:
-            driver.log.error("Couldn't retrieve audio data.");
-        
-        return message_id
+        return self._synthesize(message_id, "speechd-sound-icon", (icon, 's'))
         
     def cancel (self):
         """Cancel current synthesis process and audio output."""
 
         #Here we should somehow terminate synthesis when it will be possible
-        #in Festival
-        pass
+        #in Festival, the waveforms of cancelled messages are only dropped
+        block_sender.cancel()
         
     def defer (self):
         """Defer current message."""
         raise ErrorNotSupportedByDriver
         
     def discard (self, message_id):
-        """Discard a previously deferred message.
+        """Discard a cancelled message.
 
         Arguments:
         message_id -- unique identification of the message to discard          
         """
         assert isinstance(message_id, int)
-        raise ErrorNotSupportedByDriver
+        block_sender.cancel(message_id)
         
 def main():
     """Main loop for driver code"""
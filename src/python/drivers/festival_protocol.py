@@ -0,0 +1,138 @@
+#
+# festival_protocol.py - Parser of Festival server replies
+#
+# Copyright (C) 2008 Brailcom, o.p.s.
+#
+# This is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this package; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+
+"""Incremental parser of the replies of the Festival server.
+
+A reply to a command sent to the Festival server consists of any number
+of sections of the form
+
+    LP
+    <the result of the command as a Lisp expression>ft_StUfF_key
+    WV
+    <a waveform>ft_StUfF_key
+
+followed by the line OK, or ER if the command failed.
+
+ReplyParser accepts the reply in pieces of any size as they arrive on the
+socket. Each piece is only searched once for the terminator of a
+section, waveforms can be passed on in pieces before the whole
+section is received."""
+
+TERMINATOR = 'ft_StUfF_key'
+
+class FestivalError(Exception):
+    """Error in Festival"""
+
+    def __init__(self, description=None):
+        self.description = description
+
+class FestivalCommunicationError(FestivalError):
+    """Bad reply from Festival"""
+
+class FestivalReplyError(FestivalError):
+    """Festival returned the 'ER' reply"""
+
+class ReplyParser(object):
+    """State machine parsing one reply of the Festival server.
+
+    Feed it with the data received on the socket through feed() until it
+    returns True. Then code is 'OK' or 'ER', reply_data is the data of the
+    last LP section and audio_data the last waveform (None if there was
+    no such section).
+
+    If on_waveform is given, waveforms are not collected in audio_data,
+    instead on_waveform(data, complete) is called with the pieces of each
+    waveform as they arrive and complete True for the last piece."""
+
+    def __init__(self, on_waveform=None):
+        self._on_waveform = on_waveform
+        # Received data not parsed yet. While inside a section, it is
+        # never longer than the terminator plus the last piece received.
+        self._input = ''
+        self._state = self._identifier
+        # 'LP' or 'WV' while inside a section
+        self._section = None
+        # Pieces of the data of the current section
+        self._chunks = []
+        self.code = None
+        self.reply_data = None
+        self.audio_data = None
+
+    def feed(self, data):
+        """Parse data received from Festival. Return True if the reply
+        is complete. Raises FestivalCommunicationError on invalid input."""
+        self._input += data
+        while self.code == None and self._state():
+            pass
+        return self.code != None
+
+    def unparsed(self):
+        """Return the data received after the end of the reply"""
+        return self._input
+
+    # Each state handler consumes what it can and returns True if it
+    # should be called again (possibly as another state)
+
+    def _identifier(self):
+        """Between sections, LP, WV, OK or ER"""
+        if len(self._input) < 3:
+            return False
+        identifier = self._input[:3]
+        self._input = self._input[3:]
+        if identifier in ('LP\n', 'WV\n'):
+            self._section = identifier[:2]
+            self._chunks = []
+            self._state = self._section_data
+            return True
+        elif identifier in ('OK\n', 'ER\n'):
+            self.code = identifier[:2]
+            return False
+        else:
+            raise FestivalCommunicationError("Unknown reply identifier "
+                                             + repr(identifier))
+
+    def _section_data(self):
+        """Data of a section up to its terminator"""
+        pointer = self._input.find(TERMINATOR)
+        if pointer == -1:
+            # Keep what may be the start of the terminator
+            # and search it again with the next piece
+            keep = len(TERMINATOR) - 1
+            if len(self._input) > keep:
+                self._add_data(self._input[:-keep], False)
+                self._input = self._input[-keep:]
+            return False
+        self._add_data(self._input[:pointer], True)
+        self._input = self._input[pointer+len(TERMINATOR):]
+        if self._section == 'LP':
+            self.reply_data = ''.join(self._chunks)
+        elif self._on_waveform == None:
+            self.audio_data = ''.join(self._chunks)
+        self._chunks = []
+        self._section = None
+        self._state = self._identifier
+        return True
+
+    def _add_data(self, data, complete):
+        if self._section == 'WV' and self._on_waveform != None:
+            if len(data) > 0 or complete:
+                self._on_waveform(data, complete)
+        elif len(data) > 0:
+            self._chunks.append(data)
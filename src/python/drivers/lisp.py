@@ -0,0 +1,87 @@
+#
+# lisp.py - Parser of Lisp expressions returned by Festival
+#
+# Copyright (C) 2008 Brailcom, o.p.s.
+#
+# This is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this package; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+
+"""Parser of the Lisp expressions Festival returns in its replies.
+
+Lists are parsed into Python lists, strings into Python strings without
+the quotes and other atoms (symbols, numbers, nil) into Python strings as
+they are written. The expression is split into tokens by one regular
+expression and the tokens are read in a single pass, the time is linear
+in the length of the expression."""
+
+import re
+
+_TOKEN = re.compile(r'''
+    \s*(?:
+      (?P<open>\()
+    | (?P<close>\))
+    | (?P<quote>')
+    | "(?P<string>(?:[^"\\]|\\.)*)"
+    | (?P<atom>[^\s()"']+)
+    )''', re.VERBOSE | re.DOTALL)
+
+_ESCAPE = re.compile(r'\\(.)', re.DOTALL)
+
+class LispSyntaxError(Exception):
+    """Invalid Lisp expression"""
+    pass
+
+def parse(text):
+    """Parse the first expression in text and return it, None if
+    text contains no expression. Quoted expressions ('x) are returned
+    as the expression itself. Raises LispSyntaxError."""
+    # Stack of the lists being read, the outermost first
+    stack = []
+    position = 0
+    end = len(text.rstrip())
+    while position < end:
+        match = _TOKEN.match(text, position)
+        if match == None:
+            raise LispSyntaxError("Invalid expression at: " + text[position:position+20])
+        position = match.end()
+        kind = match.lastgroup
+        if kind == 'quote':
+            continue
+        elif kind == 'open':
+            stack.append([])
+            continue
+        elif kind == 'close':
+            if len(stack) == 0:
+                raise LispSyntaxError("Unbalanced parenthesis")
+            value = stack.pop()
+        elif kind == 'string':
+            value = _ESCAPE.sub(r'\1', match.group('string'))
+        else:
+            value = match.group('atom')
+        if len(stack) == 0:
+            return value
+        stack[-1].append(value)
+    if len(stack) > 0:
+        raise LispSyntaxError("Unterminated list")
+    return None
+
+def assoc(alist):
+    """Return a dictionary of the entries (key value) of a parsed
+    association list, entries which are not lists are skipped"""
+    result = {}
+    for entry in alist:
+        if isinstance(entry, list) and len(entry) > 1:
+            result[entry[0]] = entry[1]
+    return result
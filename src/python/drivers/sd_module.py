@@ -257,22 +257,65 @@ class _SSIP_Connection:
         'IOError' is raised when the socket was closed by the remote side.
         
         """
+        data = self._escape_data(data)
+        try:
+            self._pipe_in.write(data + self._END_OF_DATA)
+            self._pipe_in.flush()
+        except IOError:
+            raise SSIPCommunicationError("Driver connection lost.")
+        code, msg, response_data = self._recv_response()
+        if code/100 != 2:
+            raise SSIPDataError(code, msg, data)
+        return code, msg, response_data
+
+    def _escape_data(self, data):
+        """Return data with the end-of-data marker escaped"""
         # Escape the end-of-data marker even if present at the beginning
         if data.startswith(self._END_OF_DATA_MARKER + self._NEWLINE):
             l = len(self._END_OF_DATA_MARKER)
             data = self._END_OF_DATA_MARKER_ESCAPED + data[l:]
         elif data == self._END_OF_DATA_MARKER:
             data = self._END_OF_DATA_MARKER_ESCAPED
-        data = data.replace(self._END_OF_DATA, self._END_OF_DATA_ESCAPED)
+        return data.replace(self._END_OF_DATA, self._END_OF_DATA_ESCAPED)
+
+    def send_batch(self, requests):
+        """Send several commands and data at once and read the responses
+        afterwards, so that only one round trip is needed for all of them.
+
+        Arguments:
+          requests -- a list of ('command', command) and ('data', data) pairs
+            in the order they should be sent
+
+        Returns a list of the responses to the requests, each of them as
+        returned by 'send_command()' or 'send_data()'.  All responses are
+        read before 'SSIPCommandError' or 'SSIPDataError' is raised for the
+        first request which failed.
+
+        """
+        message = []
+        for kind, value in requests:
+            if kind == 'command':
+                message.append(value + self._NEWLINE)
+            else:
+                message.append(self._escape_data(value) + self._END_OF_DATA)
         try:
-            self._pipe_in.write(data + self._END_OF_DATA)
+            self._pipe_in.write(''.join(message))
             self._pipe_in.flush()
         except IOError:
             raise SSIPCommunicationError("Driver connection lost.")
-        code, msg, response_data = self._recv_response()
-        if code/100 != 2:
-            raise SSIPDataError(code, msg, data)
-        return code, msg, response_data
+        responses = []
+        error = None
+        for kind, value in requests:
+            code, msg, data = self._recv_response()
+            if code/100 != 2 and error == None:
+                if kind == 'command':
+                    error = SSIPCommandError(code, msg, value)
+                else:
+                    error = SSIPDataError(code, msg, value)
+            responses.append((code, msg, data))
+        if error != None:
+            raise error
+        return responses
 
     def set_callback(self, callback):
         """Register a callback function for handling asynchronous events.
@@ -300,13 +343,15 @@ class _SSIP_Connection:
 class SSIPDriver(object):
     """Basic Driver SSIP client interface."""
 
-    settings = {'language' : 'en'}
     current_msg_id = None
 
     def __init__(self, binary_path, binary_conf):
         """Run binary_path as a subprocess and establish piped connection"""
 
         self._lock = threading.Lock()
+        self.settings = {'language' : 'en'}
+        # Names of the settings changed since they were last sent
+        self._dirty = set(self.settings.keys())
 
         self._module = subprocess.Popen((binary_path, binary_conf), bufsize=1,
                                         stdin=subprocess.PIPE, stdout=subprocess.PIPE,
@@ -322,8 +367,14 @@ class SSIPDriver(object):
         driver.log.info("Child process terminated")
 
     def set(self, item, value):
-        # TODO: Locking
-        self.settings[item] = value
+        """Change a setting, it is sent to the module with the next message"""
+        self._lock.acquire()
+        try:
+            if self.settings.get(item) != value:
+                self.settings[item] = value
+                self._dirty.add(item)
+        finally:
+            self._lock.release()
 
     def init(self):
         """Initialize the module"""
@@ -331,22 +382,53 @@ class SSIPDriver(object):
         result = self._conn.send_command('INIT')
         
         return result
-           
-    def send_settings(self):
-        """Send current settings to output module. Settings is a list of tuples
-        (field, value)"""
-        res = ""
-        for field, value in self.settings.iteritems():
-            if isinstance(value, str):
-                val = value
-            elif isinstance(value, int) or isinstance(value, float):
-                val = str(int(value))
-            else:
-                raise "Unexpected data type"
-            res += field + "=" + val + "\n"
-        self._conn.send_command('SET')
+
+    def _take_settings(self):
+        """Return the SET requests for send_batch() with the settings
+        changed since they were last sent, an empty list if there are none,
+        and the names of these settings"""
+        self._lock.acquire()
+        try:
+            dirty = self._dirty
+            self._dirty = set()
+            res = ""
+            for field in sorted(dirty):
+                value = self.settings[field]
+                if isinstance(value, str):
+                    val = value
+                elif isinstance(value, int) or isinstance(value, float):
+                    val = str(int(value))
+                else:
+                    raise "Unexpected data type"
+                res += field + "=" + val + "\n"
+        finally:
+            self._lock.release()
+        if len(dirty) == 0:
+            return [], dirty
         driver.log.debug("Sending set data |" + res.rstrip('\n') + "|")
-        self._conn.send_data(res.rstrip('\n'))
+        return [('command', 'SET'), ('data', res.rstrip('\n'))], dirty
+
+    def _send_with_settings(self, requests):
+        """Send requests with send_batch(), preceded by the changed settings.
+        Return the response to the last request."""
+        settings, dirty = self._take_settings()
+        if len(settings + requests) == 0:
+            return None
+        try:
+            responses = self._conn.send_batch(settings + requests)
+        except (SSIPError, SSIPResponseError):
+            if len(dirty) > 0:
+                # The settings may not have reached the module
+                self._lock.acquire()
+                self._dirty.update(dirty)
+                self._lock.release()
+            raise
+        return responses[-1]
+
+    def send_settings(self):
+        """Send the settings changed since they were last sent to the
+        output module"""
+        self._send_with_settings([])
 
     def speak(self, text):
         """Say given message.
@@ -358,10 +440,7 @@ class SSIPDriver(object):
         message is queued on the server and the method returns immediately.
 
         """
-        self.send_settings()
-        self._conn.send_command('SPEAK')
-        result = self._conn.send_data(text)
-        return result
+        return self._send_with_settings([('command', 'SPEAK'), ('data', text)])
 
     def char(self, char):
         """Say given character.
@@ -374,8 +453,8 @@ class SSIPDriver(object):
         message is queued on the server and the method returns immediately.
 
         """
-        self._conn.send_command('CHAR')
-        self._conn.send_data(char.replace(' ', 'space'))
+        self._send_with_settings([('command', 'CHAR'),
+                                  ('data', char.replace(' ', 'space'))])
 
     def key(self, key):
         """Say given key name.
@@ -387,9 +466,7 @@ class SSIPDriver(object):
         message is queued on the server and the method returns immediately.
 
         """
-        self.send_settings()
-        self._conn.send_command('KEY')
-        self._conn.send_data(key)
+        self._send_with_settings([('command', 'KEY'), ('data', key)])
 
     def sound_icon(self, sound_icon):
         """Output given sound_icon.
@@ -401,9 +478,7 @@ class SSIPDriver(object):
         is queued on the server and the method returns immediately.
 
         """
-        self.send_settings()
-        self._conn.send_command('SOUND_ICON')
-        self._conn.send_data(sound_icon)
+        self._send_with_settings([('command', 'SOUND_ICON'), ('data', sound_icon)])
 
     def stop(self):
         """Immediately stop speaking the currently spoken message."""
@@ -609,7 +684,9 @@ class Core(driver.Core):
         Arguments:
         host -- IP address of the host machine as a string
         containing groups of three digits separated by a dot
-        port -- a positive number specifying the host port          
+        or path of a Unix domain socket (starting with '/')
+        port -- a positive number specifying the host port
+        (ignored for Unix domain sockets)
         """
         raise ErrorNotSupportedByDriver
         
@@ -624,15 +701,13 @@ class Controller(driver.Controller):
         if format != 'ssml': raise ErrorNotSupportedByDriver
     
         # Ask for synthesis
+        module.current_msg_id = message_id
         try:
             module.speak(text)
-            module.current_msg_id = 1
         except Exception, e:
             driver.log.error("say_text unsuccessful with text: |" + text + "|" + str(e))
             return
 
-        # TODO: Handle message_id consistently
-        message_id = module.current_msg_id
         return message_id
         
     def say_key (self, key, message_id=None):
@@ -642,12 +717,12 @@ class Controller(driver.Controller):
         key -- a string containing a key identification as defined
         in TTS API          
         """
+        module.current_msg_id = message_id
         try:
             module.key(key)
         except:
             driver.log.error("say_key unsuccessful with key: |" + key + "|")
 
-        message_id = 1
         return message_id
         
     def say_char (self, character, message_id=None):
@@ -656,12 +731,12 @@ class Controller(driver.Controller):
         Arguments:
         character -- a single UTF-32 character.          
         """
+        module.current_msg_id = message_id
         try:
             module.char(character)
         except:
             driver.log.error("say_char unsuccessful with: |" + character + "|")
 
-        message_id = 1
         return message_id
         
     def say_icon (self, icon, message_id=None):
@@ -671,12 +746,12 @@ class Controller(driver.Controller):
         icon -- name of the icon as defined in TTS API.          
         """
         assert isinstance(icon, str)
+        module.current_msg_id = message_id
         try:
             module.sound_icon(icon)
         except:
             driver.log.error("speechd-sound-icon unsuccessful with: |" + icon + "|")
 
-        message_id = 1
         return message_id
         
     def cancel (self):
@@ -689,13 +764,14 @@ class Controller(driver.Controller):
         raise ErrorNotSupportedByDriver
         
     def discard (self, message_id):
-        """Discard a previously deferred message.
-4
+        """Discard a cancelled message, stop it if the module speaks it.
+
         Arguments:
         message_id -- unique identification of the message to discard          
         """
         assert isinstance(message_id, int)
-        raise ErrorNotSupportedByDriver
+        if module.current_msg_id == message_id:
+            module.stop()
         
 def main():
     """Main loop for driver code"""
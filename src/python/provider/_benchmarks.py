@@ -0,0 +1,493 @@
+#!/usr/bin/env python
+#
+# _benchmarks.py - Performance measurements of TTS API Provider
+#
+# Copyright (C) 2008 Brailcom, o.p.s.
+#
+# This is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this package; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+
+"""Benchmarks of a running TTS API Provider.
+
+Start the provider with the configuration you want to measure (e.g. once
+with --server-mode threads and once with --server-mode events) and run
+
+    python -m provider._benchmarks [options] [benchmark ...]
+
+When no benchmark is named, all of them except the audio_soak ones
+are run."""
+
+import sys
+import time
+import socket
+import resource
+import threading
+import optparse
+
+import ttsapi.client
+
+NEWLINE = "\r\n"
+
+class _RawClient(object):
+    """Minimal text protocol client without any threads so that
+    the benchmark itself doesn't distort the measurements"""
+
+    def __init__(self, host, port):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
+        self._socket.connect((host, port))
+        self._buffer = ''
+
+    def send(self, line):
+        self._socket.sendall(line + NEWLINE)
+
+    def read_reply(self):
+        """Read lines until the final line of a reply, return its code"""
+        while True:
+            pointer = self._buffer.find(NEWLINE)
+            while pointer == -1:
+                data = self._socket.recv(4096)
+                if len(data) == 0:
+                    raise IOError("Connection closed by the provider")
+                self._buffer += data
+                pointer = self._buffer.find(NEWLINE)
+            line = self._buffer[:pointer]
+            self._buffer = self._buffer[pointer+len(NEWLINE):]
+            if len(line) >= 4 and line[3] == ' ':
+                return int(line[:3])
+
+    def close(self):
+        try:
+            self.send("QUIT")
+        except socket.error:
+            pass
+        self._socket.close()
+
+def _report(name, count, unit, seconds):
+    if seconds > 0:
+        rate = count / seconds
+    else:
+        rate = float('inf')
+    print "%-40s %8d %s in %8.3f s  (%10.1f %s/s)" % (name, count, unit,
+                                                      seconds, rate, unit)
+
+def bench_connections(options):
+    """Open many simultaneous connections and send cheap commands on all
+    of them in turns. Reports accepted connections and commands per second."""
+
+    # SET VOLUME is handled inside the provider without talking to drivers
+    command = "SET relative VOLUME 100"
+
+    start = time.time()
+    clients = []
+    for i in range(options.clients):
+        client = _RawClient(options.host, options.port)
+        # The connection is only really accepted when a reply comes back
+        client.send(command)
+        client.read_reply()
+        clients.append(client)
+    _report("accepted connections", len(clients), "conn", time.time() - start)
+
+    start = time.time()
+    for i in range(options.commands):
+        for client in clients:
+            client.send(command)
+        for client in clients:
+            code = client.read_reply()
+            assert code == 211, "Unexpected reply code " + str(code)
+    _report("commands over %d connections" % len(clients),
+            options.commands * len(clients), "cmd", time.time() - start)
+
+    for client in clients:
+        client.close()
+
+def bench_connect(options):
+    """Connect, get the first reply and disconnect, one client after another.
+    Reports the average and worst connect latency, which includes creating
+    the Provider and its driver sessions."""
+
+    command = "SET relative VOLUME 100"
+    latencies = []
+    start = time.time()
+    for i in range(options.clients):
+        connect_start = time.time()
+        client = _RawClient(options.host, options.port)
+        client.send(command)
+        client.read_reply()
+        latencies.append(time.time() - connect_start)
+        client.close()
+    _report("sequential connects", len(latencies), "conn", time.time() - start)
+    print "%-40s avg %8.3f ms  max %8.3f ms" % ("connect latency",
+                                               1000 * sum(latencies) / len(latencies),
+                                               1000 * max(latencies))
+
+def bench_driver_info(options):
+    """Connect and ask for the voices and capabilities of the default
+    driver as clients do after connecting, one client after another.
+    Reports the average and worst latency of the whole exchange."""
+
+    latencies = []
+    start = time.time()
+    for i in range(options.clients):
+        connect_start = time.time()
+        client = _RawClient(options.host, options.port)
+        for command in ("LIST DRIVERS", "DRIVER CAPABILITIES", "LIST VOICES"):
+            client.send(command)
+            code = client.read_reply()
+            assert code < 300, "Unexpected reply code " + str(code)
+        latencies.append(time.time() - connect_start)
+        client.close()
+    _report("connects with driver queries", len(latencies), "conn",
+            time.time() - start)
+    print "%-40s avg %8.3f ms  max %8.3f ms" % ("connect and query latency",
+                                               1000 * sum(latencies) / len(latencies),
+                                               1000 * max(latencies))
+
+_TEXT = "The quick brown fox jumps over the lazy dog. " \
+    "Pack my box with five dozen liquor jugs. " \
+    "How vexingly quick daft zebras jump! "
+
+def _statistics(values):
+    """Return mean, standard deviation and maximal absolute value"""
+    mean = sum(values) / len(values)
+    variance = sum([(v - mean) ** 2 for v in values]) / len(values)
+    return mean, variance ** 0.5, max([abs(v) for v in values])
+
+def bench_event_jitter(options):
+    """Speak messages and compare the arrival times of word and index mark
+    events on the client with their positions in audio. Reports the
+    offsets relative to the message_start event."""
+    tts = ttsapi.client.TCPConnection(host=options.host, port=options.port)
+    arrivals = []
+    finished = threading.Event()
+    def callback(event):
+        arrivals.append((time.time(), event))
+        if event.type == 'message_end':
+            finished.set()
+    tts.register_callback('all', callback)
+
+    offsets = []
+    for i in range(options.messages):
+        del arrivals[:]
+        finished.clear()
+        tts.say_text(_TEXT * 3)
+        finished.wait(120)
+        if not finished.isSet():
+            print "Message %d didn't finish, skipping it" % i
+            continue
+        start = None
+        for arrival, event in arrivals:
+            if event.type == 'message_start':
+                start = arrival
+            elif start != None and event.pos_audio != None \
+                    and event.type != 'message_end':
+                offsets.append(1000 * (arrival - start) - event.pos_audio)
+    tts.close()
+
+    if len(offsets) == 0:
+        print "No events with audio positions received"
+        return
+    mean, deviation, worst = _statistics(offsets)
+    print "%-40s %8d events  mean %8.2f ms  stddev %8.2f ms  max %8.2f ms" % \
+        ("event timing error", len(offsets), mean, deviation, worst)
+
+def bench_first_audio(options):
+    """Speak messages of growing length and measure the time from SAY TEXT
+    until the message_start event, i.e. until the first audio plays.
+    Compare runs of the provider with and without say_text_chunk_size."""
+    tts = ttsapi.client.TCPConnection(host=options.host, port=options.port)
+    started = threading.Event()
+    finished = threading.Event()
+    def callback(event):
+        if event.type == 'message_start':
+            started.set()
+        elif event.type == 'message_end':
+            finished.set()
+    tts.register_callback('all', callback)
+
+    repeat = 1
+    while repeat <= options.max_repeat:
+        text = _TEXT * repeat
+        started.clear()
+        finished.clear()
+        start = time.time()
+        tts.say_text(text)
+        started.wait(120)
+        if not started.isSet():
+            print "Message of %d characters didn't start" % len(text)
+            break
+        print "%-40s %8.3f ms" % ("first audio, %d characters" % len(text),
+                                  1000 * (time.time() - start))
+        # Let the message play out, so that it doesn't delay the next one
+        finished.wait(60 * repeat)
+        repeat *= 4
+    tts.close()
+
+def _start_latencies(options, requests):
+    """Call each of the functions in requests with a client connection
+    as the argument, wait until the message it says finishes and return
+    the list of times from the request until the message_start event"""
+    tts = ttsapi.client.TCPConnection(host=options.host, port=options.port)
+    started = threading.Event()
+    finished = threading.Event()
+    def callback(event):
+        if event.type == 'message_start':
+            started.set()
+        elif event.type == 'message_end':
+            finished.set()
+    tts.register_callback('all', callback)
+
+    latencies = []
+    for request in requests:
+        started.clear()
+        finished.clear()
+        start = time.time()
+        request(tts)
+        started.wait(60)
+        if not started.isSet():
+            print "Message %d didn't start" % len(latencies)
+            break
+        latencies.append(time.time() - start)
+        finished.wait(60)
+    tts.close()
+    return latencies
+
+def bench_repeated_keys(options):
+    """Say the same key --messages times and measure the time from SAY KEY
+    until the message_start event. With the audio cache, only the first
+    request should go to the driver."""
+    latencies = _start_latencies(options, [lambda tts: tts.say_key("enter")]
+                                 * options.messages)
+    if len(latencies) == 0:
+        return
+    print "%-40s %8.3f ms" % ("first key", 1000 * latencies[0])
+    if len(latencies) > 1:
+        repeated = latencies[1:]
+        print "%-40s avg %8.3f ms  max %8.3f ms" % ("repeated key",
+                                                   1000 * sum(repeated) / len(repeated),
+                                                   1000 * max(repeated))
+
+def bench_keyboard_echo(options):
+    """Echo the characters of a typed sentence by SAY CHAR and measure
+    the time until each of them starts playing. Start the provider with
+    --prerender-keyboard and give it time to prerender to measure the
+    latency of echo from memory."""
+    typed = "The quick brown fox, 42 times!"
+    requests = [lambda tts, character=character: tts.say_char(character)
+                for character in typed]
+    latencies = _start_latencies(options, requests)
+    if len(latencies) == 0:
+        return
+    print "%-40s avg %8.3f ms  max %8.3f ms" % (
+        "echo of %d characters" % len(latencies),
+        1000 * sum(latencies) / len(latencies), 1000 * max(latencies))
+
+def bench_cancel(options):
+    """Speak a long message, cancel it half a second after it starts playing
+    and measure the time until the reply to CANCEL, which comes when the
+    audio is silent. The provider logs its own measurement on exit."""
+    tts = ttsapi.client.TCPConnection(host=options.host, port=options.port)
+    started = threading.Event()
+    def callback(event):
+        if event.type == 'message_start':
+            started.set()
+    tts.register_callback('all', callback)
+
+    latencies = []
+    for i in range(options.messages):
+        started.clear()
+        tts.say_text(_TEXT * 10)
+        started.wait(60)
+        if not started.isSet():
+            print "Message %d didn't start" % i
+            break
+        time.sleep(0.5)
+        start = time.time()
+        tts.cancel()
+        latencies.append(time.time() - start)
+    tts.close()
+
+    if len(latencies) == 0:
+        return
+    print "%-40s avg %8.3f ms  max %8.3f ms" % (
+        "cancel to silence, %d messages" % len(latencies),
+        1000 * sum(latencies) / len(latencies), 1000 * max(latencies))
+
+class _NullLogger(object):
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+def _rss():
+    """Return the resident set size of this process in KB"""
+    try:
+        statm = open('/proc/self/statm').read().split()
+        return int(statm[1]) * resource.getpagesize() / 1024
+    except (IOError, IndexError, ValueError):
+        # Linux reports the maximum in KB, it's the best we have
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def bench_audio_soak(options):
+    """Stream silence through the audio output as one long message in
+    real time for --seconds seconds and report the numbers of OpenAL
+    buffers and the memory used every --report-interval seconds.
+
+    The audio output of the provider runs inside this process,
+    no provider needs to be running."""
+    import audio
+    import sleep
+
+    audio.log = _NullLogger()
+    audio.conf = options
+    output = audio.Audio()
+    sleeper = sleep.Sleeper()
+    message_id = 1
+    output.accept(message_id)
+    pool = output.buffer_pools[message_id]
+
+    sample_rate = 16000
+    block_duration = 0.1
+    block = "\0\0" * int(sample_rate * block_duration)
+    def report(sent):
+        statistics = pool.statistics()
+        print "%8.0f s of audio  buffers generated %6d reused %8d deleted %6d " \
+            "queued %4d free %4d  RSS %8d KB" % \
+            (sent, statistics['generated'], statistics['reused'],
+             statistics['deleted'], statistics['queued'], statistics['free'],
+             _rss())
+
+    start = time.time()
+    last_report = start
+    sent = 0.0
+    while sent < options.seconds:
+        # Keep about one second of audio ahead of playback
+        ahead = sent - (time.time() - start)
+        if ahead > 1.0:
+            time.sleep(ahead - 1.0)
+        output.add_data(message_id, block, "raw", sample_rate, 1,
+                        "S16_LE", sleeper)
+        sent += block_duration
+        if time.time() - last_report >= options.report_interval:
+            report(sent)
+            last_report = time.time()
+    report(sent)
+    output.close()
+
+def bench_audio_soak_messages(options):
+    """Play many short messages one after another in real time for
+    --seconds seconds, releasing each of them when it ends, and report
+    the numbers of tracks and messages held by the audio output and the
+    memory used every --report-interval seconds. The numbers must stay
+    constant however long it runs.
+
+    The audio output of the provider runs inside this process,
+    no provider needs to be running."""
+    import audio
+    import event
+    import sleep
+
+    audio.log = _NullLogger()
+    audio.conf = options
+    output = audio.Audio()
+    audio.audio = output
+    audio.audio_events = event.EventQueue()
+    sleeper = sleep.Sleeper()
+    events_thread = threading.Thread(target=audio.events, name="Audio-events",
+                                     kwargs={'sleeper': sleeper})
+    events_thread.termination_request = False
+    events_thread.start()
+
+    sample_rate = 16000
+    message_duration = 0.2
+    block = "\0\0" * int(sample_rate * message_duration)
+    def report(sent, messages):
+        print "%8.0f s of audio  messages %8d  sources %4d buffer pools %4d " \
+            "in playback %4d event lists %4d  RSS %8d KB" % \
+            (sent, messages, len(output.sources), len(output.buffer_pools),
+             len(audio.messages_in_playback), len(audio.event_list), _rss())
+
+    start = time.time()
+    last_report = start
+    sent = 0.0
+    message_id = 0
+    try:
+        while sent < options.seconds:
+            ahead = sent - (time.time() - start)
+            if ahead > 0:
+                time.sleep(ahead)
+            message_id += 1
+            output.accept(message_id)
+            output.add_data(message_id, block, "raw", sample_rate, 1,
+                            "S16_LE", sleeper)
+            # The provider does so when the message_end event comes
+            output.release(message_id, sleeper)
+            sent += message_duration
+            if time.time() - last_report >= options.report_interval:
+                report(sent, message_id)
+                last_report = time.time()
+        # Let the last messages play out
+        time.sleep(1.0)
+        report(sent, message_id)
+    finally:
+        events_thread.termination_request = True
+        sleeper.interrupt()
+        events_thread.join()
+        output.close()
+
+benchmarks = {
+    'audio_soak': bench_audio_soak,
+    'audio_soak_messages': bench_audio_soak_messages,
+    'cancel': bench_cancel,
+    'connections': bench_connections,
+    'event_jitter': bench_event_jitter,
+    'first_audio': bench_first_audio,
+    'keyboard_echo': bench_keyboard_echo,
+    'repeated_keys': bench_repeated_keys,
+    'connect': bench_connect,
+    'driver_info': bench_driver_info,
+    }
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] [benchmark ...]")
+    parser.add_option('-H', '--host', dest='host', default='127.0.0.1',
+                      help="Provider host")
+    parser.add_option('-P', '--port', dest='port', type='int', default=6567,
+                      help="Provider port")
+    parser.add_option('-c', '--clients', dest='clients', type='int', default=200,
+                      help="Number of simultaneous client connections")
+    parser.add_option('-n', '--commands', dest='commands', type='int', default=50,
+                      help="Number of commands sent on each connection")
+    parser.add_option('-m', '--messages', dest='messages', type='int', default=5,
+                      help="Number of messages spoken")
+    parser.add_option('-x', '--max-repeat', dest='max_repeat', type='int', default=64,
+                      help="Longest message in first_audio as a number of repeated paragraphs")
+    parser.add_option('-s', '--seconds', dest='seconds', type='int', default=3*3600,
+                      help="Duration of audio streamed in the audio_soak benchmarks")
+    parser.add_option('-r', '--report-interval', dest='report_interval', type='int',
+                      default=60, help="Seconds between audio_soak reports")
+    parser.add_option('', '--buffer-pool-size', dest='audio_buffer_pool_size',
+                      type='int', default=16, help="Audio buffers kept for reuse")
+    (options, args) = parser.parse_args()
+
+    # The soak tests take hours, run them only when asked for
+    for name in args or sorted([name for name in benchmarks.keys()
+                                if not name.startswith('audio_soak')]):
+        if not benchmarks.has_key(name):
+            print "Unknown benchmark " + name
+            return 1
+        benchmarks[name](options)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
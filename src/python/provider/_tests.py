@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2008 Brailcom, o.p.s.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+"""Tests of the provider internals using unittest module. They don't
+need a running provider, run them with src/python in PYTHONPATH
+
+    python -m provider._tests"""
+
+import unittest
+import threading
+import time
+
+import event
+
+class _Request(object):
+    def __init__(self, type, producer=None, n=None, message_id=None):
+        self.type = type
+        self.producer = producer
+        self.n = n
+        self.message_id = message_id
+
+class EventPotTest(unittest.TestCase):
+
+    # Seconds a consumer waits for an event before declaring it lost
+    TIMEOUT = 5
+
+    def _pop_all(self, pot, count):
+        """Pop count events, fail if one of them doesn't come in time"""
+        events = []
+        for i in range(count):
+            popped = pot.pop(timeout=self.TIMEOUT)
+            self.assert_(popped != None,
+                         "Wakeup lost after %d of %d events" % (i, count))
+            events.append(popped)
+        return events
+
+    def test_pushes_in_a_row(self):
+        """Events pushed before the consumer wakes up are all popped"""
+        pot = event.EventPot()
+        for i in range(3):
+            pot.push(_Request('say_text', n=i))
+        self.assertEqual([e.n for e in self._pop_all(pot, 3)], [0, 1, 2])
+        self.assertEqual(pot.pop(timeout=0.01), None)
+
+    def test_stress(self):
+        """Many producers and one consumer, every event arrives once and
+        in order for each producer"""
+        producers = 8
+        per_producer = 20000
+        pot = event.EventPot()
+        def produce(producer):
+            for i in range(per_producer):
+                pot.push(_Request('say_text', producer, i))
+        threads = [threading.Thread(target=produce, args=(p,))
+                   for p in range(producers)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        events = self._pop_all(pot, producers * per_producer)
+        seconds = time.time() - start
+        for thread in threads:
+            thread.join()
+        last = {}
+        for e in events:
+            self.assert_(e.n == last.get(e.producer, -1) + 1)
+            last[e.producer] = e.n
+        self.assertEqual(len(pot), 0)
+        print "\n%d events from %d producers in %.3f s (%.0f events/s)" % \
+            (len(events), producers, seconds, len(events) / seconds)
+
+    def test_ping_pong(self):
+        """The consumer sleeps between events, each push must wake it"""
+        pot = event.EventPot()
+        replies = event.EventPot()
+        count = 2000
+        def consume():
+            for i in range(count):
+                replies.push(pot.pop(timeout=self.TIMEOUT))
+        consumer = threading.Thread(target=consume)
+        consumer.start()
+        start = time.time()
+        for i in range(count):
+            pot.push(_Request('say_char', n=i))
+            reply = replies.pop(timeout=self.TIMEOUT)
+            self.assert_(reply != None and reply.n == i, "Wakeup lost")
+        seconds = time.time() - start
+        consumer.join()
+        print "\n%d round trips in %.3f s (%.0f/s)" % (count, seconds,
+                                                      count / seconds)
+
+    def test_priorities_and_superseding(self):
+        """A discard overtakes and drops the waiting synthesis of its
+        message, the requests of all other messages are popped so that
+        their clients receive their events"""
+        priorities = {'discard': 0}
+        def priority(request):
+            return priorities.get(request.type, 1)
+        def supersedes(new, queued):
+            return new.type == 'discard' and queued.type != 'discard' \
+                and queued.message_id == new.message_id
+        pot = event.EventPot(priority=priority, supersedes=supersedes)
+        # Characters typed by two clients, message ids 1 to 6
+        for n in range(1, 7):
+            pot.push(_Request('say_char', n=n, message_id=n))
+        pot.push(_Request('discard', n=0, message_id=4))
+        popped = [e.n for e in self._pop_all(pot, 6)]
+        self.assertEqual(popped, [0, 1, 2, 3, 5, 6])
+        self.assertEqual(pot.pop(timeout=0.01), None)
+        self.assertEqual(pot.statistics()['dropped'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -27,19 +27,22 @@ Audio server runs in two threads:
     2) The secondary thread accepts events and takes care of playback and
         output events emission"""
 
+import os
 import threading
 import thread
 import socket
 import select
-import datetime
 import time
+import collections
 import sleep
+import clock
 
 #Import OpenAL Python bindings
 import pyopenal
 
 import event
 import ttsapi
+import ttsapi.retrieval
 
 from ttsapi.connection import *
 from ttsapi.structures import AudioEvent
@@ -47,6 +50,13 @@ from user_configuration import UserConfiguration
 
 messages_in_sources_sleeper = sleep.Sleeper()
 
+# Maximal amount of data read from an audio client socket at once
+RECEIVE_SIZE = 65536
+
+# Path of a Unix domain socket for audio retrieval in addition to the
+# TCP port or None, to be set before init()
+socket_path = None
+
 events_thread = None
 playback_thread = None
 connection_handling_thread = None
@@ -56,7 +66,7 @@ class MessageNotInPlayback(Exception):
 
 class PlaybackInfo(object):
     """Information about playback of a track"""
-    # datetime object
+    # Times are in seconds as returned by clock.monotonic()
 
     # Time when audio was started or None if not yet started playback
     started = None
@@ -64,39 +74,193 @@ class PlaybackInfo(object):
     # Time when audio was stopped or None if not stopped
     # stopped = None
 
-    # If the track was rewinded, the rewinded time is saved here
-    rewinded = datetime.timedelta()
+    # If the track was rewinded or paused (because it ran out of data),
+    # the time played before is saved here
+    rewinded = 0.0
+
+    # Duration of all audio data queued for the track so far
+    queued = 0.0
+
+    # Position in miliseconds added to the positions of received events.
+    # A message sent to the driver in chunks starts again with each
+    # chunk, its audio follows the audio of the previous chunks.
+    events_offset = 0.0
 
     # Audio source
     source = None
 
+    def position(self, now):
+        """Return the playback position in seconds at time now.
+
+        Wall time since the start can only be trusted as long as the
+        source has data to play, so the position is never beyond the
+        end of the audio queued so far."""
+        played = self.rewinded
+        if self.started != None:
+            played += now - self.started
+        return min(played, self.queued)
+
 # Dictionary of message_id:PlaybackInfo() entries
 messages_in_playback = {}
 messages_in_playback_lock = thread.allocate_lock()
 
-# List of events to dispatche
+# Ids of the messages in messages_in_playback which ended, their tracks
+# are released when their sources stop, see Audio.release().
+# Guarded by messages_in_playback_lock.
+ended_messages = set()
+
+# Dictionary of message_id:event.EventSchedule() of events to dispatch,
+# only messages with undispatched events are kept
 event_list = {}
 event_list_lock = thread.allocate_lock()
 
+# Seconds between checks whether the sources of ended messages stopped
+RELEASE_CHECK_INTERVAL = 0.1
+
+# Measured errors of event dispatch: number of events, sum of the errors
+# and the largest error, all errors in miliseconds
+dispatch_errors = {'count': 0, 'total': 0.0, 'max': 0.0}
+
+# Measured latencies of stop_now() from the call until the sources were
+# silent: number of calls, sum of the latencies and the largest one,
+# all in miliseconds
+stop_latencies = {'count': 0, 'total': 0.0, 'max': 0.0}
+stop_latencies_lock = thread.allocate_lock()
+
+# Dictionary of message_id:(cache.Recording(), play) of messages whose
+# audio and events are recorded for the audio cache, play is False
+# for messages which are only recorded
+recordings = {}
+recordings_lock = thread.allocate_lock()
+
 # --- AUDIO FUNCTIONALITY ---
 
+class BufferPool(object):
+    """OpenAL buffers of the source of one track.
+
+    Buffers are unqueued from the source once they are played and
+    reused for new data instead of generating a new buffer for each
+    block. At most max_free unused buffers are kept, the others are
+    deleted."""
+
+    # Buffers are only unqueued when playback position is this many
+    # seconds past their end, to allow for the latency of the device
+    RECYCLE_MARGIN = 0.5
+
+    def __init__(self, source, max_free):
+        self.source = source
+        self.max_free = max_free
+        self._lock = thread.allocate_lock()
+        # Queued buffers in order with the playback position (in seconds)
+        # at which each of them ends
+        self._queued = collections.deque()
+        self._end = 0.0
+        self._free = []
+        self.generated = 0
+        self.reused = 0
+        self.deleted = 0
+
+    def get(self):
+        """Return a buffer for new data"""
+        self._lock.acquire()
+        try:
+            if len(self._free) > 0:
+                self.reused += 1
+                return self._free.pop()
+            self.generated += 1
+        finally:
+            self._lock.release()
+        return pyopenal.alGenBuffers(1)
+
+    def queue(self, buffer, duration):
+        """Queue buffer with audio of the given duration (seconds)"""
+        self._lock.acquire()
+        try:
+            self.source.queue_buffers(buffer)
+            self._end += duration
+            self._queued.append((self._end, buffer))
+        finally:
+            self._lock.release()
+
+    def recycle(self, position=None):
+        """Unqueue buffers played before position (in seconds). If position
+        is None, the source must be stopped and all buffers are unqueued."""
+        self._lock.acquire()
+        try:
+            if position == None:
+                count = len(self._queued)
+            else:
+                count = 0
+                for end, buffer in self._queued:
+                    if end + self.RECYCLE_MARGIN > position:
+                        break
+                    count += 1
+            if count == 0:
+                return
+            self.source.unqueue_buffers(count)
+            for i in range(count):
+                end, buffer = self._queued.popleft()
+                if len(self._free) < self.max_free:
+                    self._free.append(buffer)
+                else:
+                    self._delete(buffer)
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """Delete all buffers, the source must be stopped"""
+        self.recycle()
+        self._lock.acquire()
+        try:
+            for buffer in self._free:
+                self._delete(buffer)
+            self._free = []
+        finally:
+            self._lock.release()
+
+    def _delete(self, buffer):
+        # Older pyopenal versions can't delete buffers, they are at least
+        # not referenced any more then
+        if hasattr(pyopenal, 'alDeleteBuffers'):
+            pyopenal.alDeleteBuffers(buffer)
+        self.deleted += 1
+
+    def statistics(self):
+        """Return a dictionary with the number of buffers 'queued' and
+        'free' and the numbers of buffers 'generated', 'reused' and
+        'deleted' so far"""
+        self._lock.acquire()
+        try:
+            return {'queued': len(self._queued), 'free': len(self._free),
+                    'generated': self.generated, 'reused': self.reused,
+                    'deleted': self.deleted}
+        finally:
+            self._lock.release()
+
 class CtrlRequest(event.Event):
     _attributes = {
         'type': ("Type of the event",
-            ("accept", "play", "stop", "discard", "quit")),
+            ("accept", "play", "stop", "discard", "release", "replay", "quit")),
         'message_id': ("ID of the message",
-                       ("accept", "play", "stop", "discard"))
+                       ("accept", "play", "stop", "discard", "release", "replay")),
+        'recording': ("Cached audio and events to play (cache.Recording)",
+                      ("replay",))
     }
 
 class Audio(object):
     """Audio output through Pyopenal"""
     awaiting_message_data = []
     sources = {} # dictionary message_id:source
+    buffer_pools = {} # dictionary message_id:BufferPool
     
     def __init__(self):
         """Initialize audio"""
         pyopenal.init()
         self.listener = pyopenal.Listener(44100)
+        # Serializes the work on tracks between the playback thread, the
+        # connections thread and clients stopping playback directly.
+        # Acquire it before messages_in_playback_lock.
+        self._lock = threading.RLock()
 
     def close (self):
         """Clean up, close devices etc."""
@@ -109,15 +273,20 @@ class Audio(object):
         the audio server to wait for incomming data."""
         global messages_in_sources_sleeper
         
-        if message_id in self.awaiting_message_data:
-            raise "Message already in accept list"
-
-        log.debug("Adding message" +str(message_id)+"into awaiting_message_data :"
-                  +str(self.awaiting_message_data))
-        self.awaiting_message_data.append(message_id)
-        
-        source = pyopenal.Source()
-        self.sources[message_id] = source
+        self._lock.acquire()
+        try:
+            if message_id in self.awaiting_message_data:
+                raise "Message already in accept list"
+
+            log.debug("Adding message" +str(message_id)+"into awaiting_message_data :"
+                      +str(self.awaiting_message_data))
+            source = pyopenal.Source()
+            self.sources[message_id] = source
+            self.buffer_pools[message_id] = BufferPool(source,
+                                                       conf.audio_buffer_pool_size)
+            self.awaiting_message_data.append(message_id)
+        finally:
+            self._lock.release()
         log.debug("Message " + str(message_id)  +" accepted for playback")
         messages_in_sources_sleeper.interrupt()        
 
@@ -125,21 +294,31 @@ class Audio(object):
         """Start playback of the given message_id. Do nothing if it is
         already being played."""
 
+        self._lock.acquire()
         messages_in_playback_lock.acquire()
         try:
-            if messages_in_playback.has_key(message_id):
-                pass
-
+            if not self.sources.has_key(message_id):
+                log.debug("Not playing message " + str(message_id) + ", discarded")
+                return
             # Start playback
             source = self.sources[message_id]
             source.play()
+            now = clock.monotonic()
 
             # Save playback info
-            messages_in_playback[message_id] = PlaybackInfo()
-            messages_in_playback[message_id].source = source
-            messages_in_playback[message_id].started = datetime.datetime.now()
+            if messages_in_playback.has_key(message_id):
+                # Playback continues after the source ran out of data,
+                # keep the time played so far
+                info = messages_in_playback[message_id]
+                info.rewinded = info.position(now)
+            else:
+                info = PlaybackInfo()
+                info.source = source
+                messages_in_playback[message_id] = info
+            info.started = now
         finally:
             messages_in_playback_lock.release()
+            self._lock.release()
 
         # Interrupt events thread sleep so that it can recalculate
         # position of pending events for this message
@@ -148,45 +327,79 @@ class Audio(object):
     
     def stop(self, message_id):
         """Stop playback of track assigned to given message_id
-        and discard it (seee Audio.discard())"""
+        and discard it (seee Audio.discard()). Raises
+        MessageNotInPlayback if it is not playing, its recording
+        is stopped in any case."""
 
-        messages_in_playback_lock.acquire()
+        self._lock.acquire()
         try:
-
-            if not messages_in_playback.has_key(message_id):
+            messages_in_playback_lock.acquire()
+            try:
+                playing = messages_in_playback.has_key(message_id)
+            finally:
+                messages_in_playback_lock.release()
+            if not playing:
+                # A stopped message would never complete its recording
+                _stop_recording(message_id)
                 raise MessageNotInPlayback
-
-            # Stop playback
-            source = self.sources[message_id]
-            source.stop()
-        
-            # Remove playback info
-            del messages_in_playback[message_id]
-
-            # Discard this track
             self.discard(message_id)
         finally:
-            messages_in_playback_lock.release()
-
+            self._lock.release()
 
     def discard(self, message_id):
-        """Discard track assigned to message_id"""
+        """Discard track assigned to message_id: stop it if it is
+        playing, unqueue its audio, drop its pending events and reject
+        data arriving for it later. Can be called from any thread,
+        the source is silent when it returns."""
 
-        messages_in_playback_lock.acquire()
+        self._lock.acquire()
         try:
+            # Stop the source first, everything else is clean-up
+            source = self.sources.pop(message_id, None)
+            if source != None:
+                source.stop()
+            messages_in_playback_lock.acquire()
+            try:
+                if messages_in_playback.has_key(message_id):
+                    del messages_in_playback[message_id]
+                ended_messages.discard(message_id)
+            finally:
+                messages_in_playback_lock.release()
 
-            # If still playing, stop
-            if messages_in_playback.has_key(message_id):
-                self.stop(message_id)
-    
-            # Remove playback info, not awaiting data any more, remove source,
-            # clean-up
             if message_id in self.awaiting_message_data:
                 self.awaiting_message_data.remove(message_id)
-            if message_id in self.sources:
-                del self.sources[message_id]
+            if message_id in self.buffer_pools:
+                self.buffer_pools.pop(message_id).close()
         finally:
-            messages_in_playback_lock.release()
+            self._lock.release()
+
+        event_list_lock.acquire()
+        try:
+            if event_list.has_key(message_id):
+                del event_list[message_id]
+        finally:
+            event_list_lock.release()
+        # An incomplete recording would never be finished
+        _stop_recording(message_id)
+
+    def release(self, message_id, event_sleeper):
+        """Release the track of message_id after the message ended. It is
+        discarded (see Audio.discard()) at once if it has nothing to play,
+        otherwise by the events thread when its source stops."""
+        self._lock.acquire()
+        try:
+            messages_in_playback_lock.acquire()
+            try:
+                info = messages_in_playback.get(message_id)
+                if info != None:
+                    ended_messages.add(message_id)
+            finally:
+                messages_in_playback_lock.release()
+            if info == None:
+                self.discard(message_id)
+        finally:
+            self._lock.release()
+        event_sleeper.interrupt()
 
     def set_volume(self, message_id, volume):
         """Set audio volume. Volume is a floating point number.
@@ -212,42 +425,68 @@ class Audio(object):
         Currently only handles raw PCM."""
         
         log.debug("Adding data with length " + str(len(data)))
-        if message_id not in self.awaiting_message_data:
-            log.debug("Data for " + str(message_id) + " rejected. " \
-                          "Message not in awaiting_message_data list")
-            return
-
-        if channels == 1:
-            format = pyopenal.AL_FORMAT_MONO16
-        elif channels == 2:
-            format = pyopenal.AL_FORMAT_STEREO16
-        else:
-            raise "Unsupported number of channels " + str(channels)
-
-        # Generate a new buffer and fill it with the data
-        buffer = pyopenal.alGenBuffers(1)
-        pyopenal.alBufferData(buffer, format, data, sample_rate)
+        self._lock.acquire()
+        try:
+            if message_id not in self.awaiting_message_data:
+                log.debug("Data for " + str(message_id) + " rejected. " \
+                              "Message not in awaiting_message_data list")
+                return
+
+            if channels == 1:
+                format = pyopenal.AL_FORMAT_MONO16
+            elif channels == 2:
+                format = pyopenal.AL_FORMAT_STEREO16
+            else:
+                raise "Unsupported number of channels " + str(channels)
 
-        # Queue the buffer for the message_id track source
-        source = self.sources[message_id]
-        source.queue_buffers(buffer)
-        log.debug("Data added for message " + str(message_id) )
-
-        # If state is not AL_PLAYING (playback ran out of data), we must first
-        # unqueue old buffers or otherwise playback would start from the
-        # beginning again.
-        # WARNING: This might be a problem for rewinding if done on audio level.
-        state = source.get_state()
-        if state != pyopenal.AL_PLAYING:
-            log.debug("Unqueueing audio data")
-            # TODO: Unfortunatelly this is not supported in pyopenal, I've contacted
-            # the author. It will hopefully be fixed later.
-            #n = pyopenal.alGetSourcei(source, pyopenal.AL_BUFFERS_PROCESSED)
-            # WARNING: ...so we just use a number that looks big enough, relying on
-            # the fact that only already processed buffers are unqueued with the
-            # Source.unqueue_buffers method
-            source.unqueue_buffers(256)
-            self.play(message_id, event_sleeper)
+            source = self.sources[message_id]
+            pool = self.buffer_pools[message_id]
+            duration = len(data) / float(2 * channels * sample_rate)
+
+            # Return buffers which were already played to the pool. If state is
+            # not AL_PLAYING (playback ran out of data), all queued buffers
+            # were played and they must be unqueued anyway, otherwise playback
+            # would start from the beginning again.
+            state = source.get_state()
+            if state != pyopenal.AL_PLAYING:
+                pool.recycle()
+            else:
+                messages_in_playback_lock.acquire()
+                try:
+                    info = messages_in_playback.get(message_id)
+                    if info != None:
+                        position = info.position(clock.monotonic())
+                    else:
+                        position = 0.0
+                finally:
+                    messages_in_playback_lock.release()
+                pool.recycle(position)
+
+            # Fill a buffer with the data and queue it for the message_id
+            # track source
+            buffer = pool.get()
+            pyopenal.alBufferData(buffer, format, data, sample_rate)
+            pool.queue(buffer, duration)
+            log.debug("Data added for message " + str(message_id) )
+
+            if state != pyopenal.AL_PLAYING:
+                self.play(message_id, event_sleeper)
+
+            # Account the new data for playback position tracking (16 bit samples)
+            messages_in_playback_lock.acquire()
+            try:
+                info = messages_in_playback.get(message_id)
+                if info != None:
+                    # If the position was held at the end of the queued data,
+                    # the events thread must recalculate its sleep
+                    held = info.position(clock.monotonic()) >= info.queued
+                    info.queued += duration
+                    if held:
+                        event_sleeper.interrupt()
+            finally:
+                messages_in_playback_lock.release()
+        finally:
+            self._lock.release()
 
 # --- AUDIO SERVER IMPLEMENTATION ---
 
@@ -306,142 +545,145 @@ def quit():
     playback_thread.join()
 
     log.info("Terminating connections thread");
-    connection_handling_thread.server_socket.shutdown(socket.SHUT_RDWR)
-    connection_handling_thread.server_socket.close()
+    for server_socket in connection_handling_thread.server_sockets:
+        server_socket.shutdown(socket.SHUT_RDWR)
+        server_socket.close()
     connection_handling_thread.join()
+    if socket_path != None:
+        os.remove(socket_path)
 
     log.info("Audio lateral threads terminated");
+    log.info("Event dispatch errors: " + str(dispatch_statistics()))
+    log.info("Stop latencies: " + str(stop_statistics()))
     
-def receive_data(socket, event_sleeper):
-    """Receive a block of data as defined in TTS API
-    over socket"""
-
-    expecting_data = False
+def _recording(message_id):
+    """Return the Recording of message_id or None and whether
+    the message should be played"""
+    recordings_lock.acquire()
+    try:
+        return recordings.get(message_id, (None, True))
+    finally:
+        recordings_lock.release()
+
+def record(message_id, recording, play=True):
+    """Record audio and events received for message_id into
+    recording (cache.Recording) until the message ends. If play
+    is False, the message is only recorded and it needs not be
+    accepted."""
+    recordings_lock.acquire()
+    try:
+        recordings[message_id] = (recording, play)
+    finally:
+        recordings_lock.release()
+
+def stop_recording(message_id):
+    """Stop recording message_id, e.g. when it doesn't arrive"""
+    _stop_recording(message_id)
+
+def _stop_recording(message_id):
+    recordings_lock.acquire()
+    try:
+        if recordings.has_key(message_id):
+            del recordings[message_id]
+    finally:
+        recordings_lock.release()
+
+def replay(message_id, recording, event_sleeper):
+    """Play a cache.Recording as the accepted message_id"""
+    log.debug("Replaying cached audio for message " + str(message_id))
+    retrieved_events(message_id, recording.replay_events(message_id),
+                     event_sleeper)
+    for data, parameters in recording.blocks:
+        retrieved_data(message_id, data, parameters, event_sleeper)
+
+def retrieved_events(message_id, events, event_sleeper):
+    """Schedule events received for message_id on the audio socket"""
+    recording, play = _recording(message_id)
+    if recording != None:
+        recording.add_events(events)
+        if recording.complete:
+            _stop_recording(message_id)
+    if not play:
+        return
+    if message_id not in audio.sources:
+        log.debug("Events for " + str(message_id) + " rejected, message discarded")
+        return
+    messages_in_playback_lock.acquire()
+    try:
+        info = messages_in_playback.get(message_id)
+        offset = 0.0
+        if info != None:
+            for retrieved in events:
+                if retrieved.type == 'message_start':
+                    # All audio received so far belongs to previous chunks
+                    info.events_offset = 1000 * info.queued
+            offset = info.events_offset
+    finally:
+        messages_in_playback_lock.release()
 
-    header = socket.receive_line()
+    event_list_lock.acquire()
+    try:
+        if not event_list.has_key(message_id):
+            event_list[message_id] = event.EventSchedule()
+        for retrieved in events:
+            log.debug("Event received: " + retrieved.type)
+            if retrieved.pos_audio != None:
+                retrieved.pos_audio += offset
+            event_list[message_id].add(retrieved)
+    finally:
+        event_list_lock.release()
+    if len(events) > 0:
+        # Interrupt event sleeper and give it a chance
+        # to recalculate when the next callback should be
+        # sent
+        log.debug("Interrupting event sleeper")
+        event_sleeper.interrupt()
 
-    # HEADER
-    if len(header) != 3:
-        raise "Bad syntax on audio socket"
-    head = header[0]
-    msg_id = int(header[1])
-    block_number = int(header[2])
-    
-    if head != "BLOCK":
-        raise "Bad syntax on audio socket (BLOCK expected)"
-    
-    log.timestamp("Receiving audio block number " + str(block_number)
-    + " for message id " + str(msg_id))
-
-    # PARAMETERS SECTION
-    param_header = socket.receive_line()
-
-    if param_header != ['PARAMETERS']:
-        log.debug("Ommited PARAMETERS section on audio socket")
-        event_header = param_header
-    else:
-        data_length = None
-        while True:
-            parameter_line = socket.receive_line()
-            log.debug("Parameter line: " + str(parameter_line));
-            if parameter_line == ['END', 'OF', 'PARAMETERS']:
-                break
-            if parameter_line[0] == 'data_length':
-                data_length = int(parameter_line[1])
-                log.debug("Setting data length to " + str(data_length))
-            if parameter_line[0] == 'sample_rate':
-                sample_rate = int(parameter_line[1])
-                log.debug("Setting sample rate to " + str(sample_rate))
-        expecting_data = True
-        if data_length == None:
-            raise "Unspecified data length"
-
-        event_header = socket.receive_line()
-
-    # EVENTS SECTION
-    event_lines = []
+def retrieved_data(message_id, data, parameters, event_sleeper):
+    """Pass a piece of audio received for message_id to audio output"""
+    log.timestamp("Received " + str(len(data)) + " bytes of audio data "
+                  + "for message id " + str(message_id))
+    recording, play = _recording(message_id)
+    if recording != None:
+        recording.add_data(data, parameters)
+    if not play:
+        return
+    audio.add_data(message_id, data, "raw", parameters.get('sample_rate'),
+                   parameters.get('channels', 1), "S16_LE", event_sleeper)
 
-    event_list_lock.acquire()
-    if not event_list.has_key(msg_id):
-        event_list[msg_id] = []
-    if event_header == ['EVENTS']:
-        while True:
-            event_line = socket.receive_line()
-            if event_line == ['END', 'OF', 'EVENTS']:
-                break
-            event_lines.append(event_line)
-
-        for entry in event_lines:
-            log.debug("Event line being processed:" + str(entry))
-            if entry[0] in ('message_start', 'message_end'):
-                event_list[msg_id].append(AudioEvent(type=entry[0],
-                                                     pos_text=int(entry[2]),
-                                                     pos_audio=int(entry[3]),
-                                                     message_id=msg_id))
-                log.debug("event appended to list")
-            elif entry[0] in ('word_start', 'word_end', 'sentence_start',
-                              'sentence_end'):
-                event_list[msg_id].append(AudioEvent(type=entry[0],
-                                                     n = int(entry[1]),
-                                                     pos_text = int(entry[2]),
-                                                     pos_audio = int(entry[3]),
-                                                     message_id=msg_id))
-            elif entry[0] == 'index_mark':
-                event_list[msg_id].append(AudioEvent(type=entry[0],
-                                                     name = entry[1],
-                                                     pos_text = int(entry[2]),
-                                                     pos_audio = int(entry[3]),
-                                                     message_id=msg_id))
-        if len(event_lines) > 0:
-            # Interrupt event sleeper and give it a chance
-            # to recalculate when the next callback should be
-            # sent
-            log.debug("Interrupting event sleeper")
-            event_sleeper.interrupt()
-
-        if expecting_data:
-            data_header = socket.receive_line()
-    else:
-        data_header = event_header
-    event_list_lock.release()
-
-    # DATA SECTION
-    if expecting_data:
-        if data_header != ['DATA']:
-            log.debug("Missing DATA section")
-            raise "Missing DATA section"
-        else:
-            if (data_length != 0):
-                log.debug("Reading data of length " + str(data_length))
-                audio_data = socket.read_data(data_length)
-                assert len(audio_data) == data_length
-            else:
-                audio_data = ""
-            data_footer = socket.receive_line()
-            log.debug("Data footer: " + str(data_footer))
-            if data_footer != ['END', 'OF', 'DATA']:
-                raise "Missing END OF DATA"
-    
-        # Block of data read, add data to audio
-        log.debug("OK data received, sending to audio")
-        log.timestamp("TIME: Received block of audio data: ") 
-        audio.add_data(msg_id, audio_data, "raw", sample_rate, 1, "S16_LE", event_sleeper)
-    
 def connection_handling(event_sleeper):
     """Handle incomming connections and read data into buffers
-    in a separate thread."""
+    in a separate thread.
+
+    Input from all drivers is read as it arrives and fed into
+    a ttsapi.retrieval.RetrievalParser for each of them, so that
+    a slow driver doesn't hold back the others and audio is passed
+    to playback before whole blocks are received."""
     
     log.info("Starting audio server")
 
-    # Create server socket
+    # Create server sockets
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server_socket.bind(("", conf.audio_port))
     server_socket.listen(conf.max_simultaneous_connections)
+    server_sockets = [server_socket]
+    if socket_path != None:
+        log.info("Listening for audio on Unix socket " + socket_path)
+        server_sockets.append(ttsapi.connection.unix_server_socket(
+            socket_path, conf.max_simultaneous_connections))
 
     threading.currentThread().server_socket = server_socket
+    threading.currentThread().server_sockets = server_sockets
+
+    def on_events(message_id, events):
+        retrieved_events(message_id, events, event_sleeper)
+    def on_data(message_id, data, parameters):
+        retrieved_data(message_id, data, parameters, event_sleeper)
 
-    client_list = [server_socket,]
+    # Dictionary of client socket:RetrievalParser
+    parsers = {}
+    client_list = list(server_sockets)
     log.info("Waiting for audio connections, master socket= " +  str(server_socket))
     while True:
         log.debug("Waiting for activity")
@@ -450,34 +692,55 @@ def connection_handling(event_sleeper):
                  + str(in_error))
         for sock in in_error:
             try:
-                if sock.fileno() == server_socket.fileno():
+                if sock in server_sockets:
                     log.error("Master server audio socket closed, exiting.")
                     sys.exit(0)
                 else:
                     log.info("Audio client on socket " + str(sock.fileno()) + " in error.")
-                    client_list.remove(sock)        
+                    client_list.remove(sock)
+                    del parsers[sock]
             except socket.error:
                     log.error("Master server audio socket closed, exiting (socket err).")
                     sys.exit(0)
 
         for sock in ready_to_read:
+            if sock not in client_list:
+                # Removed above
+                continue
             try:
                 test = sock.fileno()
             except socket.error:
                 log.error("Master server audio socket closed, exiting.")
                 sys.exit(0)
-            if sock.fileno() == server_socket.fileno():
-                (client_socket, address) = server_socket.accept()
+            if sock in server_sockets:
+                (client_socket, address) = sock.accept()
                 log.info("Adding new audio client on socket " + str(client_socket.fileno()))
-                client_list.append(SocketConnection(socket=client_socket,
-                                                    logger=log, side='server'))
-            else:
-                try:
-                    log.info("Receiving data from socket " + str(sock.fileno()))
-                    receive_data(sock, event_sleeper)
-                except IOError:
-                    log.info("Audio client on socket " + str(sock.fileno()) + " gone.")
-                    client_list.remove(sock)
+                client_list.append(client_socket)
+                def on_framing(client_socket=client_socket):
+                    log.info("Binary framing on audio socket "
+                             + str(client_socket.fileno()))
+                    client_socket.sendall(ttsapi.retrieval.FRAMING_REPLY)
+                parsers[client_socket] = ttsapi.retrieval.RetrievalParser(
+                    on_events, on_data, on_framing=on_framing)
+                continue
+            try:
+                data = sock.recv(RECEIVE_SIZE)
+            except socket.error:
+                data = ""
+            if len(data) == 0:
+                log.info("Audio client on socket " + str(sock.fileno()) + " gone.")
+                client_list.remove(sock)
+                del parsers[sock]
+                sock.close()
+                continue
+            try:
+                parsers[sock].feed(data)
+            except ttsapi.retrieval.ProtocolError, error:
+                log.error("Audio client on socket " + str(sock.fileno()) +
+                          " sent invalid data, closing it: " + str(error))
+                client_list.remove(sock)
+                del parsers[sock]
+                sock.close()
 
 def playback():
     """Listen for events and play tracks in a separate thread."""
@@ -493,12 +756,18 @@ def playback():
         if ev.type == 'accept':
             audio.accept(ev.message_id)
         elif ev.type == 'play':
-            audio.play(ev.message_id)
-            pass
+            audio.play(ev.message_id, events_thread.event_sleeper)
         elif ev.type == 'stop':
-            audio.stop(ev.message_id)
+            try:
+                audio.stop(ev.message_id)
+            except MessageNotInPlayback:
+                log.debug("Message " + str(ev.message_id) + " not playing")
         elif ev.type == 'discard':
             audio.discard(ev.message_id)
+        elif ev.type == 'release':
+            audio.release(ev.message_id, events_thread.event_sleeper)
+        elif ev.type == 'replay':
+            replay(ev.message_id, ev.recording, events_thread.event_sleeper)
         elif ev.type == 'quit':
             log.debug("Termination in playback thread")
             # Close audio etc.
@@ -508,72 +777,116 @@ def playback():
         else:
             raise "Unknown event"
 
+def _account_dispatch_error(error):
+    dispatch_errors['count'] += 1
+    dispatch_errors['total'] += error
+    if error > dispatch_errors['max']:
+        dispatch_errors['max'] = error
+
+def dispatch_statistics():
+    """Return a dictionary with the number of dispatched events ('count'),
+    the average and the largest difference between the playback position
+    at dispatch and the position of the event ('average', 'max') in
+    miliseconds. The difference is never negative, events are not
+    dispatched before their position."""
+    event_list_lock.acquire()
+    try:
+        count = dispatch_errors['count']
+        if count > 0:
+            average = dispatch_errors['total'] / count
+        else:
+            average = 0.0
+        return {'count': count, 'average': average,
+                'max': dispatch_errors['max']}
+    finally:
+        event_list_lock.release()
+
 def events(sleeper):
     """Keep track of actual playing time of all messages, messages currently in
-    playback and calculate positions of events. When a message event gets
-    negative position in time, dispatch the appropriate notice event."""
+    playback and calculate positions of events. When playback reaches the
+    position of a message event, dispatch the appropriate notice event.
 
-    # message_event.clear()
+    Undispatched events of each message are kept in an event.EventSchedule,
+    so each wakeup only deals with the events which are due. Between them,
+    the thread sleeps until the next event is due or until it is
+    interrupted because of new events or playback of a new message.
 
-    while True:
-        #log.debug("Loop in events")
-        now = datetime.datetime.now()
-        # NOTE: This is roughly a day in miliseconds
-        NOT_ASSIGNED = 86000000
-        min = NOT_ASSIGNED
+    Only messages with undispatched events and ended messages (see
+    Audio.release()) are visited. Ended messages are discarded here once
+    their source stops, so the work doesn't grow with the number of
+    messages played so far."""
 
+    while True:
         if threading.currentThread().termination_request:
             log.debug("Termination request in events thread");
             sys.exit(0);
-        
+
+        now = clock.monotonic()
+        # Time in seconds until the next event is due or None
+        next_due = None
+        # Ended messages whose source stopped
+        finished = []
+
         messages_in_playback_lock.acquire()
         event_list_lock.acquire()
-        for id, message in messages_in_playback.iteritems():
-            log.debug("Checking events for message id " + str(id))
-            state = message.source.get_state()
-            #TODO: Possible race with message.started
-            if message.started != None:
-                since_start = now-message.started
-            else:
-                continue
-
-            if state == pyopenal.AL_STOPPED:
-                if message.started != None:
-                    message.rewinded += since_start
-                    message.started = None
-                else:
+        try:
+            for id, schedule in event_list.items():
+                message = messages_in_playback.get(id)
+                if message == None:
+                    # Not playing yet
+                    continue
+                if message.started == None:
                     # If we detected stop in the previous cycle already,
                     # there is no need to check events again
                     continue
-                
-            playback_time = since_start + message.rewinded
-            for event in event_list[id]:
-                if not event.dispatched:
-                    dte = datetime.timedelta(milliseconds=event.pos_audio)-playback_time
-                    log.debug("For event " + event.type + " dte =" + str(dte))
-                    # Convert dte into microseconds
-                    ms = (dte.days*24*3600 + dte.seconds)*1000 + dte.microseconds/1000
-                    log.debug("For event " + event.type + " ms =" + str(ms))
-                    if ms < 0:
-                        audio_events.push(event)
-                        event.dispatched=True
-                    elif ms < min:
-                        min = ms
-        messages_in_playback_lock.release()
-        event_list_lock.release()
 
-        # Sleep as long as we can, but not less than 5 miliseconds.
-        if min > 5:
-            # The following sleep is interrupted each time new
-            # events are added to the event_list, so that
-            # the sleeping time can be recalculated
-            log.debug("Sleeping " + str(min) +" ms")
-            sleeper.sleep(min/1000.0)        
-        else:
-            log.debug("Sleeping 5ms")
-            sleeper.sleep(0.005)
-        
-        #TODO: Calculate callback timing errors, check the performance
+                if message.source.get_state() == pyopenal.AL_STOPPED:
+                    message.rewinded = message.position(now)
+                    message.started = None
+
+                # Playback position in miliseconds
+                position = 1000 * message.position(now)
+                for due_event in schedule.pop_due(position):
+                    due_event.dispatch_error = position - due_event.pos_audio
+                    _account_dispatch_error(due_event.dispatch_error)
+                    log.debug("Dispatching event " + due_event.type + " for message "
+                              + str(id) + " at " + str(position) + " ms, error "
+                              + str(due_event.dispatch_error) + " ms")
+                    due_event.dispatched = True
+                    audio_events.push(due_event)
+
+                if len(schedule) == 0:
+                    # retrieved_events() adds it again for new events
+                    del event_list[id]
+                    continue
+                next_position = schedule.next_position()
+                if next_position != None and message.started != None:
+                    wait = (next_position - position) / 1000.0
+                    if next_due == None or wait < next_due:
+                        next_due = wait
+
+            for id in ended_messages:
+                if event_list.has_key(id):
+                    continue
+                if messages_in_playback[id].source.get_state() == pyopenal.AL_STOPPED:
+                    finished.append(id)
+                elif next_due == None or RELEASE_CHECK_INTERVAL < next_due:
+                    next_due = RELEASE_CHECK_INTERVAL
+        finally:
+            event_list_lock.release()
+            messages_in_playback_lock.release()
+
+        # Audio._lock must not be acquired with the locks above held
+        for id in finished:
+            log.debug("Releasing ended message " + str(id))
+            audio.discard(id)
+
+        # The following sleep is interrupted each time new
+        # events are added to the event_list or a message starts
+        # playing, so that the sleeping time can be recalculated
+        if next_due != None:
+            log.debug("Sleeping " + str(next_due) + " s")
+        sleeper.sleep(next_due)
 
 def events_quit():
     global audio_events
@@ -590,3 +903,46 @@ def post_event(type, message_id, blocking=False):
         # Wait until the request is processed
         while message_id not in audio.sources:
             messages_in_sources_sleeper.sleep(2*60)
+
+def stop_now(message_ids):
+    """Stop and discard the given messages immediately from the calling
+    thread, without waiting for the requests queued for the playback
+    thread. The latency is accounted, see stop_statistics()."""
+    start = clock.monotonic()
+    for message_id in message_ids:
+        # Also stops the recording of the message
+        audio.discard(message_id)
+    latency = 1000 * (clock.monotonic() - start)
+    log.debug("Stopped " + str(len(message_ids)) + " messages in "
+              + str(latency) + " ms")
+    stop_latencies_lock.acquire()
+    try:
+        stop_latencies['count'] += 1
+        stop_latencies['total'] += latency
+        if latency > stop_latencies['max']:
+            stop_latencies['max'] = latency
+    finally:
+        stop_latencies_lock.release()
+
+def stop_statistics():
+    """Return a dictionary with the number of stop_now() calls ('count')
+    and the average and the largest time until silence ('average', 'max')
+    in miliseconds"""
+    stop_latencies_lock.acquire()
+    try:
+        count = stop_latencies['count']
+        if count > 0:
+            average = stop_latencies['total'] / count
+        else:
+            average = 0.0
+        return {'count': count, 'average': average,
+                'max': stop_latencies['max']}
+    finally:
+        stop_latencies_lock.release()
+
+def post_replay(message_id, recording):
+    """Ask the audio server to play recording (cache.Recording)
+    as the accepted message_id"""
+    log.debug("Posting replay " + str(message_id))
+    audio_ctrl_request.push(CtrlRequest(type='replay', message_id=message_id,
+                                        recording=recording))
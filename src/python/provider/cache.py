@@ -0,0 +1,182 @@
+#
+# cache.py - Cache of synthesized audio
+#
+# Copyright (C) 2008 Brailcom, o.p.s.
+#
+# This is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this package; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+
+"""Cache of audio synthesized by the drivers.
+
+Screen readers say the same short strings (menu items, keys, characters)
+over and over. When audio is retrieved from the driver (emulated
+playback), the audio server records the audio and events of such messages
+into a Recording and AudioCache keeps them, so that the next request
+with the same text and the same driver settings is played without
+asking the driver at all.
+
+The cache is shared by all clients and bounded by the size of the cached
+audio, the least recently used recordings are dropped first."""
+
+import collections
+import itertools
+import thread
+import threading
+from copy import copy
+
+# Size accounted for each cached event in bytes
+EVENT_SIZE = 128
+
+class Recording(object):
+    """Audio data and events of one message as received from the driver"""
+
+    def __init__(self, cache, key):
+        self._cache = cache
+        self._key = key
+        self.events = []
+        # List of (data, parameters) pairs
+        self.blocks = []
+        self.size = 0
+        self.complete = False
+        # Set when the recording is complete
+        self.finished = threading.Event()
+
+    def add_events(self, events):
+        """Record events as received, before they are scheduled.
+        The recording is complete with the message_end event."""
+        for event in events:
+            self.events.append(copy(event))
+            self.size += EVENT_SIZE
+            if event.type == 'message_end':
+                self._finish()
+
+    def add_data(self, data, parameters):
+        """Record a piece of audio data"""
+        if len(self.blocks) > 0 and self.blocks[-1][1] == parameters:
+            self.blocks[-1][0].append(data)
+        else:
+            self.blocks.append(([data], parameters))
+        self.size += len(data)
+
+    def _finish(self):
+        # Pieces with the same parameters are played as one block
+        self.blocks = [(''.join(pieces), parameters)
+                       for pieces, parameters in self.blocks]
+        self.complete = True
+        self._cache.store(self._key, self)
+        self.finished.set()
+
+    def replay_events(self, message_id):
+        """Return copies of the recorded events for message_id"""
+        events = []
+        for event in self.events:
+            event = copy(event)
+            event.message_id = message_id
+            events.append(event)
+        return events
+
+class AudioCache(object):
+    """Recordings of synthesized messages by their keys. The key
+    must contain everything which affects the audio: the driver,
+    its settings, the command and the text."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = thread.allocate_lock()
+        # Dictionary of key:(recording, stamp)
+        self._recordings = {}
+        # Keys in order of use as (stamp, key) pairs, entries with an
+        # old stamp are left in place and skipped when evicting
+        self._order = collections.deque()
+        self._stamps = itertools.count()
+        self.size = 0
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return the complete Recording for key or None"""
+        self._lock.acquire()
+        try:
+            if not self._recordings.has_key(key):
+                self.misses += 1
+                return None
+            self.hits += 1
+            recording, stamp = self._recordings[key]
+            self._touch(key, recording)
+            return recording
+        finally:
+            self._lock.release()
+
+    def contains(self, key):
+        """Return True if key is cached, without counting it
+        as a use of the recording"""
+        self._lock.acquire()
+        try:
+            return self._recordings.has_key(key)
+        finally:
+            self._lock.release()
+
+    def recording(self, key):
+        """Return a new Recording which stores itself
+        under key once it is complete"""
+        return Recording(self, key)
+
+    def store(self, key, recording):
+        """Store a complete recording, evicting the least
+        recently used ones to stay within max_bytes"""
+        if recording.size > self.max_bytes:
+            return
+        self._lock.acquire()
+        try:
+            if self._recordings.has_key(key):
+                self.size -= self._recordings[key][0].size
+            self.size += recording.size
+            self._touch(key, recording)
+            while self.size > self.max_bytes:
+                stamp, old_key = self._order.popleft()
+                if not self._recordings.has_key(old_key) \
+                        or self._recordings[old_key][1] != stamp:
+                    continue
+                old_recording = self._recordings[old_key][0]
+                del self._recordings[old_key]
+                self.size -= old_recording.size
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def _touch(self, key, recording):
+        """Mark key as the most recently used one"""
+        stamp = self._stamps.next()
+        self._recordings[key] = (recording, stamp)
+        self._order.append((stamp, key))
+        if len(self._order) > 2 * len(self._recordings) + 64:
+            # Drop the outdated entries
+            self._order = collections.deque(
+                [(stamp, key) for stamp, key in self._order
+                 if self._recordings.has_key(key)
+                 and self._recordings[key][1] == stamp])
+
+    def statistics(self):
+        """Return a dictionary with hits, misses, evictions, the number
+        of cached recordings and their size in bytes"""
+        self._lock.acquire()
+        try:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions,
+                    'recordings': len(self._recordings), 'bytes': self.size}
+        finally:
+            self._lock.release()
@@ -0,0 +1,247 @@
+#
+# chunking.py - Splitting of long messages for the drivers
+#
+# Copyright (C) 2008 Brailcom, o.p.s.
+#
+# This is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this package; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+
+"""Splitting of long messages into chunks at sentence boundaries.
+
+A driver only starts to produce audio once it has processed the text it
+was given, so for long messages Provider sends the text to the driver in
+several chunks, each as a separate say_text request with the same
+message id. The driver can start synthesizing the first sentences while
+the rest is still being split and sent.
+
+split() produces Chunk objects lazily. SSML elements open at a chunk
+boundary are closed at the end of the chunk and reopened at the start of
+the next one, so that each chunk is a well formed document. The driver
+reports events for each chunk as if it were a message of its own,
+ChunkedMessage translates them back to the events of the whole message."""
+
+import re
+
+# End of a sentence: punctuation followed by whitespace, or an empty line
+_SENTENCE_END = re.compile(r'[.!?]+["\')\]]*\s+|\n[ \t\r]*\n\s*')
+
+# SSML elements which must never be split
+_UNSPLITTABLE = ('say-as', 'sub', 'phoneme', 'audio')
+
+# SSML elements whose end is a sentence boundary
+_SENTENCE_ELEMENTS = ('s', 'p', 'sentence', 'paragraph')
+
+_TAG = re.compile(r'<(/?)([^\s/>]+)[^>]*?(/?)>')
+
+class Chunk(object):
+    """A piece of a message sent to the driver as one say_text request"""
+
+    def __init__(self, text, offset, prefix_length=0, source_length=None):
+        """Arguments:
+        text -- text to send to the driver
+        offset -- position of the first character of the chunk in the message
+        prefix_length -- number of characters of markup added before
+        the text of the message
+        source_length -- number of characters of the message in the chunk
+        """
+        self.text = text
+        self.offset = offset
+        self.prefix_length = prefix_length
+        if source_length == None:
+            source_length = len(text) - prefix_length
+        self.source_length = source_length
+
+    def wrap(self, start, end):
+        """Enclose the text in start and end markup"""
+        self.text = start + self.text + end
+        self.prefix_length += len(start)
+
+    def message_position(self, position):
+        """Translate a position in the text of the chunk to the
+        position in the message, positions in the added markup
+        are moved to the nearest character of the message"""
+        if position == None:
+            return None
+        position = min(max(position - self.prefix_length, 0), self.source_length)
+        return self.offset + position
+
+def _last_content(text, format):
+    """Return the position after the last character of text which is
+    not whitespace or markup. A message is never split after it."""
+    if format == 'ssml':
+        end = len(text)
+        while True:
+            end = len(text[:end].rstrip())
+            if end == 0 or text[end-1] != '>':
+                return end
+            tag_start = text.rfind('<', 0, end)
+            if tag_start == -1:
+                return end
+            end = tag_start
+    return len(text.rstrip())
+
+def split_plain(text, chunk_size):
+    """Yield Chunk objects of at least chunk_size characters (except
+    for the last one) ending at sentence boundaries"""
+    last_content = _last_content(text, 'plain')
+    start = 0
+    for match in _SENTENCE_END.finditer(text):
+        end = match.end()
+        if end - start >= chunk_size and end < last_content:
+            yield Chunk(text[start:end], start)
+            start = end
+    yield Chunk(text[start:], start)
+
+def split_ssml(text, chunk_size):
+    """Yield Chunk objects of at least chunk_size characters of the
+    message (except for the last one) ending at sentence boundaries,
+    each of them a well formed SSML document"""
+    last_content = _last_content(text, 'ssml')
+    # The XML declaration is repeated in each chunk
+    declaration = ''
+    # Start tags of the open elements as (name, tag) pairs
+    stack = []
+    # Markup reopening the elements open at the start of the current chunk
+    prefix = ''
+    start = 0
+    position = 0
+    while position < len(text):
+        if text.startswith('<!--', position):
+            comment_end = text.find('-->', position)
+            if comment_end == -1:
+                break
+            position = comment_end + 3
+            continue
+        tag = _TAG.search(text, position)
+        if tag == None:
+            content_end = len(text)
+        else:
+            content_end = tag.start()
+
+        # Sentence boundaries in the text before the next tag
+        boundaries = []
+        if not [name for name, start_tag in stack if name in _UNSPLITTABLE]:
+            boundaries = [match.end() for match
+                          in _SENTENCE_END.finditer(text, position, content_end)]
+        if tag != None and tag.group(1) == '/' and tag.group(2) in _SENTENCE_ELEMENTS:
+            boundaries.append(None)
+
+        for end in boundaries:
+            if end == None:
+                # After the closing tag, the element is closed in this chunk
+                end = tag.end()
+                closed_stack = _closed(stack, tag.group(2))
+            else:
+                closed_stack = stack
+            if end - start >= chunk_size and end < last_content:
+                suffix = ''.join(['</' + name + '>' for name, start_tag
+                                  in reversed(closed_stack)])
+                yield Chunk(prefix + text[start:end] + suffix, start,
+                            len(prefix), end - start)
+                prefix = declaration + ''.join([start_tag for name, start_tag
+                                                in closed_stack])
+                start = end
+
+        if tag == None:
+            break
+        closing, name, empty = tag.groups()
+        if name.startswith('?'):
+            if name == '?xml':
+                declaration = tag.group(0)
+        elif name.startswith('!'):
+            pass
+        elif closing:
+            stack = _closed(stack, name)
+        elif not empty:
+            stack = stack + [(name, tag.group(0))]
+        position = tag.end()
+    yield Chunk(prefix + text[start:], start, len(prefix), len(text) - start)
+
+def _closed(stack, name):
+    """Return the stack of open elements after the element name is closed"""
+    for i in range(len(stack) - 1, -1, -1):
+        if stack[i][0] == name:
+            return stack[:i]
+    return stack
+
+def split(text, format, chunk_size):
+    """Yield the chunks of a message of the given format ('plain'
+    or 'ssml') of at least chunk_size characters each"""
+    if format == 'ssml':
+        return split_ssml(text, chunk_size)
+    else:
+        return split_plain(text, chunk_size)
+
+class ChunkedMessage(object):
+    """Events of a message sent to the driver in chunks.
+
+    The driver reports each chunk as a separate message with positions
+    counted from its start. translate() moves the positions in text to
+    the whole message, renumbers sentences and words and drops the
+    message_start and message_end events between chunks. If
+    translate_audio is True, positions in audio are moved after the audio
+    of the previous chunks as well (when the audio is retrieved, the audio
+    server already does that while scheduling the events)."""
+
+    def __init__(self, translate_audio=True):
+        self.chunks = []
+        # All chunks were added
+        self.complete = False
+        # The last message_end was translated
+        self.finished = False
+        self.cancelled = False
+        self._translate_audio = translate_audio
+        # Index of the chunk the driver reports events for
+        self._current = 0
+        # Duration of the audio of the previous chunks in miliseconds
+        self._audio_offset = 0
+        # Number of events of each type in the previous and the current chunk
+        self._previous_counts = {}
+        self._counts = {}
+
+    def add(self, chunk):
+        self.chunks.append(chunk)
+
+    def translate(self, event):
+        """Translate event reported by the driver in place. Return
+        it or None if the event should not be passed to the client."""
+        chunk = self.chunks[self._current]
+        last = self.complete and self._current == len(self.chunks) - 1
+
+        if event.type == 'message_end':
+            if not last:
+                self._next_chunk(event)
+                return None
+            self.finished = True
+        elif event.type == 'message_start' and self._current > 0:
+            return None
+        if self.cancelled:
+            return None
+
+        event.pos_text = chunk.message_position(event.pos_text)
+        if self._translate_audio and event.pos_audio != None:
+            event.pos_audio += self._audio_offset
+        if event.n != None:
+            self._counts[event.type] = self._counts.get(event.type, 0) + 1
+            event.n += self._previous_counts.get(event.type, 0)
+        return event
+
+    def _next_chunk(self, message_end):
+        if message_end.pos_audio != None:
+            self._audio_offset += message_end.pos_audio
+        for type, count in self._counts.iteritems():
+            self._previous_counts[type] = self._previous_counts.get(type, 0) + count
+        self._counts = {}
+        self._current += 1
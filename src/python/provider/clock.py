@@ -0,0 +1,75 @@
+#
+# clock.py - Monotonic clock
+#
+# Copyright (C) 2008 Brailcom, o.p.s.
+#
+# This is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this package; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+
+"""Monotonic clock for measuring playback time.
+
+Wall clock time (time.time(), datetime.now()) jumps when the system
+time is adjusted (e.g. by NTP), which would make audio events fire too
+early or too late. monotonic() uses clock_gettime(CLOCK_MONOTONIC) where
+available and falls back to time.time() otherwise."""
+
+import time
+import ctypes
+import ctypes.util
+
+# From <linux/time.h>
+CLOCK_MONOTONIC = 1
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+def _find_clock_gettime():
+    """Return the C function clock_gettime or None"""
+    for name in ('rt', 'c'):
+        library_name = ctypes.util.find_library(name)
+        if library_name == None:
+            continue
+        try:
+            library = ctypes.CDLL(library_name, use_errno=True)
+            function = library.clock_gettime
+        except (OSError, AttributeError):
+            continue
+        function.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+        function.restype = ctypes.c_int
+        return function
+    return None
+
+_clock_gettime = _find_clock_gettime()
+
+def _monotonic():
+    """Return the value of a monotonic clock in seconds as a floating
+    point number. Only differences of the values are meaningful."""
+    spec = _timespec()
+    if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(spec)) != 0:
+        raise OSError(ctypes.get_errno(), "clock_gettime failed")
+    return spec.tv_sec + spec.tv_nsec * 1e-9
+
+if _clock_gettime != None:
+    try:
+        _monotonic()
+    except OSError:
+        _clock_gettime = None
+
+if _clock_gettime != None:
+    monotonic = _monotonic
+    is_monotonic = True
+else:
+    monotonic = time.time
+    is_monotonic = False
@@ -1,5 +1,8 @@
 
 import threading
+import time
+import heapq
+import itertools
 from copy import copy
 
 class EventQueue(object):
@@ -26,29 +29,113 @@ class EventQueue(object):
         return event
 
 class EventPot(object):
-
-    def __init__(self):
-        self._data_lock = threading.Lock()
-        self._events = []
-        self._t_event = threading.Event()
-        self._t_event.clear()
+    """Queue of requests for one consumer thread, safe for any number
+    of producers.
+
+    If priority is given, priority(event) returns a number for each
+    pushed event and events with lower numbers are popped first, events
+    of the same priority in order of arrival. If supersedes is given,
+    supersedes(new, queued) returns True for events still waiting in the
+    pot which the newly pushed event makes useless, these are dropped."""
+
+    def __init__(self, priority=None, supersedes=None):
+        self._condition = threading.Condition(threading.Lock())
+        # Heap of (priority, sequence number, event)
+        self._heap = []
+        self._sequence = itertools.count()
+        self._priority = priority
+        self._supersedes = supersedes
+        # Statistics
+        self.pushed = 0
+        self.popped = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._heap)
 
     def push(self, event):
-        self._data_lock.acquire()
-        self._events.insert(0, event)
-        self._data_lock.release()
-
-        self._t_event.set()
+        if self._priority != None:
+            priority = self._priority(event)
+        else:
+            priority = 0
+        self._condition.acquire()
+        try:
+            if self._supersedes != None and len(self._heap) > 0:
+                remaining = [entry for entry in self._heap
+                             if not self._supersedes(event, entry[2])]
+                if len(remaining) < len(self._heap):
+                    self.dropped += len(self._heap) - len(remaining)
+                    heapq.heapify(remaining)
+                    self._heap = remaining
+            heapq.heappush(self._heap, (priority, self._sequence.next(), event))
+            self.pushed += 1
+            self._condition.notify()
+        finally:
+            self._condition.release()
+
+    def pop(self, timeout=None):
+        """Remove and return the first event, wait for one if the
+        pot is empty. Return None if timeout (in seconds) expires."""
+        self._condition.acquire()
+        try:
+            if timeout != None:
+                deadline = time.time() + timeout
+            while len(self._heap) == 0:
+                if timeout == None:
+                    self._condition.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                    self._condition.wait(remaining)
+            self.popped += 1
+            return heapq.heappop(self._heap)[2]
+        finally:
+            self._condition.release()
+
+    def statistics(self):
+        """Return a dictionary with the numbers of events pushed,
+        popped, dropped as superseded and waiting"""
+        self._condition.acquire()
+        try:
+            return {'pushed': self.pushed, 'popped': self.popped,
+                    'dropped': self.dropped, 'waiting': len(self._heap)}
+        finally:
+            self._condition.release()
+
+class EventSchedule(object):
+    """Audio events of one message waiting for dispatch, ordered
+    by their position in audio (the pos_audio attribute)"""
 
-    def pop(self):
-        self._t_event.wait()
-        self._t_event.clear()
-
-        self._data_lock.acquire()
-        event = self._events.pop()
-        self._data_lock.release()
-
-        return event
+    def __init__(self):
+        # Heap of (pos_audio, sequence number, event), the sequence
+        # number keeps events with the same position in order of arrival
+        self._heap = []
+        self._sequence = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def add(self, event):
+        heapq.heappush(self._heap, (event.pos_audio, self._sequence.next(), event))
+
+    def next_position(self):
+        """Return the position of the earliest event or None if empty"""
+        if len(self._heap) == 0:
+            return None
+        return self._heap[0][0]
+
+    def pop_due(self, position):
+        """Remove and return the list of events with position
+        up to the given position, in order"""
+        due = []
+        while len(self._heap) > 0 and self._heap[0][0] <= position:
+            due.append(heapq.heappop(self._heap)[2])
+        return due
+
+    def clear(self):
+        """Remove all events"""
+        self._heap = []
 
 class Event(object):
 
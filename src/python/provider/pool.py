@@ -0,0 +1,515 @@
+#
+# pool.py - Driver processes shared by all clients
+#
+# Copyright (C) 2008 Brailcom, o.p.s.
+#
+# This is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this package; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+
+"""Pool of driver processes shared by all Provider instances.
+
+Driver processes are started once when the server starts. Each Provider
+receives a DriverSession for every available driver. The session
+remembers the settings its client made and restores them on the shared
+driver whenever another session used the driver in the meantime.
+
+Information which doesn't change while a driver runs (its description,
+capabilities and voices) is cached in the pool for all sessions, see
+DriverPool.cached()."""
+
+import subprocess
+import threading
+import random
+import os
+
+from ttsapi.errors import *
+import ttsapi.client
+from ttsapi.structures import VoiceDescription
+
+class Driver(object):
+    """TTS API driver"""
+    "Name (id) of the driver"
+    name = None,
+    "Process object for the driver"
+    process = None,
+    "Communication object for the driver (ttsapi.Client object)"
+    com = None,
+    "Audio output. One of 'playback', 'retrieval', 'emulated_playback'"
+    audio_output = None,
+    "Real (without any emulateion) capabilities as reported by the driver"
+    real_capabilities = None
+
+    def __init__(self, name, process, com):
+        """Init the main attributes"""
+        self.name = name
+        self.process = process
+        self.com = com
+        # Serializes the requests of the sessions sharing this driver
+        self.lock = threading.RLock()
+        # Session whose settings are currently set in the driver
+        self.owner = None
+        # Number of sessions using this driver
+        self.sessions = 0
+        # Groups of settings (see DriverSession._SETTINGS) changed
+        # from their defaults by any session
+        self.changed = set()
+
+    def alive(self):
+        """Return True if the driver process is still running"""
+        return self.process.poll() == None
+
+class _SessionCommunication(object):
+    """Stands for the driver communication object (Driver.com)
+    in a DriverSession, routing all calls through the session"""
+
+    def __init__(self, session):
+        self._session = session
+
+    def __getattr__(self, name):
+        session = self._session
+        def call(*args, **kwargs):
+            return session.call(name, args, kwargs)
+        return call
+
+class DriverSession(object):
+    """One Provider's handle to a driver shared through DriverPool.
+
+    It offers the same attributes Provider uses on Driver objects.
+    Calls on 'com' are serialized with calls of other sessions of the same
+    driver. Use acquire() and release() around sequences of calls which
+    must not be interleaved with other sessions (e.g. setting the message
+    id and sending the message)."""
+
+    # Driver commands whose effect persists in the driver by the
+    # group of settings they change
+    _SETTINGS = {'set_voice_by_name': 'voice',
+                 'set_voice_by_properties': 'voice',
+                 'set_rate': 'rate',
+                 'set_pitch': 'pitch',
+                 'set_pitch_range': 'pitch_range',
+                 'set_volume': 'volume',
+                 'set_punctuation_mode': 'punctuation_mode',
+                 'set_punctuation_detail': 'punctuation_detail',
+                 'set_capital_letters_mode': 'capital_letters_mode',
+                 'set_number_grouping': 'number_grouping'}
+
+    # Calls (name, args, kwargs) restoring the default of each group
+    _DEFAULTS = {'voice': ('set_voice_by_properties', (VoiceDescription(), 0), {}),
+                 'rate': ('set_rate', (0, 'relative'), {}),
+                 'pitch': ('set_pitch', (0, 'relative'), {}),
+                 'pitch_range': ('set_pitch_range', (0, 'relative'), {}),
+                 'volume': ('set_volume', (0, 'relative'), {}),
+                 'punctuation_mode': ('set_punctuation_mode', ('none',), {}),
+                 'punctuation_detail': ('set_punctuation_detail', ('',), {}),
+                 'capital_letters_mode': ('set_capital_letters_mode', ('no',), {}),
+                 'number_grouping': ('set_number_grouping', (0,), {})}
+
+    def __init__(self, driver, pool):
+        self.driver = driver
+        self.pool = pool
+        self.name = driver.name
+        self.real_capabilities = driver.real_capabilities
+        self.audio_output = driver.audio_output
+        self.com = _SessionCommunication(self)
+        # Dictionary of group:(name, args, kwargs) of the settings
+        # this session made successfully
+        self._settings = {}
+        self._settings_order = []
+        # Function called after each change of the settings or None
+        self.on_settings = None
+        # Nesting level of acquire() calls holding the driver lock
+        self._depth = 0
+
+    def acquire(self):
+        """Get exclusive access to the driver. If its process died,
+        the session moves to another process of the same driver first."""
+        while True:
+            driver = self.driver
+            driver.lock.acquire()
+            if driver is not self.driver:
+                # Moved to another process by a concurrent call meanwhile
+                driver.lock.release()
+                continue
+            if self._depth == 0 and not driver.alive():
+                # Only move when not nested in another acquire(),
+                # which would then release the wrong lock
+                try:
+                    self.pool.replace(self)
+                finally:
+                    driver.lock.release()
+                continue
+            self._depth += 1
+            return
+
+    def release(self):
+        """Release access obtained by acquire()"""
+        self._depth -= 1
+        self.driver.lock.release()
+
+    def _synchronize(self):
+        """Restore the settings of this session in the driver
+        if another session changed them. Settings this session never
+        made are reset to their defaults."""
+        if self.driver.owner is self:
+            return
+        for group in self.driver.changed:
+            if self._settings.has_key(group):
+                continue
+            name, args, kwargs = self._DEFAULTS[group]
+            try:
+                getattr(self.driver.com, name)(*args, **kwargs)
+            except TTSAPIError, error:
+                log.debug("Can't reset " + group + " in driver "
+                          + self.name + ": " + str(error))
+        for group in self._settings_order:
+            name, args, kwargs = self._settings[group]
+            getattr(self.driver.com, name)(*args, **kwargs)
+        self.driver.owner = self
+
+    def settings_key(self):
+        """Return a hashable description of the settings this
+        session made in the driver. As the rest is at the defaults
+        while the session owns the driver, the key fully describes
+        the settings its messages are synthesized with."""
+        key = []
+        for group in sorted(self._settings.keys()):
+            name, args, kwargs = self._settings[group]
+            # Arguments like VoiceDescription are compared by their contents
+            key.append((name, tuple(map(str, args)),
+                        tuple(sorted([(arg, str(value))
+                                      for arg, value in kwargs.items()]))))
+        return tuple(key)
+
+    def cached(self, key, compute):
+        """Return the value cached under 'key' for this driver,
+        computing it by compute() on the first request"""
+        return self.pool.cached(self.name, key, compute)
+
+    def call(self, name, args, kwargs):
+        """Call the driver communication method 'name' with
+        the settings of this session in effect"""
+        self.acquire()
+        try:
+            self._synchronize()
+            result = getattr(self.driver.com, name)(*args, **kwargs)
+            if self._SETTINGS.has_key(name):
+                # Only remember settings the driver accepted
+                group = self._SETTINGS[name]
+                # Replayed in the order of the last change
+                if self._settings.has_key(group):
+                    self._settings_order.remove(group)
+                self._settings_order.append(group)
+                self._settings[group] = (name, args, kwargs)
+                self.driver.changed.add(group)
+                if self.on_settings != None:
+                    self.on_settings()
+            return result
+        finally:
+            self.release()
+
+class DriverPool(object):
+    """Driver processes shared by all clients.
+
+    For each driver in configuration.available_drivers,
+    configuration.driver_pool_size processes are started by start(). Sessions
+    are handed out on the least used process of each driver. Processes
+    which died are replaced on the next acquire, which also drops
+    everything cached for the driver. Sessions on a dead process move
+    to another one on their next call, see replace()."""
+
+    def __init__(self, logger, configuration, global_state):
+        global log, conf
+        log = logger
+        conf = configuration
+        self.global_state = global_state
+        self._lock = threading.Lock()
+        self._drivers = {}
+        self._module_info = {}
+        self._order = []
+        # Drivers which failed to initialize at start
+        self._unavailable = []
+        # Statistics
+        self.spawned = 0
+        self.reused = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # Cached values by driver name and key
+        self._cache = {}
+        self._cache_lock = threading.Lock()
+        for module_info in conf.available_drivers:
+            name = module_info['driver']
+            self._order.append(name)
+            self._module_info[name] = module_info
+            self._drivers[name] = []
+            self._cache[name] = {}
+
+    def _spawn(self, name):
+        """Launch and initialize a new process for driver 'name'.
+        Return the Driver object or None on failure."""
+        module_info = self._module_info[name]
+
+        # TODO: Create log files based on PID
+        # Currently, it is necessary to compare the log
+        # times
+        id = random.randrange(1,10000,1)
+        logfile = open(os.path.join(conf.log_dir,
+                                    module_info['driver']+"-"+str(id)+".log"), "w")
+
+        if module_info.has_key('args'):
+            module_executable_args = module_info['args']
+        else:
+            module_executable_args = []
+
+        try:
+            if module_info['communication'] == "shm":
+                driver_com = ttsapi.client.TCPConnection(method = 'shm',
+                                                         logger=log)
+                log.debug("Communication with "+ name + " via shared memory")
+
+                process = subprocess.Popen(args=[module_info['executable'],]+ ["shm",] +
+                                       [str(driver_com.key),
+                                       str(driver_com.write_semaphore_key),
+                                       str(driver_com.read_semaphore_key)] +
+                                       module_executable_args,
+                                       stderr=logfile)
+                log.debug("Subprocess for driver" + name + "initalized")
+            elif module_info['communication'] == "pipe":
+                process = subprocess.Popen(args=[module_info['executable'],]+ ["pipe",] +
+                                       module_executable_args,
+                                       stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE,
+                                       stderr=logfile)
+                log.debug("Subprocess for driver" + name + "initalized")
+                driver_com = ttsapi.client.TCPConnection(method = 'pipe',
+                                                         pipe_in = process.stdout,
+                                                         pipe_out = process.stdin,
+                                                         logger=log)
+                log.debug("Communication with "+ name + " via pipes")
+
+            else:
+                raise "Unknown communication mechanism with output module"
+
+        except OSError:
+            log.error("Can't launch driver  "+ name);
+            return None
+
+        driver = Driver(process=process, name=name, com=driver_com)
+        log.debug("Driver instance for driver" + name + "created")
+
+        try:
+            driver.com.init()
+        except TTSAPIError, error:
+            log.debug("Can't initialize driver " + name)
+            # Cleanup
+            log.debug("Terminating driver " + name)
+            try:
+                driver.com.quit()
+            except IOError:
+                pass
+            log.debug("Waiting for the driver process to terminate and joinin it")
+            driver.process.wait()
+            log.debug("Closing driver logfile")
+            logfile.close()
+            return None
+
+        log.debug("Driver instance for driver" + name + "initalized")
+        driver.real_capabilities = driver.com.driver_capabilities()
+        log.debug("Real capabilities for driver" + name + "filled in")
+        # Now comes the playback/retrieval question
+        if driver.real_capabilities.audio_methods == 'retrieval':
+            # Audio output is retrieval
+            driver.audio_output = 'emulated_playback'
+        else:
+            # Audio output is playback
+            driver.audio_output = 'playback'
+            # Dispatch incomming events to the Provider
+            # which owns the message
+            log.debug("Registering callbacks for driver " + name)
+            driver.com.register_callback('all', self._dispatch_audio_event)
+
+        self.spawned += 1
+        return driver
+
+    def _dispatch_audio_event(self, event):
+        """Pass an event reported by a driver to the Provider
+        which sent the message"""
+        try:
+            provider = self.global_state.message_provider(int(event.message_id))
+        except (KeyError, ValueError, TypeError):
+            log.error("Event for unknown message " + str(event.message_id))
+            return
+        provider.dispatch_audio_event(event)
+
+    def start(self):
+        """Start the driver processes"""
+        for name in self._order:
+            for i in range(conf.driver_pool_size):
+                driver = self._spawn(name)
+                if driver == None:
+                    break
+                self._drivers[name].append(driver)
+            if len(self._drivers[name]) == 0:
+                log.error("Driver " + name + " not available")
+                self._unavailable.append(name)
+        log.info("Driver pool started: " + str(self.statistics()))
+
+    def _select(self, name):
+        """Return the least used live process of driver 'name',
+        spawning one if there is none, or None on failure.
+        Must be called with self._lock held."""
+        drivers = self._drivers[name]
+        for driver in drivers[:]:
+            if not driver.alive():
+                log.error("Driver process for " + name + " died, removing it")
+                drivers.remove(driver)
+                self._invalidate(name)
+        if len(drivers) == 0:
+            driver = self._spawn(name)
+            if driver == None:
+                return None
+            drivers.append(driver)
+        else:
+            driver = drivers[0]
+            for candidate in drivers[1:]:
+                if candidate.sessions < driver.sessions:
+                    driver = candidate
+            self.reused += 1
+        return driver
+
+    def acquire(self, name):
+        """Return a new DriverSession on the least used process
+        of driver 'name' or None if the driver is not available"""
+        self._lock.acquire()
+        try:
+            if name in self._unavailable:
+                return None
+            driver = self._select(name)
+            if driver == None:
+                return None
+            driver.sessions += 1
+            return DriverSession(driver, self)
+        finally:
+            self._lock.release()
+
+    def replace(self, session):
+        """Move 'session' from its dead driver process to a live one.
+        The settings of the session are replayed on the new process
+        by its next call (see DriverSession._synchronize()). Raise
+        ErrorDriverNotAvailable if no process can be started."""
+        self._lock.acquire()
+        try:
+            dead = session.driver
+            if dead.alive():
+                # Already moved by a concurrent call
+                return
+            driver = self._select(session.name)
+            if driver == None:
+                log.error("No replacement for dead driver process "
+                          + session.name)
+                raise ErrorDriverNotAvailable
+            log.info("Moving session from dead driver process "
+                     + session.name + " to a new one")
+            dead.sessions -= 1
+            driver.sessions += 1
+            session.driver = driver
+            session.real_capabilities = driver.real_capabilities
+            session.audio_output = driver.audio_output
+        finally:
+            self._lock.release()
+
+    def acquire_all(self):
+        """Return a dictionary of sessions for all available
+        drivers indexed by driver names"""
+        sessions = {}
+        for name in self._order:
+            session = self.acquire(name)
+            if session != None:
+                sessions[name] = session
+        log.debug("Driver sessions created: " + str(self.statistics()))
+        return sessions
+
+    def release(self, session):
+        """Return a session obtained by acquire()"""
+        self._lock.acquire()
+        try:
+            session.driver.sessions -= 1
+            if session.driver.owner is session:
+                session.driver.owner = None
+        finally:
+            self._lock.release()
+
+    def cached(self, name, key, compute):
+        """Return the value cached under 'key' for driver 'name'.
+        On a miss, the value is computed by compute() and cached
+        until the driver restarts. The returned value is shared by
+        all sessions and must not be modified."""
+        self._cache_lock.acquire()
+        try:
+            cache = self._cache[name]
+            if cache.has_key(key):
+                self.cache_hits += 1
+                return cache[key]
+            self.cache_misses += 1
+        finally:
+            self._cache_lock.release()
+        # Don't hold the lock while talking to the driver. Two sessions
+        # may compute the same value, the result is the same.
+        value = compute()
+        self._cache_lock.acquire()
+        try:
+            cache[key] = value
+        finally:
+            self._cache_lock.release()
+        return value
+
+    def _invalidate(self, name):
+        """Drop everything cached for driver 'name'"""
+        self._cache_lock.acquire()
+        try:
+            self._cache[name] = {}
+        finally:
+            self._cache_lock.release()
+
+    def statistics(self):
+        """Return a dictionary with the number of driver processes spawned,
+        sessions served by already running processes, sessions
+        currently in use and hits and misses of the cache"""
+        sessions = 0
+        for drivers in self._drivers.values():
+            for driver in drivers:
+                sessions += driver.sessions
+        return {'spawned': self.spawned, 'reused': self.reused,
+                'sessions': sessions, 'cache_hits': self.cache_hits,
+                'cache_misses': self.cache_misses}
+
+    def quit(self):
+        """Terminate all driver processes"""
+        log.info("Driver pool statistics: " + str(self.statistics()))
+        log.info("Terminaning all loaded drivers")
+        self._lock.acquire()
+        try:
+            for name, drivers in self._drivers.iteritems():
+                for driver in drivers:
+                    log.debug("Terminating " + name + " driver")
+                    try:
+                        driver.com.quit()
+                    except IOError:
+                        pass
+                    log.debug("Waiting for driver process to terminate (" + name + ")")
+                    driver.process.wait()
+                    log.debug("Driver process terminated (" + name + ")")
+                del drivers[:]
+        finally:
+            self._lock.release()
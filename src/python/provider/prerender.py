@@ -0,0 +1,222 @@
+#
+# prerender.py - Synthesis of characters and keys in advance
+#
+# Copyright (C) 2008 Brailcom, o.p.s.
+#
+# This is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this package; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+
+"""Synthesis of characters and keys into the audio cache in advance.
+
+Keyboard echo is the most latency critical use of the provider. Once
+the characters and keys a user types are in the audio cache, they are
+played without any request to the driver. Prerenderer synthesizes them
+in the background for a driver and its settings. Clients with the same
+driver and settings share one Prerenderer, see Prerenderers."""
+
+import string
+import threading
+import time
+
+from ttsapi.errors import *
+
+# Characters synthesized by SAY CHAR
+CHARACTERS = string.ascii_letters + string.digits + string.punctuation + " "
+
+# Key names of SSIP synthesized by SAY KEY
+KEYS = (['space', 'underscore', 'double-quote', 'alt', 'control', 'hyper',
+         'meta', 'shift', 'super', 'backspace', 'break', 'delete', 'down',
+         'end', 'enter', 'escape', 'home', 'insert', 'left', 'menu', 'next',
+         'num-lock', 'pause', 'print', 'prior', 'return', 'right',
+         'scroll-lock', 'tab', 'up', 'window',
+         'kp-*', 'kp-+', 'kp--', 'kp-.', 'kp-/', 'kp-enter']
+        + ['f' + str(i) for i in range(1, 25)]
+        + ['kp-' + str(i) for i in range(10)])
+
+# Seconds to wait for the driver to synthesize a prerendered item
+TIMEOUT = 10
+
+class Prerenderer(threading.Thread):
+    """Thread synthesizing CHARACTERS and KEYS one by one for key,
+    a driver and its settings as returned by Provider.prerender_key(),
+    through Provider.prerender() of any of the providers added"""
+
+    def __init__(self, key, logger):
+        threading.Thread.__init__(self, name="Prerender")
+        self.setDaemon(True)
+        self.key = key
+        self._log = logger
+        self._lock = threading.Lock()
+        self._providers = []
+        self._wakeup = threading.Event()
+        self._quit = False
+
+    def add(self, provider):
+        """Prerender through provider too, it has the driver and settings
+        of key. The table is gone through again for items not cached."""
+        self._lock.acquire()
+        try:
+            self._providers.append(provider)
+        finally:
+            self._lock.release()
+        self._wakeup.set()
+
+    def remove(self, provider):
+        """Stop using provider, return the number of providers left"""
+        self._lock.acquire()
+        try:
+            if provider in self._providers:
+                self._providers.remove(provider)
+            return len(self._providers)
+        finally:
+            self._lock.release()
+
+    def quit(self):
+        """Terminate the thread after the current item"""
+        self._quit = True
+        self._wakeup.set()
+
+    def _provider(self):
+        self._lock.acquire()
+        try:
+            if len(self._providers) == 0:
+                return None
+            return self._providers[0]
+        finally:
+            self._lock.release()
+
+    def _table(self):
+        for character in CHARACTERS:
+            yield ('char', character)
+        for key in KEYS:
+            yield ('key', key)
+
+    def _wait(self, recording):
+        """Wait until recording is complete, TIMEOUT seconds at most,
+        return False if it is not"""
+        deadline = time.time() + TIMEOUT
+        while not recording.finished.isSet() and not self._quit:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            recording.finished.wait(min(remaining, 0.1))
+        return recording.complete
+
+    def _prerender(self, command, text):
+        """Prerender one item through any of the providers"""
+        while not self._quit:
+            provider = self._provider()
+            if provider == None:
+                return
+            started = provider.prerender(command, text, self.key)
+            if started == False:
+                # The provider switched to other settings
+                self.remove(provider)
+                continue
+            if started != None:
+                message_id, recording = started
+                # One item at a time, so that requests of the clients
+                # don't wait for more than one item in the driver
+                if not self._wait(recording):
+                    self._log.debug("Prerendering of " + command + " " + text
+                                    + " timed out")
+                    provider.audio.stop_recording(message_id)
+            return
+
+    def run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            if self._quit:
+                return
+            self._log.debug("Prerendering characters and keys for " + self.key[0])
+            try:
+                for command, text in self._table():
+                    if self._quit:
+                        break
+                    self._prerender(command, text)
+            except (TTSAPIError, DriverError), error:
+                self._log.info("Prerendering stopped: " + str(error))
+
+class Prerenderers(object):
+    """Prerenderer threads shared by all clients, one for each
+    driver and its settings"""
+
+    def __init__(self, logger):
+        self._log = logger
+        self._lock = threading.Lock()
+        # Dictionary of key:Prerenderer
+        self._prerenderers = {}
+        # Dictionary of provider:key of the Prerenderer it is in
+        self._keys = {}
+        # Prerenderers without providers, to be joined
+        self._retired = []
+
+    def update(self, provider, key):
+        """Prerender for key (see Provider.prerender_key()) through provider
+        instead of its previous key, only stop prerendering through it
+        if key is None"""
+        self._lock.acquire()
+        try:
+            old_key = self._keys.get(provider)
+            if old_key == key:
+                return
+            if old_key != None:
+                del self._keys[provider]
+                prerenderer = self._prerenderers[old_key]
+                if prerenderer.remove(provider) == 0:
+                    del self._prerenderers[old_key]
+                    prerenderer.quit()
+                    self._retired.append(prerenderer)
+            if key != None:
+                self._keys[provider] = key
+                prerenderer = self._prerenderers.get(key)
+                if prerenderer == None:
+                    prerenderer = Prerenderer(key, self._log)
+                    self._prerenderers[key] = prerenderer
+                    prerenderer.start()
+                prerenderer.add(provider)
+        finally:
+            self._lock.release()
+
+    def remove(self, provider):
+        """Stop prerendering through provider and join the
+        threads left without providers. Must not be called with
+        the driver of provider acquired."""
+        self.update(provider, None)
+        self._join_retired()
+
+    def _join_retired(self):
+        self._lock.acquire()
+        try:
+            retired = self._retired
+            self._retired = []
+        finally:
+            self._lock.release()
+        for prerenderer in retired:
+            prerenderer.join()
+
+    def quit(self):
+        """Terminate and join all threads"""
+        self._lock.acquire()
+        try:
+            for prerenderer in self._prerenderers.values():
+                prerenderer.quit()
+                self._retired.append(prerenderer)
+            self._prerenderers = {}
+            self._keys = {}
+        finally:
+            self._lock.release()
+        self._join_retired()
@@ -23,35 +23,14 @@
 """TTS API Provider core logic"""
 
 import sys
-import subprocess
+import thread
 from copy import copy
-import random
-import os
 
 from ttsapi.structures import *
 from ttsapi.errors import *
 import ttsapi.client
 
-current_message_id = None
-
-class Driver(object):
-    """TTS API driver"""
-    "Name (id) of the driver"
-    name = None,
-    "Process object for the driver"
-    process = None,
-    "Communication object for the driver (ttsapi.Client object)"
-    com = None,
-    "Audio output. One of 'playback', 'retrieval', 'emulated_playback'"
-    audio_output = None,
-    "Real (without any emulateion) capabilities as reported by the driver"
-    real_capabilities = None
-    
-    def __init__(self, name, process, com):
-        """Init the main attributes"""
-        self.name = name
-        self.process = process
-        self.com = com
+import chunking
 
 class Provider(object):
     """TTS API implementation class (main process)
@@ -60,6 +39,11 @@ class Provider(object):
     _connection = None
     _registered_callbacks = {}
     _audio_volume = 1.0
+    # Dictionary of message_id:chunking.ChunkedMessage for messages
+    # sent to the driver in chunks
+    _chunked_messages = {}
+    # Id of the last message of this client
+    _current_message_id = None
 
     def __init__ (self, logger, configuration, audio,
                   global_state):
@@ -67,96 +51,22 @@ class Provider(object):
         global log, conf
         log = logger
         conf = configuration
-        # Load all available drivers, fill in the self.drivers and
-        # self.current_driver attributes
+        # Get sessions on the driver processes shared by all clients,
+        # fill in the self.loaded_drivers and self.current_driver attributes
         self.audio = audio
         self.global_state = global_state
-        self.loaded_drivers = {}
-        for module_info in conf.available_drivers:
-            
-            # TODO: Create log files based on PID
-            # Currently, it is necessary to compare the log
-            # times
-            id = random.randrange(1,10000,1)
-            logfile = open(os.path.join(conf.log_dir,
-                                        module_info['driver']+"-"+str(id)+".log"), "w")
-            name = module_info['driver']
-
-            if module_info.has_key('args'):
-                module_executable_args = module_info['args']
-            else:
-                module_executable_args = []
-
-            try:
-                if module_info['communication'] == "shm":
-                    driver_com = ttsapi.client.TCPConnection(method = 'shm',
-                                                             logger=log)
-                    log.debug("Communication with "+ name + " via shared memory")
-
-                    process = subprocess.Popen(args=[module_info['executable'],]+ ["shm",] +
-                                           [str(driver_com.key),
-                                           str(driver_com.write_semaphore_key),
-                                           str(driver_com.read_semaphore_key)] +
-                                           module_executable_args,
-                                           stderr=logfile)
-                    log.debug("Subprocess for driver" + name + "initalized")
-                elif module_info['communication'] == "pipe":
-                    process = subprocess.Popen(args=[module_info['executable'],]+ ["pipe",] +
-                                           module_executable_args,
-                                           stdin=subprocess.PIPE,
-                                           stdout=subprocess.PIPE,
-                                           stderr=logfile)
-                    log.debug("Subprocess for driver" + name + "initalized")
-                    driver_com = ttsapi.client.TCPConnection(method = 'pipe',
-                                                             pipe_in = process.stdout,
-                                                             pipe_out = process.stdin,
-                                                             logger=log)
-                    log.debug("Communication with "+ name + " via pipes")
-
-                else:
-                    raise "Unknown communication mechanism with output module"
-                
-            except OSError:
-                log.error("Can't launch driver  "+ name);
-                continue;
-
-            # bufsize = 1 means line buffered
-            self.loaded_drivers[name] = Driver(process=process, name=name,
-                                               com = driver_com)
-            log.debug("Driver instance for driver" + name + "created")
-
-            try:
-                self.loaded_drivers[name].com.init()
-            except TTSAPIError, error:
-                log.debug("Can't initialize driver " + name)
-                # Cleanup
-                log.debug("Terminating driver " + name)
-                try:
-                    self.loaded_drivers[name].com.quit()
-                except IOError:
-                    pass
-                log.debug("Waiting for the driver process to terminate and joinin it")
-                self.loaded_drivers[name].process.wait()
-                log.debug("Closing driver logfile")
-                logfile.close()
-                del self.loaded_drivers[name]
-                continue
-
-            log.debug("Driver instance for driver" + name + "initalized")
-            self.loaded_drivers[name].real_capabilities \
-               = self.loaded_drivers[name].com.driver_capabilities()
-            log.debug("Real capabilities for driver" + name + "filled in")
-            # Now comes the playback/retrieval question
-            if self.loaded_drivers[name].real_capabilities.audio_methods == 'retrieval':
-                # Audio output is retrieval
-                self.loaded_drivers[name].audio_output = 'emulated_playback'
-            else:
-                # Audio output is playback
-                self.loaded_drivers[name].audio_output = 'playback'
-                # Dispatch incomming events
-                log.debug("Registering callbacks for driver " + name)
-                self.loaded_drivers[name].com.register_callback(
-                    'all', self.dispatch_audio_event)
+        self._chunked_messages = {}
+        # Ids of the chunked messages cancelled by the last cancel()
+        self._cancelled_chunked = set()
+        # Ids of the messages of this client in the audio server
+        # which didn't end yet
+        self._messages_in_audio = set()
+        # Dictionary of message_id:DriverSession of the messages of this
+        # client sent to a driver which didn't end yet
+        self._messages_in_driver = {}
+        # Lock of both _messages_in_audio and _messages_in_driver
+        self._messages_in_audio_lock = thread.allocate_lock()
+        self.loaded_drivers = global_state.driver_pool.acquire_all()
 
         if self.loaded_drivers.has_key(conf.default_driver):
             self.current_driver = self.loaded_drivers[conf.default_driver]
@@ -174,21 +84,30 @@ class Provider(object):
                 self.current_driver = None
                 log.info("No driver available")
 
+        # Characters and keys are synthesized into the audio
+        # cache in advance for the settings of this client
+        if global_state.prerenderers != None:
+            for driver in self.loaded_drivers.values():
+                driver.on_settings = self._update_prerendering
+            self._update_prerendering()
+
     def init(self):
         """Called on the INIT TTS API command."""
         raise ErrorInvalidCommand
 
     def quit(self):
-        """Terminate all child threads and processes and exit"""
+        """Release the drivers used by this client"""
 
-        log.info("Terminaning all loaded drivers")
-    
+        if self.global_state.prerenderers != None:
+            self.global_state.prerenderers.remove(self)
+
+        log.info("Releasing all loaded drivers")
+        # The driver processes themselves are shared and terminated
+        # by the driver pool when the server exits
         for name, driver in self.loaded_drivers.iteritems():
-            log.debug("Terminating " + name + " driver")
-            driver.com.quit()
-            log.debug("Waiting for driver process to terminate (" + name + ")")
-            driver.process.wait()
-            log.debug("Driver process terminated (" + name + ")")
+            log.debug("Releasing " + name + " driver")
+            self.global_state.driver_pool.release(driver)
+        self.loaded_drivers = {}
 
     def set_connection(self, connection):
         """Set the associated connection. Necessary for
@@ -203,9 +122,8 @@ class Provider(object):
         """
         res = []
         for name, driver in self.loaded_drivers.iteritems():
-            dscr = driver.com.drivers()
-            dscr[0].driver_id = name
-            res += dscr
+            res += driver.cached('drivers',
+                                 lambda: self._driver_description(driver))
         return res
 
     def driver_capabilities (self):
@@ -216,13 +134,25 @@ class Provider(object):
         """
         if not self.current_driver:
             raise ErrorDriverNotAvailable
+        return self.current_driver.cached('capabilities',
+                                          self._emulated_capabilities)
+
+    def _driver_description(self, driver):
+        """Ask the driver for its description"""
+        dscr = driver.com.drivers()
+        dscr[0].driver_id = driver.name
+        return dscr
+
+    def _emulated_capabilities(self):
+        """Return capabilities of the current driver including
+        the features provided by emulation"""
         capabilities = copy(self.current_driver.real_capabilities)
-        
         # If retrieval is available, then by emulation also playback
-        # is available
-        if 'retrieval' in capabilities.audio_methods:
-            capabilities.audio_methods.append('playback')
-            
+        # is available. The list is shared with real_capabilities,
+        # don't modify it in place.
+        if 'retrieval' in capabilities.audio_methods \
+                and 'playback' not in capabilities.audio_methods:
+            capabilities.audio_methods = capabilities.audio_methods + ['playback']
         return capabilities
 
     def voices (self):
@@ -233,7 +163,8 @@ class Provider(object):
         """
         if not self.current_driver:
             raise ErrorDriverNotAvailable
-        return self.current_driver.com.voices()
+        return self.current_driver.cached('voices',
+                                          self.current_driver.com.voices)
         
     # Speech Synthesis commands
 
@@ -248,22 +179,132 @@ class Provider(object):
         # know there will be an incomming message and set the
         # proper destination on the driver.
         log.debug("Audio output method: " + str (self.current_driver.audio_output))
+        self._messages_in_audio_lock.acquire()
+        try:
+            self._messages_in_driver[message_id] = self.current_driver
+        finally:
+            self._messages_in_audio_lock.release()
         
         # Decide what kind of audio output to use
         self.set_audio_output()
         # Make preparations for this kind of audio output
         if self.current_driver.audio_output == 'emulated_playback':
-            self.audio.post_event('accept', message_id, blocking=True)
-            try:
-                log.debug("Setting audio retrieval destination")
-                self.current_driver.com.set_audio_retrieval_destination(host=self.audio.host,
-                    port=self.audio.port)
-            except TTSAPIError, error:
-                log.error("Error in output module: " + str(error))
-                raise DriverError
-
+            self._accept(message_id)
+            self._set_retrieval_destination()
             self.audio.audio.set_volume(message_id, self._audio_volume)
 
+    def _accept(self, message_id):
+        """Let the audio server accept message_id for playback"""
+        self._messages_in_audio_lock.acquire()
+        try:
+            self._messages_in_audio.add(message_id)
+        finally:
+            self._messages_in_audio_lock.release()
+        self.audio.post_event('accept', message_id, blocking=True)
+
+    def _set_retrieval_destination(self):
+        """Let the driver send retrieved audio to our audio server"""
+        try:
+            log.debug("Setting audio retrieval destination")
+            if self.audio.socket_path != None:
+                self.current_driver.com.set_audio_retrieval_destination(
+                    host=self.audio.socket_path, port=0)
+            else:
+                self.current_driver.com.set_audio_retrieval_destination(
+                    host=self.audio.host, port=self.audio.port)
+        except TTSAPIError, error:
+            log.error("Error in output module: " + str(error))
+            raise DriverError
+
+    def _cache_key(self, command, text):
+        """Return the key of the audio of command with text in the
+        audio cache or None if it is not cached"""
+        if self.global_state.audio_cache == None:
+            return None
+        # Only retrieved audio can be recorded
+        if 'retrieval' not in self.current_driver.real_capabilities.audio_methods:
+            return None
+        # Volume is not included, it is applied by the audio server
+        return (self.current_driver.name, self.current_driver.settings_key(),
+                command, text)
+
+    def _say_from_cache(self, cache_key):
+        """If audio for cache_key is cached, play it as a new message
+        without asking the driver and return the message id, otherwise
+        return None"""
+        recording = self.global_state.audio_cache.get(cache_key)
+        if recording == None:
+            return None
+        message_id = self.global_state.new_message_id(self)
+        log.debug("Playing message " + str(message_id) + " from the audio cache")
+        self._accept(message_id)
+        self.audio.audio.set_volume(message_id, self._audio_volume)
+        self.audio.post_replay(message_id, recording)
+        return message_id
+
+    def _record(self, message_id, cache_key):
+        """Record the audio of message_id into the audio cache
+        under cache_key if it is retrieved from the driver"""
+        if cache_key != None \
+                and self.current_driver.audio_output == 'emulated_playback':
+            self.audio.record(message_id,
+                              self.global_state.audio_cache.recording(cache_key))
+
+    def prerender_key(self):
+        """Return the key of the driver and settings characters and
+        keys are prerendered for (see prerender.Prerenderers) or None
+        if they can't be cached"""
+        driver = self.current_driver
+        if not driver or self.global_state.audio_cache == None:
+            return None
+        if 'retrieval' not in driver.real_capabilities.audio_methods:
+            return None
+        return (driver.name, driver.settings_key())
+
+    def _update_prerendering(self):
+        """Let the prerenderers know the driver or its settings changed"""
+        if self.global_state.prerenderers != None:
+            self.global_state.prerenderers.update(self, self.prerender_key())
+
+    def prerender(self, command, text, key):
+        """Start synthesis of command ('char' or 'key') with text into
+        the audio cache without playing it. Return (message_id, recording)
+        with the cache.Recording completed when the audio arrives, None if
+        it is cached already or False if this client doesn't have the
+        driver and settings of key (see prerender_key()) any more. Called
+        from a prerender.Prerenderer thread."""
+        driver = self.current_driver
+        if not driver:
+            return False
+        cache_key = self._cache_key(command, text)
+        if cache_key == None or cache_key[:2] != key:
+            return False
+        if self.global_state.audio_cache.contains(cache_key):
+            return None
+        recording = self.global_state.audio_cache.recording(cache_key)
+        driver.acquire()
+        try:
+            if driver is not self.current_driver \
+                    or driver.settings_key() != key[1]:
+                # Switched in the meantime
+                return False
+            # The message id is unique, so the request is never superseded
+            # by requests of the clients in the driver
+            message_id = self.global_state.new_message_id(self)
+            driver.com.set_message_id(message_id)
+            self.set_audio_output()
+            if driver.audio_output != 'emulated_playback':
+                return False
+            self._set_retrieval_destination()
+            self.audio.record(message_id, recording, play=False)
+            if command == 'char':
+                driver.com.say_char(text)
+            else:
+                driver.com.say_key(text)
+        finally:
+            driver.release()
+        return (message_id, recording)
+
     def say_text (self, text, format='plain',
                   position = None, position_type = None,
                   index_mark = None, character = None):
@@ -295,29 +336,32 @@ class Provider(object):
         assert index_mark == None or isinstance(index_mark, str) \
             or isinstance(text, unicode)
         assert character == None or isinstance(character, int)
-        global current_message_id
 
         #TODO: mutex
-        #if current_message_id != None:
+        #if self._current_message_id != None:
         #    raise ErrorDriverBusy()
 
         if not self.current_driver:
             raise ErrorDriverNotAvailable
 
-        message_id = self.global_state.new_message_id(self)
-        current_message_id = message_id
-        self.current_driver.com.set_message_id(message_id)
-        log.debug("Preparing for message")
-        self._prepare_for_message(message_id)
+        # Long messages are sent to the driver in chunks so that
+        # synthesis starts before the driver has processed all the text
+        chunks = None
+        if conf.say_text_chunk_size > 0 and len(text) > conf.say_text_chunk_size \
+                and position == None and index_mark == None and character == None:
+            log.debug("Splitting message into chunks")
+            chunks = chunking.split(text, format, conf.say_text_chunk_size)
 
         log.debug("Plain text emulation")
         # TODO: Escape '<' and '>'
         # Plain text emulation
         cap_message_format = self.current_driver.real_capabilities.message_format
+        wrap = None
         if format not in cap_message_format:
             if (format == 'plain') and ('ssml' in cap_message_format):
                 log.debug("Converting from PLAIN to SSML")                
                 text = "<speak>" + text + "</speak>"
+                wrap = ("<speak>", "</speak>")
                 format = 'ssml'
             elif (format == 'ssml') and ('plain' in cap_message_format):
                 log.debug("Converting from SSML to PLAIN")                
@@ -327,13 +371,63 @@ class Provider(object):
                 raise "Format not supported in driver or invalid format. Requested: " + str(format) + \
                     " Offered: " + str(cap_message_format)
 
-        log.debug("Calling driver say_text")
-        self.current_driver.com.say_text(text, format, position, position_type,
-                                         index_mark, character)
-        
+        # Short messages spoken whole may be cached
+        cache_key = None
+        if chunks == None and len(text) <= conf.audio_cache_max_text_length \
+                and position == None and index_mark == None and character == None:
+            cache_key = self._cache_key('text', (format, text))
+        if cache_key != None:
+            message_id = self._say_from_cache(cache_key)
+            if message_id != None:
+                self._current_message_id = message_id
+                return message_id
+
+        # Other clients may share the driver, don't let them
+        # interleave their messages with this one
+        self.current_driver.acquire()
+        try:
+            message_id = self.global_state.new_message_id(self)
+            self._current_message_id = message_id
+            self.current_driver.com.set_message_id(message_id)
+            log.debug("Preparing for message")
+            self._prepare_for_message(message_id)
+            self._record(message_id, cache_key)
+
+            if chunks == None:
+                log.debug("Calling driver say_text")
+                self.current_driver.com.say_text(text, format, position, position_type,
+                                                 index_mark, character)
+            else:
+                self._say_chunks(message_id, chunks, format, wrap)
+        finally:
+            self.current_driver.release()
+
         log.debug("Returning message id")
         return message_id
         
+    def _say_chunks(self, message_id, chunks, format, wrap):
+        """Send the chunks of message_id to the driver one by one
+        as they are produced"""
+        chunked = chunking.ChunkedMessage(translate_audio =
+            self.current_driver.audio_output != 'emulated_playback')
+        self._chunked_messages[message_id] = chunked
+        chunks = iter(chunks)
+        chunk = next(chunks, None)
+        while chunk != None:
+            following = next(chunks, None)
+            if wrap != None:
+                chunk.wrap(*wrap)
+            chunked.add(chunk)
+            if following == None:
+                # The message_end of the last chunk may arrive before
+                # say_text returns, it must not be taken for the end of
+                # a chunk
+                chunked.complete = True
+            log.debug("Calling driver say_text for chunk at " + str(chunk.offset))
+            self.current_driver.com.say_text(chunk.text, format)
+            chunk = following
+        log.debug("Message sent in " + str(len(chunked.chunks)) + " chunks")
+
     def say_deferred (self, message_id,
                       format='plain',
                       position = None, position_type = None,
@@ -362,22 +456,33 @@ class Provider(object):
         key -- a string containing a key identification as defined
         in TTS API          
         """
-        global current_message_id
         assert isinstance(key, str) or isinstance(key, unicode)
 
         #TODO: mutex
-        #if current_message_id != None:
+        #if self._current_message_id != None:
         #    raise ErrorDriverBusy()
         
         if not self.current_driver:
             raise ErrorDriverNotAvailable
 
-        message_id = self.global_state.new_message_id(self)
-        current_message_id = message_id
-        self.current_driver.com.set_message_id(message_id)
-        self._prepare_for_message(message_id)
-                
-        self.current_driver.com.say_key(key)
+        cache_key = self._cache_key('key', key)
+        if cache_key != None:
+            message_id = self._say_from_cache(cache_key)
+            if message_id != None:
+                self._current_message_id = message_id
+                return message_id
+
+        self.current_driver.acquire()
+        try:
+            message_id = self.global_state.new_message_id(self)
+            self._current_message_id = message_id
+            self.current_driver.com.set_message_id(message_id)
+            self._prepare_for_message(message_id)
+            self._record(message_id, cache_key)
+
+            self.current_driver.com.say_key(key)
+        finally:
+            self.current_driver.release()
         
         return message_id
         
@@ -390,21 +495,32 @@ class Provider(object):
         """
         assert isinstance(character, str) or isinstance(character, unicode)
         assert len(character) == 1
-        global current_message_id
 
         #TODO: mutex
-        #if current_message_id != None:
+        #if self._current_message_id != None:
         #    raise ErrorDriverBusy()
 
         if not self.current_driver:
             raise ErrorDriverNotAvailable
 
-        message_id = self.global_state.new_message_id(self)
-        current_message_id = message_id
-        self.current_driver.com.set_message_id(message_id)
-        self._prepare_for_message(message_id)
-                
-        self.current_driver.com.say_char(character)
+        cache_key = self._cache_key('char', character)
+        if cache_key != None:
+            message_id = self._say_from_cache(cache_key)
+            if message_id != None:
+                self._current_message_id = message_id
+                return message_id
+
+        self.current_driver.acquire()
+        try:
+            message_id = self.global_state.new_message_id(self)
+            self._current_message_id = message_id
+            self.current_driver.com.set_message_id(message_id)
+            self._prepare_for_message(message_id)
+            self._record(message_id, cache_key)
+
+            self.current_driver.com.say_char(character)
+        finally:
+            self.current_driver.release()
         
         return message_id
         
@@ -415,21 +531,32 @@ class Provider(object):
         icon -- name of the icon as defined in TTS API.          
         """
         assert isinstance(icon, str)
-        global current_message_id
 
         #TODO: mutex
-        #if current_message_id != None:
+        #if self._current_message_id != None:
         #    raise ErrorDriverBusy()
 
         if not self.current_driver:
             raise ErrorDriverNotAvailable
         
-        message_id = self.global_state.new_message_id(self)
-        current_message_id = message_id
-        self.current_driver.com.set_message_id(message_id)
-        self._prepare_for_message(message_id)
-        
-        self.current_driver.com.say_icon(icon)
+        cache_key = self._cache_key('icon', icon)
+        if cache_key != None:
+            message_id = self._say_from_cache(cache_key)
+            if message_id != None:
+                self._current_message_id = message_id
+                return message_id
+
+        self.current_driver.acquire()
+        try:
+            message_id = self.global_state.new_message_id(self)
+            self._current_message_id = message_id
+            self.current_driver.com.set_message_id(message_id)
+            self._prepare_for_message(message_id)
+            self._record(message_id, cache_key)
+
+            self.current_driver.com.say_icon(icon)
+        finally:
+            self.current_driver.release()
         
         return message_id
         
@@ -442,14 +569,39 @@ class Provider(object):
             raise ErrorDriverNotAvailable
 
 
-        log.debug("Cancelling current message (id == "+str(current_message_id)+")")
-        # Cancel playback in audio
-        # Strictly speaking, we should only do this if 'emulated_playback' is used
-        #if current_message_id != None:
-        #    self.audio.post_event('discard', current_message_id)
+        log.debug("Cancelling current message (id == "+str(self._current_message_id)+")")
+        # All chunked messages of this client are discarded below, the
+        # final message_end which would remove them never comes. Chunks
+        # already sent to the driver may still be synthesized, don't
+        # report their events.
+        chunked_messages = self._chunked_messages
+        self._chunked_messages = {}
+        for chunked in chunked_messages.values():
+            chunked.cancelled = True
+        # Only the messages of the last cancel, so that it doesn't grow
+        self._cancelled_chunked = set(chunked_messages.keys())
+        # Silence our messages in the audio server right away, not
+        # through the queue of requests of the playback thread
+        self._messages_in_audio_lock.acquire()
+        try:
+            message_ids = list(self._messages_in_audio)
+            self._messages_in_audio.clear()
+            messages_in_driver = self._messages_in_driver.items()
+            self._messages_in_driver = {}
+        finally:
+            self._messages_in_audio_lock.release()
+        if len(message_ids) > 0:
+            self.audio.stop_now(message_ids)
             
-        # NOTE: We are not waiting until the cancel is completed in the driver
-        return self.current_driver.com.cancel()
+        # The driver processes are shared with other clients, so only
+        # the messages of this client are discarded, not cancelled.
+        # NOTE: We are not waiting until the discard is completed in the driver
+        for message_id, driver in messages_in_driver:
+            try:
+                driver.com.discard(message_id)
+            except ErrorNotSupportedByDriver:
+                log.debug("Driver " + driver.name + " can't discard message "
+                          + str(message_id))
         
     def defer (self):
         """Defer current message."""
@@ -486,6 +638,7 @@ class Provider(object):
         if self.loaded_drivers.has_key(driver_id):
             self.current_driver = self.loaded_drivers[driver_id]
             log.info("Driver switched to " + driver_id)
+            self._update_prerendering()
         else:
             raise ErrorDriverNotLoaded
     
@@ -611,7 +764,6 @@ class Provider(object):
         method -- either 'relative' or 'absolute'          
         """
         assert isinstance(volume, int)
-        global current_message_id
 
         if method == 'relative':
             self._audio_volume = volume / 100.0
@@ -727,10 +879,12 @@ class Provider(object):
         Arguments:
         host -- IP address of the host machine as a string
         containing groups of three digits separated by a dot
-        port -- a positive number specifying the host port          
+        or path of a Unix domain socket (starting with '/')
+        port -- a positive number specifying the host port
+        (ignored for Unix domain sockets)
         """
         assert isinstance(host, str)
-        assert isinstance(port, int) and port > 0
+        assert isinstance(port, int) and (port > 0 or host.startswith('/'))
 
         if not self.current_driver:
             raise ErrorDriverNotAvailable
@@ -742,11 +896,32 @@ class Provider(object):
     def dispatch_audio_event(self, event):
         """Method to be called whenever an audio
         event is available. Takes care of dispatching
-        the audio event through the associated connection."""
+        the audio event through the associated connection.
+        Events of messages sent in chunks are translated
+        to events of the whole message first."""
+        message_id = int(event.message_id)
+        if message_id in self._cancelled_chunked:
+            return
+        chunked = self._chunked_messages.get(message_id)
+        if chunked != None:
+            event = chunked.translate(event)
+            if chunked.finished:
+                self._chunked_messages.pop(message_id, None)
+            if event == None:
+                return
+        if event.type == 'message_end':
+            self._messages_in_audio_lock.acquire()
+            try:
+                in_audio = message_id in self._messages_in_audio
+                self._messages_in_audio.discard(message_id)
+                if self._messages_in_driver.has_key(message_id):
+                    del self._messages_in_driver[message_id]
+            finally:
+                self._messages_in_audio_lock.release()
+            if in_audio:
+                # Free the track once its audio is played out
+                self.audio.post_event('release', message_id)
         try:
-            #TODO: Mutex
-            if event.type == 'message_end':
-                message_id = -1
             self._connection.send_audio_event(event)
         except ttsapi.server.ClientGone:
             pass
@@ -23,11 +23,13 @@
 
 import sys
 import socket
+import select
 import signal
 import threading
 import thread
 import traceback
 import fcntl
+import errno
 import os
 import atexit
 from copy import copy
@@ -41,6 +43,13 @@ import ttsapi
 # Provider (core of implementation)
 import provider
 
+# Driver processes shared by all clients
+import pool
+
+# Synthesized audio shared by all clients
+import cache
+import prerender
+
 # Logging object
 import logs
 
@@ -66,6 +75,14 @@ class GlobalState(object):
         """Initialize global state"""
 
         self._lock = thread.allocate_lock()
+        # Driver processes shared by all clients (pool.DriverPool)
+        self.driver_pool = None
+        # Audio synthesized for all clients (cache.AudioCache)
+        # or None if disabled
+        self.audio_cache = None
+        # Threads synthesizing characters and keys into audio_cache
+        # (prerender.Prerenderers) or None if disabled
+        self.prerenderers = None
 
     def delete_messages_from_provider(self):
         raise NotImplementedError
@@ -87,6 +104,22 @@ class GlobalState(object):
         # Return id of the new message
         return id
 
+def create_connection(client_socket, global_state):
+    """Create a Provider and a server side TTS API connection
+    for a new client on client_socket and return the connection"""
+
+    p = provider.Provider(logger=log,
+                          configuration=conf,
+                          audio=audio,
+                          global_state=global_state)
+    connection = ttsapi.server.TCPConnection(provider=p,
+                                             method='socket',
+                                             client_socket=client_socket,
+                                             logger=log,
+                                             max_message_size=conf.max_message_size or None)
+    p.set_connection(connection)
+    return connection
+
 def serve_client(method, global_state, socket=None):
     """Runs one connection to TTS API Provider
     
@@ -96,15 +129,7 @@ def serve_client(method, global_state, socket=None):
 
     if method == 'socket':
         assert socket != None
-        p = provider.Provider(logger=log,
-                              configuration=conf,
-                              audio=audio,
-                              global_state=global_state)
-        connection = ttsapi.server.TCPConnection(provider=p,
-                                                 method='socket',
-                                                 client_socket=socket,
-                                                 logger=log)
-        p.set_connection(connection)
+        connection = create_connection(socket, global_state)
         log.debug("Connection initialized, listening");
     else:
         raise NotImplementedError
@@ -117,6 +142,97 @@ def serve_client(method, global_state, socket=None):
             log.debug("Client on socket " + str(socket) + " gone")
             break
 
+class Poller(object):
+    """Waits for activity on a set of file descriptors. Uses epoll
+    where available and falls back to poll otherwise."""
+
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self._poll = select.epoll()
+            self._events = select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP
+        else:
+            self._poll = select.poll()
+            self._events = select.POLLIN | select.POLLERR | select.POLLHUP
+
+    def register(self, fd):
+        self._poll.register(fd, self._events)
+
+    def unregister(self, fd):
+        try:
+            self._poll.unregister(fd)
+        except (IOError, OSError, KeyError, ValueError):
+            # Already closed descriptors are removed automatically
+            pass
+
+    def poll(self):
+        """Block until there is activity, return a list of
+        (fd, event) pairs"""
+        while True:
+            try:
+                return self._poll.poll()
+            except (IOError, select.error), error:
+                if error.args[0] != errno.EINTR:
+                    raise
+
+def serve_clients_in_event_loop(server_sockets, global_state):
+    """Accept and serve all clients from the calling thread.
+
+    Instead of dedicating a thread to every client, wait for activity
+    on the server socket and all client sockets at once and process
+    the complete commands available on each readable socket. Commands are
+    still dispatched into the client's own Provider object."""
+
+    poller = Poller()
+    listeners = {}
+    for server_socket in server_sockets:
+        poller.register(server_socket.fileno())
+        listeners[server_socket.fileno()] = server_socket
+    connections = {}
+
+    while True:
+        for fd, event in poller.poll():
+            if listeners.has_key(fd):
+                (client_socket, address) = listeners[fd].accept()
+                log.debug("Connection ready")
+                connections[client_socket.fileno()] = \
+                    create_connection(client_socket, global_state)
+                poller.register(client_socket.fileno())
+                log.info("Accepted new client on socket " + str(client_socket.fileno()))
+                continue
+
+            connection = connections.get(fd)
+            if connection == None:
+                poller.unregister(fd)
+                continue
+            try:
+                connection.process_available_input()
+            except ttsapi.server.ClientGone:
+                log.debug("Client on socket " + str(fd) + " gone")
+                poller.unregister(fd)
+                del connections[fd]
+            except Exception:
+                # Only this client is disconnected, as its own thread
+                # would terminate in the threaded server
+                log.error("Error on client socket " + str(fd)
+                          + ", closing it: " + traceback.format_exc())
+                poller.unregister(fd)
+                del connections[fd]
+                try:
+                    connection.close()
+                except Exception:
+                    log.error("Error closing client socket " + str(fd) + ": "
+                              + traceback.format_exc())
+
+def select_listeners(server_sockets):
+    """Wait until one of the listening server_sockets has a connection
+    waiting, return that socket"""
+    while True:
+        try:
+            return select.select(server_sockets, [], [])[0][0]
+        except select.error, error:
+            if error.args[0] != errno.EINTR:
+                raise
+
 def audio_event_delivery(global_state):
     """Listens for events reported from audio server and send them
     to the appropriate clients"""
@@ -184,6 +300,13 @@ def join_audio_event_delivery_thread(thread):
     log.debug("Joining audio event delivery thread")
     thread.join()
 
+def log_cache_statistics(global_state):
+    log.info("Reply cache statistics: "
+             + str(ttsapi.server.reply_cache_statistics()))
+    if global_state.audio_cache != None:
+        log.info("Audio cache statistics: "
+                 + str(global_state.audio_cache.statistics()))
+
 def sigint_handler(signum, frame):
     log.info("SIGINT received, exitting")
     sys.exit(0)
@@ -221,6 +344,12 @@ def main():
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server_socket.bind(("", conf.port))
     server_socket.listen(conf.max_simultaneous_connections)
+    server_sockets = [server_socket]
+    if conf.socket_path:
+        server_sockets.append(
+            ttsapi.connection.unix_server_socket(conf.socket_path,
+                                                 conf.max_simultaneous_connections))
+        atexit.register(os.remove, conf.socket_path)
         
     # Redirect logging to logfile
     log.init_stage2(conf)
@@ -231,6 +360,7 @@ def main():
     log.info("Starting audio server")
     audio.port = conf.audio_port
     audio.host = conf.audio_host
+    audio.socket_path = conf.audio_socket_path or None
     audio.init(logger=log, config=conf)
 
     log.info("Starting audio event delivery thread")
@@ -240,13 +370,37 @@ def main():
     audio_event_delivery_thread.start()
     # Terminate and join this thread on exit()
     atexit.register(join_audio_event_delivery_thread, audio_event_delivery_thread)
-    
+
+    if conf.audio_cache_size > 0:
+        global_state.audio_cache = cache.AudioCache(conf.audio_cache_size)
+
+    log.info("Starting drivers")
+    global_state.driver_pool = pool.DriverPool(logger=log, configuration=conf,
+                                               global_state=global_state)
+    global_state.driver_pool.start()
+    # Terminate the drivers on exit(), after all clients are gone
+    atexit.register(global_state.driver_pool.quit)
+    atexit.register(log_cache_statistics, global_state)
+
+    if conf.prerender_keyboard and global_state.audio_cache != None:
+        global_state.prerenderers = prerender.Prerenderers(log)
+        # Joined before the drivers terminate
+        atexit.register(global_state.prerenderers.quit)
+
+    if conf.server_mode == 'events':
+        log.info("Serving all clients from a single event loop")
+        serve_clients_in_event_loop(server_sockets, global_state)
+        return
 
     log.info("Waiting for connections")
     atexit.register(join_terminated_client_threads)
     while True:
         log.info("Waiting for connections")
-        (client_socket, address) = server_socket.accept()
+        if len(server_sockets) > 1:
+            ready = select_listeners(server_sockets)
+        else:
+            ready = server_sockets[0]
+        (client_socket, address) = ready.accept()
 
         join_terminated_client_threads()
 
@@ -45,14 +45,17 @@ class Sleeper(object):
 
     def sleep(self, seconds):
         """Do what a sleeper most likes. Sleep for the given amount of seconds
-        (floating point number allowed), but stay reasonably alert so
-        that we can quickly wake up on self.interrupt()"""
+        (floating point number allowed, None means until interrupted), but
+        stay reasonably alert so that we can quickly wake up on
+        self.interrupt()"""
         
         sel = select.select([self._interruption_pipe[0]], [], [], seconds)
         self._lock.acquire()
         try:
             if len(sel[0]) != 0:
-                os.read(self._interruption_pipe[0], 1)
+                # Consume all interruptions requested so far, the
+                # caller recalculates its state only once anyway
+                os.read(self._interruption_pipe[0], 4096)
         finally:
             self._lock.release()
 
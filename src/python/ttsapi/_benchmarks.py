@@ -0,0 +1,462 @@
+#!/usr/bin/env python
+#
+# _benchmarks.py - Performance measurements of the TTS API library
+#
+# Copyright (C) 2008 Brailcom, o.p.s.
+#
+# This is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this package; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+
+"""Micro-benchmarks of the TTS API library. They don't need a running
+provider, everything goes through local socket pairs. Run
+
+    python -m ttsapi._benchmarks [options] [benchmark ...]
+
+When no benchmark is named, all of them are run."""
+
+import os
+import sys
+import time
+import tempfile
+import socket
+import threading
+import optparse
+
+import connection
+import server
+import client
+import retrieval
+
+MEGABYTE = 1024 * 1024
+
+def _report(name, count, unit, seconds):
+    if seconds > 0:
+        rate = count / seconds
+    else:
+        rate = float('inf')
+    print "%-40s %8d %s in %8.3f s  (%10.1f %s/s)" % (name, count, unit,
+                                                      seconds, rate, unit)
+
+def _socket_connection():
+    """Return a server side SocketConnection reading from a new
+    socket pair and the socket for writing to it"""
+    reading, writing = socket.socketpair()
+    conn = connection.SocketConnection(socket=reading, side='server')
+    return conn, writing
+
+def _send_in_thread(sock, chunks):
+    """Send all chunks through sock from a new thread, return the thread"""
+    def send():
+        for chunk in chunks:
+            sock.sendall(chunk)
+    sender = threading.Thread(target=send, name="Benchmark sender")
+    sender.start()
+    return sender
+
+def bench_lines(options):
+    """Read a long multi-line text (as in SAY TEXT) line by line"""
+    line = "x" * (options.line_length - 2) + "\r\n"
+    count = options.megabytes * MEGABYTE / len(line)
+    conn, writing = _socket_connection()
+    start = time.time()
+    sender = _send_in_thread(writing, [line * 1000] * (count / 1000))
+    for i in range(count / 1000 * 1000):
+        conn._read_line()
+    _report("text lines of %d bytes" % len(line), count / 1000 * 1000 * len(line)
+            / MEGABYTE, "MB", time.time() - start)
+    sender.join()
+    writing.close()
+
+def bench_single_line(options):
+    """Read one huge line arriving in many small pieces"""
+    piece = "x" * 1024
+    count = options.megabytes * MEGABYTE / len(piece)
+    conn, writing = _socket_connection()
+    start = time.time()
+    sender = _send_in_thread(writing, [piece] * count + ["\r\n"])
+    line = conn._read_line()
+    assert len(line) == count * len(piece) + 2
+    _report("one line in 1 KB pieces", len(line) / MEGABYTE, "MB",
+            time.time() - start)
+    sender.join()
+    writing.close()
+
+def bench_audio_blocks(options):
+    """Read audio blocks announced by a header line, as on the
+    audio retrieval socket"""
+    block = "\0" * options.block_size
+    count = options.megabytes * MEGABYTE / len(block)
+    header = "BLOCK %d\r\n" % len(block)
+    conn, writing = _socket_connection()
+    start = time.time()
+    sender = _send_in_thread(writing, [header + block + "\r\n"] * count)
+    for i in range(count):
+        length = int(conn._read_line().split()[1])
+        data = conn.read_data(length)
+        assert len(data) == length
+        conn._read_line()
+    _report("audio blocks of %d bytes" % len(block), count * len(block)
+            / MEGABYTE, "MB", time.time() - start)
+    sender.join()
+    writing.close()
+
+def bench_say_text(options):
+    """Receive SAY TEXT data of 1 MB and 10 MB on the server side
+    of a connection, as text with lines of --line-length characters"""
+    line = "x" * (options.line_length - 2) + "\r\n"
+    for megabytes in (1, 10):
+        text = line * (megabytes * MEGABYTE / len(line))
+        conn, writing = _socket_connection()
+        start = time.time()
+        conn.data_transfer_on()
+        sender = _send_in_thread(writing, [text + connection.Connection.END_OF_DATA])
+        while conn.receive_line() != ['.']:
+            pass
+        conn.data_transfer_off()
+        data = conn.get_data()
+        _report("SAY TEXT data of %d MB" % megabytes, len(data) / 1024,
+                "KB", time.time() - start)
+        assert data == text
+        sender.join()
+        writing.close()
+
+# Commands as sent by a screen reader during a short session of reading
+# and navigating, without the SAY TEXT data
+_COMMAND_MIX = [
+    "SET DRIVER espeak",
+    "SET relative RATE 20",
+    "SET relative PITCH -10",
+    "SET relative VOLUME 100",
+    "SET PUNCTUATION MODE some",
+    "SET CAPITAL LETTERS MODE icon",
+    "SAY KEY shift_a",
+    "CANCEL",
+    "SET relative RATE 40",
+    "SAY CHAR x",
+    "CANCEL",
+    "SET absolute PITCH 100",
+    "SAY ICON message",
+    "SET relative RATE 20",
+    "SAY KEY down",
+    "CANCEL",
+    "SET NUMBER GROUPING 3",
+    "SET AUDIO OUTPUT playback",
+    "DEFER",
+    "DISCARD 12",
+    ]
+
+class _NullLogger(object):
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+class _DummyProvider(object):
+    """Provider doing nothing, so that only the command dispatch is measured"""
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+def bench_dispatch(options):
+    """Replay a recorded mix of small commands through
+    server.TCPConnection.process_input"""
+    reading, writing = socket.socketpair()
+    conn = server.TCPConnection(provider=_DummyProvider(), logger=_NullLogger(),
+                                client_socket=reading)
+    count = options.commands * len(_COMMAND_MIX)
+    data = ("\r\n".join(_COMMAND_MIX) + "\r\n") * options.commands
+
+    # Read and throw away the replies
+    def drain():
+        while writing.recv(65536):
+            pass
+    drainer = threading.Thread(target=drain, name="Benchmark reply reader")
+    drainer.start()
+    sender = _send_in_thread(writing, [data])
+
+    start = time.time()
+    for i in range(count):
+        conn.process_input()
+    _report("dispatched commands", count, "cmd", time.time() - start)
+    sender.join()
+    writing.shutdown(socket.SHUT_WR)
+    reading.close()
+    drainer.join()
+
+def _serve_dummy_provider(socket_path=None):
+    """Start a server thread answering one client connection with
+    _DummyProvider, return its port. If socket_path is given, listen
+    on this Unix domain socket instead of TCP."""
+    if socket_path != None:
+        listening = connection.unix_server_socket(socket_path, 1)
+    else:
+        listening = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listening.bind(("127.0.0.1", 0))
+        listening.listen(1)
+    def serve():
+        client_socket, address = listening.accept()
+        listening.close()
+        conn = server.TCPConnection(provider=_DummyProvider(),
+                                    logger=_NullLogger(),
+                                    client_socket=client_socket)
+        try:
+            while True:
+                conn.process_input()
+        except server.ClientGone:
+            pass
+    server_thread = threading.Thread(target=serve, name="Benchmark server")
+    server_thread.setDaemon(True)
+    server_thread.start()
+    if socket_path != None:
+        return None
+    return listening.getsockname()[1]
+
+def _set_up_message(tts):
+    """Settings and a message as sent by a client before each message"""
+    tts.set_driver("espeak")
+    tts.set_rate(20)
+    tts.set_pitch(-10)
+    tts.set_volume(100)
+    tts.set_punctuation_mode('some')
+    tts.set_capital_letters_mode('icon')
+    tts.say_key("shift_a")
+
+def bench_pipeline(options):
+    """Latency of setting six parameters and sending a message,
+    sequentially and in one pipeline"""
+    count = options.commands / 10
+    tts = client.TCPConnection(port=_serve_dummy_provider(),
+                               logger=_NullLogger())
+
+    start = time.time()
+    for i in range(count):
+        _set_up_message(tts)
+    sequential = time.time() - start
+    _report("sequential message setup", count, "msg", sequential)
+
+    start = time.time()
+    for i in range(count):
+        tts.begin_pipeline()
+        _set_up_message(tts)
+        tts.end_pipeline()
+    pipelined = time.time() - start
+    _report("pipelined message setup", count, "msg", pipelined)
+    print "%-40s sequential %8.3f ms  pipelined %8.3f ms" % \
+        ("latency per message", 1000 * sequential / count,
+         1000 * pipelined / count)
+    tts.close()
+
+def _retrieval_block(message_id, block_number, data):
+    """Format a block of the audio retrieval protocol with a few events"""
+    return "BLOCK %d %d\r\n" % (message_id, block_number) \
+        + "PARAMETERS\r\ndata_format raw\r\ndata_length %d\r\n" % len(data) \
+        + "sample_rate 16000\r\nchannels 1\r\nEND OF PARAMETERS\r\n" \
+        + "EVENTS\r\n" \
+        + "word_start %d 1 0 0\r\n" % message_id \
+        + "index_mark %d \"mark\" 10 500\r\n" % message_id \
+        + "END OF EVENTS\r\n" \
+        + "DATA\r\n" + data + "END OF DATA\r\n"
+
+def bench_retrieval(options):
+    """Parse audio retrieval blocks of --block-size bytes arriving in
+    4 KB pieces. Reports the throughput and how long it takes from the
+    first piece of a block until the first audio is passed on."""
+    block = _retrieval_block(1, 0, "\0" * options.block_size)
+    pieces = [block[i:i+4096] for i in range(0, len(block), 4096)]
+    count = options.megabytes * MEGABYTE / options.block_size
+    first_audio = []
+    def on_events(message_id, events):
+        pass
+    def on_data(message_id, data, parameters):
+        if first_audio[-1] == None:
+            first_audio[-1] = time.time()
+    parser = retrieval.RetrievalParser(on_events, on_data)
+
+    first_audio_delays = []
+    start = time.time()
+    for i in range(count):
+        first_audio.append(None)
+        block_start = time.time()
+        for piece in pieces:
+            parser.feed(piece)
+        first_audio_delays.append(first_audio[-1] - block_start)
+    _report("retrieval blocks of %d bytes" % options.block_size,
+            count * options.block_size / MEGABYTE, "MB", time.time() - start)
+    print "%-40s avg %8.3f ms" % ("first audio of a block after",
+                                  1000 * sum(first_audio_delays) / count)
+
+def _connected_pair(family):
+    """Return two connected stream sockets of the given address family"""
+    listening = socket.socket(family, socket.SOCK_STREAM)
+    if family == socket.AF_UNIX:
+        address = tempfile.mktemp(prefix='ttsapi-benchmark-')
+    else:
+        address = ("127.0.0.1", 0)
+    listening.bind(address)
+    listening.listen(1)
+    writing = socket.socket(family, socket.SOCK_STREAM)
+    writing.connect(listening.getsockname())
+    reading, peer = listening.accept()
+    listening.close()
+    if family == socket.AF_UNIX:
+        os.remove(address)
+    return reading, writing
+
+def bench_transport(options):
+    """Compare TCP on the loopback with Unix domain sockets: round trip
+    latency of commands through client.TCPConnection and throughput
+    of audio blocks through SocketConnection"""
+    count = options.commands / 10
+    for name in ('TCP', 'Unix'):
+        if name == 'Unix':
+            socket_path = tempfile.mktemp(prefix='ttsapi-benchmark-')
+            _serve_dummy_provider(socket_path)
+            tts = client.TCPConnection(socket_path=socket_path,
+                                       logger=_NullLogger())
+        else:
+            tts = client.TCPConnection(port=_serve_dummy_provider(),
+                                       logger=_NullLogger())
+        start = time.time()
+        for i in range(count):
+            _set_up_message(tts)
+        elapsed = time.time() - start
+        print "%-40s %8.3f ms" % ("%s message setup latency" % name,
+                                  1000 * elapsed / count)
+        tts.close()
+        if name == 'Unix':
+            os.remove(socket_path)
+
+    block = "\0" * options.block_size
+    count = options.megabytes * MEGABYTE / len(block)
+    for name, family in (('TCP', socket.AF_INET), ('Unix', socket.AF_UNIX)):
+        reading, writing = _connected_pair(family)
+        conn = connection.SocketConnection(socket=reading, side='server')
+        buf = bytearray(len(block))
+        start = time.time()
+        sender = _send_in_thread(writing, [block] * count)
+        for i in range(count):
+            conn.readinto(buf)
+        _report("%s blocks of %d bytes" % (name, len(block)),
+                count * len(block) / MEGABYTE, "MB", time.time() - start)
+        sender.join()
+        writing.close()
+        reading.close()
+
+def _pipe_pair():
+    """Return (client, server) keyword arguments for TCPConnection
+    objects talking through two new pipes"""
+    commands_in, commands_out = os.pipe()
+    replies_in, replies_out = os.pipe()
+    return ({'method': 'pipe', 'pipe_in': os.fdopen(replies_in, 'r'),
+             'pipe_out': os.fdopen(commands_out, 'w')},
+            {'method': 'pipe', 'pipe_in': os.fdopen(commands_in, 'r'),
+             'pipe_out': os.fdopen(replies_out, 'w')})
+
+def _serve_in_thread(**arguments):
+    """Serve one client with _DummyProvider in a new thread"""
+    def serve():
+        conn = server.TCPConnection(provider=_DummyProvider(),
+                                    logger=_NullLogger(), **arguments)
+        try:
+            while True:
+                conn.process_input()
+        except server.ClientGone:
+            pass
+    server_thread = threading.Thread(target=serve, name="Benchmark server")
+    server_thread.setDaemon(True)
+    server_thread.start()
+
+def bench_shm(options):
+    """Compare pipes with shared memory: round trip latency of commands
+    through client.TCPConnection and throughput of text lines (as in
+    SAY TEXT) through the connections"""
+    count = options.commands / 10
+    for name in ('pipe', 'shm'):
+        if name == 'pipe':
+            client_arguments, server_arguments = _pipe_pair()
+            tts = client.TCPConnection(logger=_NullLogger(), **client_arguments)
+        else:
+            tts = client.TCPConnection(method='shm', logger=_NullLogger())
+            server_arguments = {'method': 'shm', 'memory_key': tts.key,
+                                'read_semaphore_key': tts.write_semaphore_key,
+                                'write_semaphore_key': tts.read_semaphore_key}
+        _serve_in_thread(**server_arguments)
+        start = time.time()
+        for i in range(count):
+            _set_up_message(tts)
+        elapsed = time.time() - start
+        print "%-40s %8.3f ms" % ("%s message setup latency" % name,
+                                  1000 * elapsed / count)
+        tts.close()
+
+    line = "x" * (options.line_length - 2) + "\r\n"
+    lines = options.megabytes * MEGABYTE / len(line)
+    for name in ('pipe', 'shm'):
+        if name == 'pipe':
+            reading, writing = os.pipe()
+            sending = connection.PipeConnection(pipe_in=None,
+                                                pipe_out=os.fdopen(writing, 'w'),
+                                                side='server')
+            receiving = connection.PipeConnection(pipe_in=os.fdopen(reading, 'r'),
+                                                  pipe_out=None, side='server')
+        else:
+            sending = connection.SHMConnection(side='client')
+            receiving = connection.SHMConnection(
+                side='server', memory_key=sending.key(),
+                read_semaphore_key=sending.write_semaphore_key(),
+                write_semaphore_key=sending.read_semaphore_key())
+        start = time.time()
+        sender = threading.Thread(target=sending._write, args=(line * lines,),
+                                  name="Benchmark sender")
+        sender.start()
+        for i in range(lines):
+            receiving._read_line()
+        _report("%s text lines of %d bytes" % (name, len(line)),
+                lines * len(line) / MEGABYTE, "MB", time.time() - start)
+        sender.join()
+        if name == 'shm':
+            # Let the client communication thread of sending finish
+            receiving.close()
+
+benchmarks = {
+    'dispatch': bench_dispatch,
+    'shm': bench_shm,
+    'transport': bench_transport,
+    'retrieval': bench_retrieval,
+    'pipeline': bench_pipeline,
+    'say_text': bench_say_text,
+    'lines': bench_lines,
+    'single_line': bench_single_line,
+    'audio_blocks': bench_audio_blocks,
+    }
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options] [benchmark ...]")
+    parser.add_option('-m', '--megabytes', dest='megabytes', type='int', default=16,
+                      help="Amount of data pushed through the connection")
+    parser.add_option('-l', '--line-length', dest='line_length', type='int',
+                      default=80, help="Length of text lines")
+    parser.add_option('-b', '--block-size', dest='block_size', type='int',
+                      default=32768, help="Size of audio blocks")
+    parser.add_option('-n', '--commands', dest='commands', type='int', default=5000,
+                      help="Number of times the command mix is replayed")
+    (options, args) = parser.parse_args()
+
+    for name in args or sorted(benchmarks.keys()):
+        if not benchmarks.has_key(name):
+            print "Unknown benchmark " + name
+            return 1
+        benchmarks[name](options)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
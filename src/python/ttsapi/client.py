@@ -46,7 +46,8 @@ d    available from
 
 
     def __init__ (self, method='socket', host='127.0.0.1', port=6567,
-                  pipe_in = sys.stdin, pipe_out = sys.stdout, logger=None):
+                  pipe_in = sys.stdin, pipe_out = sys.stdout, logger=None,
+                  socket_path=None):
         """Initialize the instance and connect to the server
 
         Arguments:
@@ -54,6 +55,8 @@ d    available from
         method -- either 'socket' or 'pipe'
         host -- server hostname or IP address as a string
         port -- server port as a number
+        socket_path -- path of the Unix domain socket of a server on the
+          same machine, used instead of host and port if given
           
         """
         assert method in ['socket', 'pipe', 'shm']
@@ -74,7 +77,8 @@ d    available from
             self.logger = logging.Logger('TTS API Information')
 
         if method == 'socket':
-            self._conn = connection.SocketConnection(host, port, logger=logger, provider=self)
+            self._conn = connection.SocketConnection(host, port, logger=logger, provider=self,
+                                                     socket_path=socket_path)
         elif method == 'pipe':
             self._conn = connection.PipeConnection(pipe_in, pipe_out, logger=logger, provider=self)
         elif method == 'shm':
@@ -83,6 +87,58 @@ d    available from
             self.key = self._conn.key()
             self.read_semaphore_key = self._conn.read_semaphore_key()
             self.write_semaphore_key = self._conn.write_semaphore_key()
+
+        # Requests queued since begin_pipeline() or None
+        self._pipeline = None
+
+    def _send_command(self, command, *args):
+        """Send a command whose reply carries no data. Between
+        begin_pipeline() and end_pipeline(), only queue it."""
+        if self._pipeline != None:
+            self._pipeline.append(self._conn.format_command(command, *args))
+        else:
+            self._conn.send_command(command, *args)
+
+    # Pipelining
+
+    def begin_pipeline(self):
+        """Start queueing commands instead of sending them one by one.
+
+        Until end_pipeline() is called, the commands which only change
+        settings or send messages (set_*, say_*, cancel, defer, discard)
+        are queued and return None. Commands returning information
+        (voices(), current_voice() etc.) are still sent immediately.
+        The pipeline belongs to the calling thread, don't use the
+        connection from other threads meanwhile."""
+        assert self._pipeline == None, "Pipeline already started"
+        self._pipeline = []
+
+    def end_pipeline(self, wait=True):
+        """Send all commands queued since begin_pipeline() at once.
+
+        Return a list of ttsapi.connection.PendingReply objects, one for
+        each request sent (say_text() sends two requests: the command and
+        the text), in order. If wait is True, wait for all the replies
+        first and raise TTSAPIError for the first error reply. The
+        message id of say_* commands is the first line of data of the
+        last reply for them."""
+        assert self._pipeline != None, "No pipeline started"
+        requests = self._pipeline
+        self._pipeline = None
+        if len(requests) == 0:
+            return []
+        replies = self._conn.send_pipelined(requests)
+        if wait:
+            error = None
+            for reply in replies:
+                try:
+                    reply.result()
+                except TTSAPIError, e:
+                    if error == None:
+                        error = e
+            if error != None:
+                raise error
+        return replies
             
     # Driver discovery
 
@@ -223,18 +279,24 @@ d    available from
 
         if (position == None and index_mark == None
             and character == None):
-            self._conn.send_command("SAY TEXT", format);
+            command = ("SAY TEXT", format)
         elif position != None:
             assert position_type != None
-            self._conn.send_command("SAY TEXT", format, "FROM POSITION",
-                                    str(position), position_type);
+            command = ("SAY TEXT", format, "FROM POSITION",
+                       str(position), position_type)
         elif index_mark != None:
-            self._conn.send_command("SAY TEXT", format, "FROM INDEX MARK",
-                                    '"'+index_mark+'"')
+            command = ("SAY TEXT", format, "FROM INDEX MARK",
+                       '"'+index_mark+'"')
         elif character != None:
-            self._conn.send_command("SAY TEXT", format, "FROM CHARACTER",
-                                    str(character))
-            
+            command = ("SAY TEXT", format, "FROM CHARACTER",
+                       str(character))
+
+        if self._pipeline != None:
+            self._pipeline.append(self._conn.format_command(*command))
+            self._pipeline.append(self._conn.format_data(text))
+            return None
+
+        self._conn.send_command(*command)
         code, msg, data = self._conn.send_data(text);
 
         if len(data) < 1 or not data[0].isdigit():
@@ -292,7 +354,7 @@ d    available from
         in TTS API          
         """
         assert isinstance(key, str)
-        self._conn.send_command("SAY KEY", key)
+        self._send_command("SAY KEY", key)
         
     def say_char (self, character):
         """Synthesize a character event.
@@ -301,7 +363,7 @@ d    available from
         character -- a single UTF-32 character.          
         """
         assert len(character) == 1
-        self._conn.send_command("SAY CHAR", character)
+        self._send_command("SAY CHAR", character)
         
     def say_icon (self, icon):
         """Synthesize a sound icon.
@@ -309,17 +371,17 @@ d    available from
         Arguments:
         icon -- name of the icon as defined in TTS API.          
         """
-        self._conn.send_command("SAY ICON", icon)
+        self._send_command("SAY ICON", icon)
         
     # Speech Controll commands
 
     def cancel (self):
         """Cancel current synthesis process and audio output."""
-        self._conn.send_command("CANCEL")
+        self._send_command("CANCEL")
         
     def defer (self):
         """Defer current message."""
-        self._conn.send_command("DEFER")
+        self._send_command("DEFER")
         
     def discard (self, message_id):
         """Discard a previously deferred message.
@@ -328,7 +390,7 @@ d    available from
         message_id -- unique identification of the message to discard          
         """
         assert isinstance(message_id, int)
-        self._conn.send_command("DISCARD", message_id)
+        self._send_command("DISCARD", message_id)
         
     # Parameter settings
 
@@ -341,12 +403,12 @@ d    available from
         driver_id -- id of the driver as returned by drivers()
         """
         assert isinstance(driver_id, str)
-        self._conn.send_command("SET DRIVER", driver_id)
+        self._send_command("SET DRIVER", driver_id)
 
     def set_message_id(self, message_id):
         """Set message identification number"""
         assert isinstance(message_id, int)
-        self._conn.send_command("SET MESSAGE ID", message_id)
+        self._send_command("SET MESSAGE ID", message_id)
         
     ## Voice selection
 
@@ -357,7 +419,7 @@ d    available from
         voice_name -- name of a voice as obtained by voices()          
         """
         assert isinstance(voice_name, str)
-        self._conn.send_command("SET VOICE BY NAME", '"'+voice_name+'"')
+        self._send_command("SET VOICE BY NAME", '"'+voice_name+'"')
         
     def set_voice_by_properties(self, voice_description, variant):
         """Choose and set a voice best matching the given description.
@@ -370,12 +432,12 @@ d    available from
         assert isinstance(voice_description, VoiceDescription)
         assert isinstance(variant, int)
 
-        self._conn.send_command("SET VOICE BY PROPERTIES",
-                                voice_description.language,
-                                '"'+voice_description.dialect+'"',
-                                voice_description.gender,
-                                voice_description.age,
-                                variant)        
+        self._send_command("SET VOICE BY PROPERTIES",
+                           voice_description.language,
+                           '"'+voice_description.dialect+'"',
+                           voice_description.gender,
+                           voice_description.age,
+                           variant)        
         
     def current_voice(self):
         """Return VoiceDescription of the current voice."""
@@ -402,7 +464,7 @@ d    available from
         method -- either 'relative' or 'absolute'          
         """
         assert isinstance(rate, int)
-        self._conn.send_command("SET", method, "RATE", rate)
+        self._send_command("SET", method, "RATE", rate)
         
     def default_absolute_rate(self):
         """Returns default absolute rate for the given voice
@@ -422,7 +484,7 @@ d    available from
         method -- either 'relative' or 'absolute'          
         """
         assert isinstance(pitch, int)
-        self._conn.send_command("SET", method, "PITCH", pitch)
+        self._send_command("SET", method, "PITCH", pitch)
         
     def default_absolute_pitch(self):
         """Returns default absolute pitch for the given voice
@@ -442,7 +504,7 @@ d    available from
         method -- either 'relative' or 'absolute'          
         """
         assert isinstance(range, int)
-        self._conn.send_command("SET", method,  "PITCH RANGE", range)
+        self._send_command("SET", method,  "PITCH RANGE", range)
         
     def set_volume(self, volume, method='relative'):
         """Set relative or absolute volume.
@@ -454,7 +516,7 @@ d    available from
         method -- either 'relative' or 'absolute'          
         """
         assert isinstance(volume, int)
-        self._conn.send_command("SET", method, "VOLUME", volume)
+        self._send_command("SET", method, "VOLUME", volume)
         
     def default_absolute_volume(self):
         """Returns default absolute volume for the given voice
@@ -474,7 +536,7 @@ d    available from
         mode -- one of 'none', 'all', 'some'          
         """
         assert mode in ('none', 'all', 'some')
-        self._conn.send_command("SET PUNCTUATION MODE", mode)
+        self._send_command("SET PUNCTUATION MODE", mode)
 
     def set_punctuation_detail(self, detail):
         """Set punctuation detail.
@@ -484,7 +546,7 @@ d    available from
         should be explicitly indicated by the synthesizer          
         """
         assert isinstance(detail, str)
-        self._conn.send_command("SET PUNCTUATION DETAIL", detail)
+        self._send_command("SET PUNCTUATION DETAIL", detail)
 
     def set_capital_letters_mode(self, mode):
         """Set mode for reading capital letters.
@@ -493,7 +555,7 @@ d    available from
         mode -- one of 'no', 'spelling', 'icon', 'pitch'          
         """
         assert mode in ('no', 'spelling', 'icon', 'pitch')
-        self._conn.send_command("SET CAPITAL LETTERS MODE", mode)
+        self._send_command("SET CAPITAL LETTERS MODE", mode)
 
     def set_number_grouping(self, grouping):
         """Set grouping of digits for reading numbers.
@@ -503,7 +565,7 @@ d    available from
         specifying how many digits should be read together          
         """
         assert isinstance(grouping, int)
-        self._conn.send_command("SET NUMBER GROUPING", grouping)
+        self._send_command("SET NUMBER GROUPING", grouping)
 
     # Dictionaries
     
@@ -523,7 +585,7 @@ d    available from
 
         if method != self.current_audio_output_method:
             self.current_audio_output_method = method
-            self._conn.send_command("SET AUDIO OUTPUT", method)
+            self._send_command("SET AUDIO OUTPUT", method)
 
     def set_audio_retrieval_destination(self, host, port):
         """Set destination for audio retrieval socket.
@@ -531,16 +593,18 @@ d    available from
         Arguments:
         host -- IP address of the host machine as a string
         containing groups of three digits separated by a dot
-        port -- a positive number specifying the host port          
+        or path of a Unix domain socket (starting with '/')
+        port -- a positive number specifying the host port
+        (ignored for Unix domain sockets)
         """
         assert isinstance(host, str)
-        assert isinstance(port, int) and port > 0
+        assert isinstance(port, int) and (port > 0 or host.startswith('/'))
 
         if ((host != self.current_audio_retrieval_host) 
             or (port != self.current_audio_retrieval_port)):
             self.current_audio_retrieval_port = port
             self.current_audio_retrieval_host = host
-            self._conn.send_command("SET AUDIO RETRIEVAL", host, port)
+            self._send_command("SET AUDIO RETRIEVAL", host, port)
 
     # Callbacks
     
@@ -600,17 +664,17 @@ d    available from
                 event.pos_audio = int(line[3])
         elif event.type in ['sentence_start', 'sentence_end', 'word_start', 'word_end']:
             if line[2] != 'None':
-                event.n = int(line[1])
+                event.n = int(line[2])
             if line[3] != 'None':
-                event.pos_text = int(line[2])
+                event.pos_text = int(line[3])
             if line[4] != 'None':
-                event.pos_audio = int(line[3])
+                event.pos_audio = int(line[4])
         elif event.type == 'index_mark':
-            name = line[1].strip('"')
-            if line[2] != 'None':
-                event.pos_text = int(line[1])
+            event.name = line[2].strip('"')
             if line[3] != 'None':
-                event.pos_audio = int(line[2])
+                event.pos_text = int(line[3])
+            if line[4] != 'None':
+                event.pos_audio = int(line[4])
         else:
             raise "Unknown index mark"
 
@@ -622,6 +686,13 @@ d    available from
                     callback(event)
                 except Exception, e:
                     traceback.print_exc()
+
+    def reply_statistics(self):
+        """Return a dictionary with statistics of the queue of replies
+        received from the server: current and maximal depth and the time
+        spent waiting for replies (see connection.ReplyChannel)"""
+        return self._conn.reply_statistics()
+
     def close(self):
         """Close this connection"""
         self._conn.close()
@@ -24,11 +24,13 @@
 
 import socket as socket_
 import shm_wrapper
+import struct
 import string
 import time
 import sys
 import os
 from copy import copy
+from collections import deque
 
 try:
     import threading
@@ -75,6 +77,126 @@ def _nil_to_None(str):
     else:
         return str
 
+class PendingReply(object):
+    """Reply to a command which was already sent but maybe not yet
+    answered, as returned by Connection.send_pipelined()"""
+
+    def __init__(self, connection, command):
+        self._connection = connection
+        self.command = command
+        self._reply = None
+        self._done = False
+
+    def done(self):
+        """Return True if the reply was already received"""
+        return self._done
+
+    def result(self):
+        """Wait for the reply and return the triplet (code, msg, data)
+        where data is a tuple of the reply lines. Raise TTSAPIError in
+        case of an error reply (non 2xx code)."""
+        self._connection._resolve(self)
+        code, msg, data = self._reply
+        if code/100 != 2:
+            raise TTSAPIError(code, msg, self.command)
+        return code, msg, data
+
+class ReplyChannel(object):
+    """Bounded FIFO queue passing replies from the communication thread
+    to the threads waiting for them.
+
+    When the queue is full, put() blocks until a reply is taken out.
+    After close(), waiting in get() raises ConnectionLost. The channel
+    keeps statistics about its depth and the time spent waiting for
+    replies, see statistics()."""
+
+    def __init__(self, max_size=1024):
+        self._replies = deque()
+        self._max_size = max_size
+        self._condition = threading.Condition(threading.Lock())
+        self._closed = False
+        # Statistics
+        self._max_depth = 0
+        self._waits = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    def put(self, reply):
+        """Append reply to the queue, wait while the queue is full"""
+        self._condition.acquire()
+        try:
+            while len(self._replies) >= self._max_size and not self._closed:
+                self._condition.wait()
+            if self._closed:
+                return
+            self._replies.append(reply)
+            if len(self._replies) > self._max_depth:
+                self._max_depth = len(self._replies)
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
+    def get(self, timeout=None):
+        """Remove and return the first reply, waiting for it at most
+        timeout seconds (None means no limit). Raise ReplyTimeout when
+        the time runs out and ConnectionLost when the channel is closed."""
+        self._condition.acquire()
+        try:
+            start = time.time()
+            while len(self._replies) == 0:
+                if self._closed:
+                    raise ConnectionLost
+                if timeout == None:
+                    self._condition.wait()
+                else:
+                    remaining = start + timeout - time.time()
+                    if remaining <= 0:
+                        raise ReplyTimeout
+                    self._condition.wait(remaining)
+            reply = self._replies.popleft()
+            waited = time.time() - start
+            self._waits += 1
+            self._total_wait += waited
+            if waited > self._max_wait:
+                self._max_wait = waited
+            # Wake up put() waiting for free space
+            self._condition.notifyAll()
+            return reply
+        finally:
+            self._condition.release()
+
+    def close(self):
+        """Mark the connection as lost and wake up all waiting threads"""
+        self._condition.acquire()
+        try:
+            self._closed = True
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
+    def depth(self):
+        """Return the number of replies waiting in the queue"""
+        return len(self._replies)
+
+    def statistics(self):
+        """Return a dictionary with the current and maximal depth of the
+        queue, the number of replies taken out and the total, average and
+        maximal time in seconds spent waiting for them"""
+        self._condition.acquire()
+        try:
+            if self._waits > 0:
+                average_wait = self._total_wait / self._waits
+            else:
+                average_wait = 0.0
+            return {'depth': len(self._replies),
+                    'max_depth': self._max_depth,
+                    'waits': self._waits,
+                    'total_wait': self._total_wait,
+                    'average_wait': average_wait,
+                    'max_wait': self._max_wait}
+        finally:
+            self._condition.release()
+
 class Connection(object):
     NEWLINE = "\r\n"
     """New line delimiter """
@@ -97,10 +219,21 @@ class Connection(object):
     END_OF_DATA_ESCAPED = NEWLINE + END_OF_DATA_ESCAPED_SINGLE + NEWLINE
     "Escaping for END_OF_DATA"    
 
+    REPLY_QUEUE_SIZE = 1024
+    "Maximal number of received replies nobody asked for yet"
+
+    reply_timeout = None
+    "Time in seconds to wait for a reply or None for no limit"
+
+    max_data_size = None
+    "Maximal size of data received in one data transfer or None for no limit"
+
 
     def __init__ (self, logger=None, side='client', provider=None):
         self._data_transfer = False
-        self._server_side_buf = ''
+        self._server_side_chunks = []
+        self._server_side_size = 0
+        self._server_side_too_large = False
         self.logger = logger
         self.provider = provider
 
@@ -108,8 +241,12 @@ class Connection(object):
         self._side = side
 
         if side == 'client':
-            self._com_buffer = []
-            self._reply_semaphore = threading.Semaphore(0)
+            # Commands sent and not yet answered (PendingReply objects)
+            # in the order in which they were sent
+            self._pending = deque()
+            self._request_lock = threading.Lock()
+            self._resolve_lock = threading.Lock()
+            self._replies = ReplyChannel(self.REPLY_QUEUE_SIZE)
             self._communication_thread = \
                 threading.Thread(target=self._communication, kwargs={},
                                  name="Client communication thread")
@@ -119,10 +256,8 @@ class Connection(object):
         """Handle incomming socket communication.
 
         Listens for all incomming communication on the socket, dispatches
-        events and puts all other replies into self._com_buffer list in the
-        already parsed form as (code, msg, data).  Each time a new item is
-        appended to the _com_buffer list, the corresponding semaphore
-        'self._reply_semaphore' is incremented.
+        events and puts all other replies into the self._replies channel in
+        the already parsed form as (code, msg, data).
 
         This method is designed to run in a separate thread.  The thread can be
         interrupted by closing the socket on which it is listening for
@@ -132,12 +267,13 @@ class Connection(object):
             try:
                 code, msg, data = self._recv_message()
             except IOError:
-                # If the socket has been closed, exit the thread
-                sys.exit()
+                # If the socket has been closed, wake up everybody
+                # waiting for a reply and exit the thread
+                self._replies.close()
+                return
             if code/100 != 7:
                 # This is not an index mark nor an event
-                self._com_buffer.append((code, msg, data))
-                self._reply_semaphore.release()
+                self._replies.put((code, msg, data))
                 continue
             else: # code of type 7**
                 # This is an event
@@ -167,16 +303,15 @@ class Connection(object):
 
     def _recv_response(self):
         """Read server response from the communication thread
-        and return the triplet (code, msg, data)."""
-        # TODO: This check is dumb but seems to work.  The main thread
-        # hangs without it, when the Speech Dispatcher connection is lost.
-        if not self._communication_thread.isAlive():
-            raise "Communication error"
-        self._reply_semaphore.acquire()
-        # The list is sorted, read the first item
-        response = self._com_buffer[0]
-        del self._com_buffer[0]
-        return response
+        and return the triplet (code, msg, data). Raise ConnectionLost
+        if the connection is closed, ReplyTimeout if the reply doesn't
+        arrive within reply_timeout seconds."""
+        return self._replies.get(self.reply_timeout)
+
+    def reply_statistics(self):
+        """Return statistics of the reply queue, see
+        ReplyChannel.statistics()"""
+        return self._replies.statistics()
 
     def _read_line(self):
         """Read one whole line from the communication channel.
@@ -206,6 +341,57 @@ class Connection(object):
         raise NotImplementedError
     
 
+    def format_command(self, command, *args):
+        """Return command with the given arguments as a line
+        ready to be sent"""
+        return str.join(' ', [command,] + map(self._arg_to_str, args)) \
+            + self.NEWLINE
+
+    def format_data(self, data):
+        """Return multiline data escaped and terminated
+        by the end of data marker, ready to be sent"""
+        # Escape the end-of-data sequence even if presented on the beginning
+        if data[0:3] == self.END_OF_DATA_BEGIN:
+            data = self.END_OF_DATA_ESCAPED_BEGIN + data[3:]
+
+        if (len(data) == 1) and (data[0] == '.'):
+            data = self.END_OF_DATA_ESCAPED_SINGLE
+
+        data = string.replace(data, self.END_OF_DATA, self.END_OF_DATA_ESCAPED)
+        return data + self.END_OF_DATA
+
+    def send_pipelined(self, requests):
+        """Send several requests at once without waiting for replies.
+
+        requests -- list of strings as returned by format_command() and
+        format_data(), each of them must be answered by one reply
+
+        All requests are written together. Return a list of PendingReply
+        objects, one for each request in the same order."""
+        replies = [PendingReply(self, request) for request in requests]
+        # The order of replies in self._pending must be the same
+        # as the order of requests on the connection
+        self._request_lock.acquire()
+        try:
+            self._pending.extend(replies)
+            self._write(''.join(requests))
+        finally:
+            self._request_lock.release()
+        return replies
+
+    def _resolve(self, pending):
+        """Read replies and assign them to the pending requests in order
+        until the reply for pending arrives"""
+        self._resolve_lock.acquire()
+        try:
+            while not pending._done:
+                reply = self._recv_response()
+                first = self._pending.popleft()
+                first._reply = reply
+                first._done = True
+        finally:
+            self._resolve_lock.release()
+
     def send_command (self, command, *args):
         """Send command with given arguments and read server response.
 
@@ -221,19 +407,13 @@ class Connection(object):
         
         """        
 
-        cmd = str.join(' ', [command,] + map(self._arg_to_str, args)) \
-            + self.NEWLINE
-        self._write(cmd)
-        code, msg, data = self._recv_response()
-        if code/100 != 2:
-            raise TTSAPIError(code, msg, cmd)
+        cmd = self.format_command(command, *args)
+        code, msg, data = self.send_pipelined([cmd])[0].result()
         return code, msg, parse_list(data)
 
     def send_command_without_reply(self, command, *args):
         """Send command but do not wait for reply, see send_command()"""
-        cmd = str.join(' ', [command,] + map(self._arg_to_str, args)) \
-              + self.NEWLINE
-        self._write(cmd)
+        self._write(self.format_command(command, *args))
 
     def send_reply(self, code, text, args = None):
         """Send reply to the client
@@ -266,32 +446,53 @@ class Connection(object):
 
         data = self._read_line()
         
-        self.logger.debug("receive_line: received" + str(data))
+        if self.logger:
+            self.logger.debug("receive_line: received %s", data)
         
         if not self._data_transfer:
             # TODO: Doublequotes            
             return data.rstrip(self.NEWLINE).split(' ')
         else:
             if (data == '.'+self.NEWLINE) or (data == '.'):
-                _server_side_buf = self._server_side_buf.rstrip(self.NEWLINE)
                 return ['.']
-            elif data[:2] == '..':
-                self._server_side_buf += '.' + self.NEWLINE
-            else:
-                self._server_side_buf += data + self.NEWLINE
+            if self._server_side_too_large:
+                # Drain the rest of the message
+                return None
+            if data == self.END_OF_DATA_ESCAPED_BEGIN:
+                data = self.END_OF_DATA_BEGIN
+            self._server_side_size += len(data)
+            if self.max_data_size and self._server_side_size > self.max_data_size:
+                if self.logger:
+                    self.logger.info("Data larger than %d bytes received, "
+                                     "discarding them", self.max_data_size)
+                self._server_side_chunks = []
+                self._server_side_too_large = True
                 return None
+            self._server_side_chunks.append(data)
+            return None
 
     def data_transfer_on(self):
         assert self._data_transfer == False
         self._data_transfer = True
-        self._server_side_buf = ''
+        self._server_side_chunks = []
+        self._server_side_size = 0
+        self._server_side_too_large = False
 
     def data_transfer_off(self):
         assert self._data_transfer == True
         self._data_transfer = False
 
     def get_data(self):
-        return self._server_side_buf
+        """Return the data received during the last data transfer.
+        Raise ErrorMessageTooLarge if they exceeded max_data_size."""
+        if self._server_side_too_large:
+            raise ErrorMessageTooLarge
+        data = ''.join(self._server_side_chunks)
+        self._server_side_chunks = []
+        # The last newline belongs to the end of data marker
+        if data.endswith(self.NEWLINE):
+            data = data[:-len(self.NEWLINE)]
+        return data
         
 
     def send_data (self, data):
@@ -300,20 +501,7 @@ class Connection(object):
         Returned value is the same as for 'send_command()' method.
 
         """
-
-        # Escape the end-of-data sequence even if presented on the beginning
-        if data[0:3] == self.END_OF_DATA_BEGIN:
-            data = self.END_OF_DATA_ESCAPED_BEGIN + data[3:]
-
-        if (len(data) == 1) and (data[0] == '.'):
-            data = self.END_OF_DATA_ESCAPED_SINGLE
-
-        data = string.replace(data, self.END_OF_DATA, self.END_OF_DATA_ESCAPED)
-        self._write(data + self.END_OF_DATA)
-        code, msg, rep_data = self._recv_response()
-        if code/100 != 2:
-            raise TTSAPIError(code, msg, data)
-        return code, msg, rep_data
+        return self.send_pipelined([self.format_data(data)])[0].result()
 
     def close (self):
         """Close the connection."""
@@ -322,20 +510,56 @@ class Connection(object):
         if self._side == 'client':
             self._communication_thread.join()
 
+def unix_server_socket(path, backlog):
+    """Return a socket listening on the Unix domain socket path.
+    A socket file left there by a previous process is replaced."""
+    if os.path.exists(path):
+        probe = socket_.socket(socket_.AF_UNIX, socket_.SOCK_STREAM)
+        try:
+            try:
+                probe.connect(path)
+            except socket_.error:
+                # Nobody is listening there any more
+                os.remove(path)
+            else:
+                raise IOError("Unix socket " + path + " already in use")
+        finally:
+            probe.close()
+    server_socket = socket_.socket(socket_.AF_UNIX, socket_.SOCK_STREAM)
+    server_socket.bind(path)
+    server_socket.listen(backlog)
+    return server_socket
+
 class SocketConnection(Connection):
 
-    _buffer = ''
+    # Maximal amount of data received from the socket at once
+    RECEIVE_SIZE = 65536
+
     _data_transfer = False
 
     def __init__(self, host="127.0.0.1", port=6567, socket=None, logger=None,
-                 provider=None, side='client'):
-        """Init a connection to the server"""
+                 provider=None, side='client', socket_path=None):
+        """Init a connection to the server on host and port or, if
+        socket_path is given, on the Unix domain socket socket_path"""
 
         #self.logger = logger
 
         self._lock = thread.allocate_lock()
+
+        # Received data. Everything before _consumed was already
+        # returned to the caller, there is no NEWLINE between _consumed
+        # and _searched.
+        self._buffer = bytearray()
+        self._consumed = 0
+        self._searched = 0
+        self._chunk = bytearray(self.RECEIVE_SIZE)
         
-        if socket is None:
+        if socket is None and socket_path != None:
+            if logger:
+                logger.debug("Opening new Unix socket")
+            self._socket = socket_.socket(socket_.AF_UNIX, socket_.SOCK_STREAM)
+            self._socket.connect(socket_path)
+        elif socket is None:
             if logger:
                 logger.debug("Opening new socket")
             self._socket = socket_.socket(socket_.AF_INET, socket_.SOCK_STREAM)
@@ -346,9 +570,48 @@ class SocketConnection(Connection):
             if logger:
                 logger.debug("Using existing socket")
             self._socket = socket
+            # Several replies may be written in a row (e.g. to pipelined
+            # requests), they must not wait for acknowledgement of the
+            # previous ones
+            try:
+                self._socket.setsockopt(socket_.SOL_TCP, socket_.TCP_NODELAY, 1)
+            except socket_.error:
+                # Not a TCP socket
+                pass
 
         Connection.__init__(self, logger=logger, side=side, provider=provider)
 
+    def _fill(self):
+        """Receive data waiting on the socket (at most RECEIVE_SIZE bytes)
+        and append it to the buffer. Blocks if no data is waiting.
+        Raises IOError if the connection was closed."""
+        # Drop the consumed data once it makes up most of the buffer
+        # so that the buffer doesn't grow and the copying stays linear
+        if self._consumed > 0 and self._consumed * 2 >= len(self._buffer):
+            del self._buffer[:self._consumed]
+            self._searched -= self._consumed
+            self._consumed = 0
+        try:
+            received = self._socket.recv_into(self._chunk)
+        except socket_.error:
+            raise IOError
+        # WARNING: I don't know if this is correct, python library
+        # documentation is unclear here, but it seems to work
+        if received == 0:
+            raise IOError
+        self._buffer += memoryview(self._chunk)[:received]
+
+    def _find_newline(self):
+        """Return the position of the first NEWLINE in the unconsumed
+        part of the buffer or -1. Parts already searched are not
+        searched again."""
+        pointer = self._buffer.find(self.NEWLINE, self._searched)
+        if pointer == -1:
+            # The delimiter may be split between this and the next read
+            self._searched = max(self._consumed,
+                                 len(self._buffer) - len(self.NEWLINE) + 1)
+        return pointer
+
     def _read_line(self):
         """Read one whole line from the socket.
         
@@ -356,53 +619,62 @@ class SocketConnection(Connection):
         `NEWLINE' constant).  Blocks until the delimiter is read.
         
         """
-        pointer = self._buffer.find(self.NEWLINE)
+        pointer = self._find_newline()
         while pointer == -1:
-            try:
-                res = self._socket.recv(1024)
-            except socket_.error:
-                raise IOError
-            # WARNING: I don't know if this is correct, python library
-            # documentation is unclear here, but it seems to work
-            if len(res) == 0:
-                raise IOError
-            self._buffer += res
-            pointer = self._buffer.find(self.NEWLINE)
-        assert pointer >= 0
-        line = self._buffer[:(pointer+len(self.NEWLINE))]
-        self._buffer = self._buffer[pointer+len(self.NEWLINE):]
+            self._fill()
+            pointer = self._find_newline()
+        assert pointer >= self._consumed
+        end = pointer + len(self.NEWLINE)
+        line = str(buffer(self._buffer, self._consumed, end - self._consumed))
+        self._consumed = end
+        self._searched = end
         if self.logger:
             self.logger.debug("Received over socket: |%s|",  line)
 
         assert len(line) > 0
         return line
 
+    def receive_available(self):
+        """Read the data currently waiting on the socket into the buffer.
+
+        Unlike _read_line(), this doesn't wait for a whole line to arrive.
+        It is meant to be called when select() or poll() reported the socket
+        as readable, in which case it doesn't block at all.  Raises IOError
+        if the connection was closed."""
+        self._fill()
+
+    def line_available(self):
+        """Return True if a whole line is waiting in the buffer"""
+        return self._find_newline() != -1
+
+    def readinto(self, buf):
+        """Read exactly len(buf) bytes into the writable buffer buf
+        (e.g. a bytearray). Data already waiting in the internal
+        buffer are used first, the rest is received directly into buf.
+        Return the number of bytes read."""
+        view = memoryview(buf)
+        size = len(view)
+        available = min(len(self._buffer) - self._consumed, size)
+        if available > 0:
+            view[:available] = \
+                memoryview(self._buffer)[self._consumed:self._consumed+available]
+            self._consumed += available
+            self._searched = max(self._searched, self._consumed)
+        received = available
+        while received < size:
+            try:
+                count = self._socket.recv_into(view[received:], size - received)
+            except socket_.error:
+                raise IOError
+            if count == 0:
+                raise IOError
+            received += count
+        return size
+
     def read_data(self, bytes):
-        """Read the specified amount of data"""
-        if bytes > len(self._buffer):
-            # First read data from buffer
-            result  = self._buffer
-            bytes_to_read = bytes-len(self._buffer)
-            self._buffer = ""
-            # Calculate how much more data do we have to read
-        else:
-            # Data waiting in buffer is larger than what
-            # we actually want to read now
-            result = copy(self._buffer[:bytes])
-            # Strip the already read data from buffer
-            self._buffer = self._buffer[bytes:]
-            bytes_to_read = 0
-
-        while bytes_to_read > 4096:
-            data = self._socket.recv(4096)
-            result += data
-            bytes_to_read -= len(data) 
-        
-        while bytes_to_read > 0:
-            data = self._socket.recv(bytes_to_read)
-            result += data
-            bytes_to_read -= len(data) 
-        
+        """Read the specified amount of data, return it as a bytearray"""
+        result = bytearray(bytes)
+        self.readinto(result)
         return result
 
     def _write(self, data):
@@ -414,7 +686,8 @@ class SocketConnection(Connection):
         try:
             self._lock.acquire()
             try:
-                self._socket.send(data)
+                # Pipelined requests may not fit into a single send()
+                self._socket.sendall(data)
             except:
                 raise IOError
             # WARNING: Seems not to bee needed, but may be cause
@@ -497,11 +770,33 @@ class PipeConnection(Connection):
         Connection.close(self)
 
 class SHMConnection(Connection):
-    """Connection through shared memmory"""
+    """Connection through shared memory.
+
+    The client creates a shared memory segment with two rings, one for
+    each direction, and two semaphores for each ring. Each ring has a
+    header with the head and tail indices (the numbers of slots written
+    and read so far) and the key of its free slots semaphore, followed by
+    SLOTS slots of SLOT_SIZE bytes. Every slot holds one record, the length
+    of its data followed by the data, longer writes take several slots.
+    One semaphore of a ring counts the records written and not read yet,
+    the other one its free slots, so the reader only blocks when the ring
+    is empty and the writer only blocks when it is full, until one slot
+    is read. A record without data marks the end of the connection.
+
+    Only the keys of the memory and of the records semaphores are passed
+    to the server, it finds the free slots semaphores in the headers."""
     
     NEWLINE = "\r\n"
 
-    _buffer = ''
+    # Number of slots in each ring and size of a slot in bytes
+    SLOTS = 32
+    SLOT_SIZE = 4096
+
+    _RING_HEADER = struct.Struct('!QQq')
+    _INDEX = struct.Struct('!Q')
+    _KEY = struct.Struct('!q')
+    _RECORD_HEADER = struct.Struct('!I')
+
     _data_transfer = False
 
     def __init__(self, logger=None, side='client',
@@ -509,91 +804,158 @@ class SHMConnection(Connection):
                  read_semaphore_key=None,
                  write_semaphore_key=None,
                  provider = None):
-        """Setup pipes for communication
-        """
+        """Create the shared memory and semaphores (client side) or
+        attach to the ones created by the client (server side). The server
+        side gets the client's write semaphore as its read semaphore and
+        vice versa."""
         assert ((side == 'client') 
                 or ((memory_key != None) and (read_semaphore_key != None)
                     and (write_semaphore_key != None)))
 
+        self._ring_size = self._RING_HEADER.size + self.SLOTS * self.SLOT_SIZE
         if side == 'client':
-            self.memory_handle = shm_wrapper.create_memory(16384)
+            self.memory_handle = shm_wrapper.create_memory(2 * self._ring_size)
             self.read_semaphore = shm_wrapper.create_semaphore(InitialValue=0)
             self.write_semaphore = shm_wrapper.create_semaphore(InitialValue=0)
+            # The client writes into the first ring and reads from the second
+            self._write_ring = 0
+            self._read_ring = self._ring_size
+            self._write_free = shm_wrapper.create_semaphore(InitialValue=self.SLOTS)
+            self._read_free = shm_wrapper.create_semaphore(InitialValue=self.SLOTS)
+            # Both rings start empty
+            for ring, free in ((self._write_ring, self._write_free),
+                               (self._read_ring, self._read_free)):
+                self.memory_handle.write(self._RING_HEADER.pack(0, 0, free.key),
+                                         ring)
         if side == 'server':
             self.memory_handle = shm_wrapper.SharedMemoryHandle(memory_key)
             self.read_semaphore = shm_wrapper.SemaphoreHandle(read_semaphore_key)
             self.write_semaphore = shm_wrapper.SemaphoreHandle(write_semaphore_key)
+            self._write_ring = self._ring_size
+            self._read_ring = 0
+            self._write_free = shm_wrapper.SemaphoreHandle(
+                self._free_semaphore_key(self._write_ring))
+            self._read_free = shm_wrapper.SemaphoreHandle(
+                self._free_semaphore_key(self._read_ring))
+
+        # Number of slots written into the write ring and read from
+        # the read ring so far
+        self._head = 0
+        self._tail = 0
+        self._lock = thread.allocate_lock()
+        self._closed = False
+        # Received data. Everything before _consumed was already
+        # returned to the caller, there is no NEWLINE between _consumed
+        # and _searched.
+        self._buffer = bytearray()
+        self._consumed = 0
+        self._searched = 0
             
         self.side = side
         Connection.__init__(self, logger=logger, side=side, provider=provider)
 
     def _read_line(self):
-        """Read one whole line from the socket.
+        """Read one whole line from the shared memory.
         
-        Read from the socket until the newline delimeter (given by the
+        Read until the newline delimeter (given by the
         `NEWLINE' constant).  Blocks until the delimiter is read.
         
         """
-        pointer = self._buffer.find(self.NEWLINE)
+        pointer = self._buffer.find(self.NEWLINE, self._searched)
         while pointer == -1:
             res = self._recv()
             if len(res) == 0:
                 raise IOError
+            # Drop the consumed data once it makes up most of the buffer
+            # so that the buffer doesn't grow and the copying stays linear
+            if self._consumed > 0 and self._consumed * 2 >= len(self._buffer):
+                del self._buffer[:self._consumed]
+                self._searched -= self._consumed
+                self._consumed = 0
+            # The delimiter may be split between two records
+            self._searched = max(self._consumed,
+                                 len(self._buffer) - len(self.NEWLINE) + 1)
             self._buffer += res
-            pointer = self._buffer.find(self.NEWLINE)
-        assert pointer >= 0
-        line = self._buffer[:(pointer+len(self.NEWLINE))]
-        self._buffer = self._buffer[pointer+len(self.NEWLINE):]
+            pointer = self._buffer.find(self.NEWLINE, self._searched)
+        assert pointer >= self._consumed
+        end = pointer + len(self.NEWLINE)
+        line = str(buffer(self._buffer, self._consumed, end - self._consumed))
+        self._consumed = end
+        self._searched = end
         if self.logger:
             self.logger.debug("Line read from shared memory buffer: ||%s||",  line)
 
         assert len(line) > 0
         return line
 
+    def _free_semaphore_key(self, ring):
+        """Return the key of the free slots semaphore of ring"""
+        return self._KEY.unpack(self.memory_handle.read(
+                self._KEY.size, ring + 2 * self._INDEX.size))[0]
+
+    def _write_record(self, data):
+        """Write one record with data into the next slot of the write
+        ring, wait while the ring is full until a slot is read"""
+        self._write_free.P()
+        slot = self._write_ring + self._RING_HEADER.size \
+            + (self._head % self.SLOTS) * self.SLOT_SIZE
+        self.memory_handle.write(self._RECORD_HEADER.pack(len(data)) + data, slot)
+        self._head += 1
+        self.memory_handle.write(self._INDEX.pack(self._head), self._write_ring)
+        self.write_semaphore.V()
+
     def _write(self, data):
         """Write data to output.
 
         data -- contains the data to be written including the
         necessary newlines and carriage return characters."""
 
-        bytes_to_write = len(data)
-
+        if len(data) == 0:
+            return
+        step = self.SLOT_SIZE - self._RECORD_HEADER.size
+        self._lock.acquire()
         try:
-            while bytes_to_write > 0:
-                self.write_semaphore.Z() # Wait for the semaphore to become zero (channel clear)
-                
-                # Write this data    
-                self.memory_handle.write(
-                    data[:self.memory_handle.size] + (self.memory_handle.size - len(data)) * ' ')
-                    
-                # If not all data was written, continue
-                bytes_to_write -= self.memory_handle.size
-                if bytes_to_write > 0:
-                    data = data[bytes_to_write:]
-            
-                if self.logger: 
-                    self.logger.debug("Sent over shared memory: |%s|",  data)
-
-                self.write_semaphore.V() # Increment the semaphore (0->1)
-                self.write_semaphore.V() # Increment the semaphore second time (1->2)
+            if self._closed:
+                raise IOError
+            for start in range(0, len(data), step):
+                self._write_record(data[start:start+step])
+            if self.logger: 
+                self.logger.debug("Sent over shared memory: |%s|",  data)
         finally:
-            pass
+            self._lock.release()
 
     def _recv(self):
-        """Receive data into buffer"""
-        data = ""
-        self.read_semaphore.P() # Wait until semaphore becomes non-zero and decrement (2 -> 1)
-        while not len(data):
-            data = self.memory_handle.read(self.memory_handle.size).strip(' ')
+        """Receive the data of the next record, wait while
+        the read ring is empty"""
+        self.read_semaphore.P()
+        slot = self._read_ring + self._RING_HEADER.size \
+            + (self._tail % self.SLOTS) * self.SLOT_SIZE
+        length = self._RECORD_HEADER.unpack(
+            self.memory_handle.read(self._RECORD_HEADER.size, slot))[0]
+        if length > 0:
+            data = self.memory_handle.read(length, slot + self._RECORD_HEADER.size)
+        else:
+            data = ''
+        # The slot may be written again now
+        self._tail += 1
+        self.memory_handle.write(self._INDEX.pack(self._tail),
+                                 self._read_ring + self._INDEX.size)
+        self._read_free.V()
         if self.logger:
             self.logger.debug("Received over shared memmory: |%s|", data)
-        self.read_semaphore.P() # Decrement (1->0) to signalize we have read the data
-        # Now the channel is clear again
         return data
 
     def close (self):
         """Close the connection."""
         #TODO: Destroy shared memory in server
+        self._lock.acquire()
+        try:
+            if not self._closed:
+                self._closed = True
+                # Tell the other side that no more data will come
+                self._write_record('')
+        finally:
+            self._lock.release()
         Connection.close(self)
         if self.logger:
             self.logger.debug("SHM connection closed")
@@ -84,6 +84,10 @@ class ErrorWrongEncoding(ClientError):
     """Invalid encoding from client."""
     pass
 
+class ErrorMessageTooLarge(ClientError):
+    """The message data exceed the maximal allowed size."""
+    pass
+
 class ErrorDriverBusy(ClientError):
     """Driver can't process the message because it is currently
     processing another message."""
@@ -123,3 +127,14 @@ class TTSAPIError (_CommunicationError):
             err += "\n Provided data: " + self.data
 
         return err
+
+class ConnectionLost(TTSAPIError, IOError):
+    """Connection was closed before the reply arrived"""
+    def __init__(self, msg = "Connection lost"):
+        TTSAPIError.__init__(self, msg = msg)
+
+class ReplyTimeout(TTSAPIError):
+    """Reply didn't arrive in the requested time. It may still arrive
+    later, in which case it is assigned to the request it belongs to."""
+    def __init__(self, msg = "Timeout waiting for reply"):
+        TTSAPIError.__init__(self, msg = msg)
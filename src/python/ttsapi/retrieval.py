@@ -0,0 +1,375 @@
+#
+# retrieval.py - Parser of the audio retrieval protocol
+#
+# Copyright (C) 2008 Brailcom, o.p.s.
+#
+# This is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2, or (at your option)
+# any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this package; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street, Fifth Floor,
+# Boston, MA 02110-1301, USA.
+
+"""Incremental parser of the audio retrieval protocol.
+
+Drivers send audio and events for each message in blocks of the form
+
+    BLOCK <message_id> <block_number>
+    PARAMETERS
+    data_length <bytes>
+    sample_rate <rate>
+    ...
+    END OF PARAMETERS
+    EVENTS
+    <event lines as in TTS API EVENT replies>
+    END OF EVENTS
+    DATA
+    <data_length bytes of audio>
+    END OF DATA
+
+where both PARAMETERS and DATA are omitted in blocks carrying only events
+and EVENTS may be omitted.
+
+A driver may instead switch the connection to binary framing by sending
+the line FRAMING BINARY before its first block. The server confirms
+with the line OK FRAMING BINARY (a server without binary framing closes
+the connection instead). Each block is then BINARY_HEADER followed by
+the packed events (BINARY_EVENT, each followed by the index mark name)
+and the audio data, see format_binary_block().
+
+RetrievalParser accepts the input in pieces of any size as they arrive
+and passes events and audio on as soon as they are complete, audio in
+chunks before the whole block is received."""
+
+import struct
+
+from structures import AudioEvent
+
+NEWLINE = "\r\n"
+
+FRAMING_REQUEST = "FRAMING BINARY" + NEWLINE
+FRAMING_REPLY = "OK FRAMING BINARY" + NEWLINE
+
+# Magic, message id, block number, sample rate, channels,
+# number of events, data length or -1 for a block without data
+BINARY_HEADER = struct.Struct('!4sIIIHHi')
+BINARY_MAGIC = 'TTSB'
+
+# Event type, n, position in text, position in audio (-1 for None)
+# and length of the index mark name
+BINARY_EVENT = struct.Struct('!BiiiH')
+EVENT_TYPES = ('message_start', 'message_end', 'sentence_start',
+               'sentence_end', 'word_start', 'word_end', 'index_mark')
+
+class ProtocolError(Exception):
+    """Invalid input on the audio retrieval socket"""
+    pass
+
+def parse_event(line, message_id):
+    """Parse an event line (split into words) as formatted by
+    ttsapi.server.tcp_format_event, return an AudioEvent"""
+
+    def position(value):
+        if value == 'None':
+            return None
+        return int(value)
+
+    try:
+        if line[0] in ('message_start', 'message_end'):
+            return AudioEvent(type=line[0], message_id=message_id,
+                              pos_text=position(line[2]),
+                              pos_audio=position(line[3]))
+        elif line[0] in ('word_start', 'word_end', 'sentence_start',
+                         'sentence_end'):
+            return AudioEvent(type=line[0], message_id=message_id,
+                              n=position(line[2]),
+                              pos_text=position(line[3]),
+                              pos_audio=position(line[4]))
+        elif line[0] == 'index_mark':
+            return AudioEvent(type=line[0], message_id=message_id,
+                              name=line[2].strip('"'),
+                              pos_text=position(line[3]),
+                              pos_audio=position(line[4]))
+    except (IndexError, ValueError):
+        raise ProtocolError("Invalid event line: " + ' '.join(line))
+    raise ProtocolError("Unknown event " + line[0])
+
+def _unpack_int(value):
+    if value < 0:
+        return None
+    return value
+
+def format_binary_block(message_id, block_number, data_length=None,
+                        sample_rate=None, channels=None, events=()):
+    """Return the binary header and packed events of a block. The
+    block is complete when data_length bytes of audio follow, data_length
+    None means a block without audio."""
+
+    def pack_int(value):
+        if value == None:
+            return -1
+        return int(value)
+
+    if data_length == None:
+        data_length = -1
+    parts = [BINARY_HEADER.pack(BINARY_MAGIC, message_id, block_number,
+                                sample_rate or 0, channels or 1,
+                                len(events), data_length)]
+    for event in events:
+        name = event.name or ''
+        parts.append(BINARY_EVENT.pack(EVENT_TYPES.index(event.type),
+                                       pack_int(event.n),
+                                       pack_int(event.pos_text),
+                                       pack_int(event.pos_audio), len(name)))
+        parts.append(name)
+    return ''.join(parts)
+
+class RetrievalParser(object):
+    """State machine parsing the audio retrieval protocol.
+
+    Feed it with whatever data arrived on the socket through feed(). For
+    each block, on_events(message_id, events) is called with the list of
+    AudioEvent objects once the EVENTS section is complete and
+    on_data(message_id, data, parameters) with pieces of the audio data
+    as they arrive. parameters is a dictionary of the block parameters
+    with 'data_length', 'sample_rate' and 'channels' converted to
+    integers.
+
+    If on_framing is given, the parser accepts a request for binary
+    framing at the start of the connection and calls on_framing() to
+    let the caller send the confirmation."""
+
+    # Audio data are passed on in pieces of at least this many bytes,
+    # except for the last piece of a block
+    min_chunk_size = 8192
+
+    _INTEGER_PARAMETERS = ('data_length', 'sample_rate', 'channels')
+
+    def __init__(self, on_events, on_data, on_framing=None):
+        self._on_events = on_events
+        self._on_data = on_data
+        self._on_framing = on_framing
+        self._buffer = bytearray()
+        if on_framing != None:
+            self._state = self._framing
+        else:
+            self._state = self._block
+        # State after the audio data of a block
+        self._after_data = self._data_footer
+        self._message_id = None
+        self._block_number = None
+        self._parameters = None
+        self._events = None
+        self._event_count = 0
+        # Bytes of audio data of the current block not received yet
+        self._remaining = 0
+        # Bytes per frame of the current block, data are only passed
+        # on in whole frames
+        self._frame_size = 2
+
+    def feed(self, data):
+        """Parse data received on the socket. Raises ProtocolError
+        on invalid input."""
+        self._buffer += data
+        while self._state():
+            pass
+
+    def _line(self):
+        """Return the next line split into words or None if the line
+        is not complete yet"""
+        pointer = self._buffer.find(NEWLINE)
+        if pointer == -1:
+            return None
+        line = str(self._buffer[:pointer])
+        del self._buffer[:pointer+len(NEWLINE)]
+        return line.split(' ')
+
+    # Each state handler consumes what it can and returns True if it
+    # should be called again (possibly as another state)
+
+    def _framing(self):
+        """Start of the connection, a framing request or the first block"""
+        pointer = self._buffer.find(NEWLINE)
+        if pointer == -1:
+            if len(self._buffer) >= len(FRAMING_REQUEST):
+                # Can't be the request, leave it to _block to complain
+                self._state = self._block
+                return True
+            return False
+        if str(self._buffer[:pointer+len(NEWLINE)]) == FRAMING_REQUEST:
+            del self._buffer[:pointer+len(NEWLINE)]
+            self._on_framing()
+            self._state = self._binary_header
+            self._after_data = self._binary_header
+        else:
+            self._state = self._block
+        return True
+
+    def _block(self):
+        line = self._line()
+        if line == None:
+            return False
+        if len(line) != 3 or line[0] != 'BLOCK':
+            raise ProtocolError("BLOCK expected, got " + ' '.join(line))
+        try:
+            self._message_id = int(line[1])
+            self._block_number = int(line[2])
+        except ValueError:
+            raise ProtocolError("Invalid BLOCK line " + ' '.join(line))
+        self._parameters = None
+        self._events = None
+        self._state = self._first_section
+        return True
+
+    def _first_section(self):
+        line = self._line()
+        if line == None:
+            return False
+        if line == ['PARAMETERS']:
+            self._parameters = {}
+            self._state = self._parameter_lines
+        elif line == ['EVENTS']:
+            self._events = []
+            self._state = self._event_lines
+        else:
+            raise ProtocolError("PARAMETERS or EVENTS expected, got "
+                                + ' '.join(line))
+        return True
+
+    def _parameter_lines(self):
+        line = self._line()
+        if line == None:
+            return False
+        if line == ['END', 'OF', 'PARAMETERS']:
+            if not self._parameters.has_key('data_length'):
+                raise ProtocolError("Unspecified data length")
+            self._frame_size = 2 * self._parameters.get('channels', 1)
+            self._state = self._data_section
+            return True
+        if len(line) < 2:
+            raise ProtocolError("Invalid parameter line " + ' '.join(line))
+        name, value = line[0], ' '.join(line[1:])
+        if name in self._INTEGER_PARAMETERS:
+            try:
+                value = int(value)
+            except ValueError:
+                raise ProtocolError("Invalid value of parameter " + name)
+        self._parameters[name] = value
+        return True
+
+    def _data_section(self):
+        """After PARAMETERS, either EVENTS and DATA or DATA"""
+        line = self._line()
+        if line == None:
+            return False
+        if line == ['EVENTS'] and self._events == None:
+            self._events = []
+            self._state = self._event_lines
+        elif line == ['DATA']:
+            self._remaining = self._parameters['data_length']
+            self._state = self._data
+        else:
+            raise ProtocolError("DATA expected, got " + ' '.join(line))
+        return True
+
+    def _event_lines(self):
+        line = self._line()
+        if line == None:
+            return False
+        if line == ['END', 'OF', 'EVENTS']:
+            self._on_events(self._message_id, self._events)
+            if self._parameters == None:
+                # A block with events only
+                self._state = self._block
+            else:
+                self._state = self._data_section
+            return True
+        self._events.append(parse_event(line, self._message_id))
+        return True
+
+    def _data(self):
+        available = min(len(self._buffer), self._remaining)
+        if available < self._remaining:
+            if available < self.min_chunk_size:
+                return False
+            # Only pass on whole frames
+            available -= available % self._frame_size
+        if available > 0:
+            data = str(self._buffer[:available])
+            del self._buffer[:available]
+            self._remaining -= available
+            self._on_data(self._message_id, data, self._parameters)
+        if self._remaining > 0:
+            return False
+        self._state = self._after_data
+        return True
+
+    def _data_footer(self):
+        line = self._line()
+        if line == None:
+            return False
+        if line != ['END', 'OF', 'DATA']:
+            raise ProtocolError("END OF DATA expected, got " + ' '.join(line))
+        self._state = self._block
+        return True
+
+    def _binary_header(self):
+        if len(self._buffer) < BINARY_HEADER.size:
+            return False
+        magic, message_id, block_number, sample_rate, channels, \
+            event_count, data_length = \
+            BINARY_HEADER.unpack(str(self._buffer[:BINARY_HEADER.size]))
+        if magic != BINARY_MAGIC:
+            raise ProtocolError("Invalid binary block header")
+        del self._buffer[:BINARY_HEADER.size]
+        self._message_id = message_id
+        self._block_number = block_number
+        if data_length >= 0:
+            self._parameters = {'data_length': data_length,
+                                'sample_rate': sample_rate,
+                                'channels': channels}
+            self._frame_size = 2 * channels
+        else:
+            self._parameters = None
+        self._events = []
+        self._event_count = event_count
+        self._state = self._binary_events
+        return True
+
+    def _binary_events(self):
+        while len(self._events) < self._event_count:
+            if len(self._buffer) < BINARY_EVENT.size:
+                return False
+            type, n, pos_text, pos_audio, name_length = \
+                BINARY_EVENT.unpack(str(self._buffer[:BINARY_EVENT.size]))
+            if len(self._buffer) < BINARY_EVENT.size + name_length:
+                return False
+            if type >= len(EVENT_TYPES):
+                raise ProtocolError("Unknown event type " + str(type))
+            event = AudioEvent(type=EVENT_TYPES[type],
+                               message_id=self._message_id,
+                               pos_text=_unpack_int(pos_text),
+                               pos_audio=_unpack_int(pos_audio))
+            if EVENT_TYPES[type] == 'index_mark':
+                event.name = str(self._buffer[BINARY_EVENT.size:
+                                              BINARY_EVENT.size+name_length])
+            elif EVENT_TYPES[type] not in ('message_start', 'message_end'):
+                event.n = _unpack_int(n)
+            del self._buffer[:BINARY_EVENT.size+name_length]
+            self._events.append(event)
+        if self._event_count > 0:
+            self._on_events(self._message_id, self._events)
+        if self._parameters == None:
+            self._state = self._binary_header
+        else:
+            self._remaining = self._parameters['data_length']
+            self._state = self._data
+        return True
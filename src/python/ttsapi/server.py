@@ -24,16 +24,130 @@ import connection
 from structures import *
 from errors import *
 
+import sys
+import thread
 import traceback
 
 class ClientGone(Exception):
     """Raised when connection with client is terminated"""
 
+class _CommandNode(object):
+    """Node of the command tree built from TCPConnection.commands_map.
+
+    Children are reached either by a keyword or by an argument
+    converted by the given function. The action of the node is
+    the one of the template ending in this node or None."""
+
+    def __init__(self):
+        self.keywords = {}
+        self.arguments = []
+        self.action = None
+
+    def keyword_child(self, keyword):
+        if not self.keywords.has_key(keyword):
+            self.keywords[keyword] = _CommandNode()
+        return self.keywords[keyword]
+
+    def argument_child(self, name, converter):
+        for child_name, child_converter, child in self.arguments:
+            if child_name == name and child_converter == converter:
+                return child
+        child = _CommandNode()
+        self.arguments.append((name, converter, child))
+        return child
+
+    def find(self, command, position, arguments, problems):
+        """Return the action matching command[position:] or None.
+
+        Converted arguments are appended to the list arguments as (name,
+        value) pairs. Keywords are preferred over arguments, other branches
+        are only tried if the preferred one doesn't match. The reasons of
+        failures are appended to problems as error classes."""
+        if position == len(command):
+            if self.action == None:
+                problems.append(ErrorMissingArgument)
+            return self.action
+        word = command[position]
+        if self.keywords.has_key(word):
+            action = self.keywords[word].find(command, position+1,
+                                              arguments, problems)
+            if action != None:
+                return action
+        for name, converter, child in self.arguments:
+            try:
+                value = converter(word.rstrip('"').lstrip('"'))
+            except:
+                if word == 'nil':
+                    value = None
+                else:
+                    problems.append(ErrorInvalidArgument)
+                    continue
+            arguments.append((name, value))
+            action = child.find(command, position+1, arguments, problems)
+            if action != None:
+                return action
+            arguments.pop()
+        return None
+
+class _ReplyCache(object):
+    """Formatted replies by the identity of the result they were
+    formatted from.
+
+    The provider returns the same objects for information which doesn't
+    change while a driver runs (capabilities, voices), so their replies
+    need to be built only once for all connections. The results are
+    referenced from the cache, so their ids can't be reused."""
+
+    # The cache is emptied when it grows over this many entries
+    max_entries = 64
+
+    def __init__(self):
+        self._replies = {}
+        self._lock = thread.allocate_lock()
+        self.hits = 0
+        self.misses = 0
+
+    def reply(self, kind, result, format):
+        """Return the reply of the given kind for result,
+        building it by format(result) if not cached"""
+        key = (kind, id(result))
+        self._lock.acquire()
+        try:
+            if self._replies.has_key(key):
+                self.hits += 1
+                return self._replies[key][1]
+            self.misses += 1
+        finally:
+            self._lock.release()
+        reply = format(result)
+        self._lock.acquire()
+        try:
+            if len(self._replies) >= self.max_entries:
+                self._replies.clear()
+            self._replies[key] = (result, reply)
+        finally:
+            self._lock.release()
+        return reply
+
+    def statistics(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self._replies)}
+
+_reply_cache = _ReplyCache()
+
+def reply_cache_statistics():
+    """Return a dictionary with hits and misses of the cache
+    of formatted LIST VOICES and DRIVER CAPABILITIES replies"""
+    return _reply_cache.statistics()
+
 class TCPConnection(object):
     """TTS API on server side"""
 
+    _closed = False
+
     def _quit(self):
         self.logger.debug("Quitting in TCPConnection");
+        self._closed = True
 
         # Terminate provider
         self.provider.quit()
@@ -44,13 +158,17 @@ class TCPConnection(object):
             pass
 
     def __init__(self, provider, logger, method='socket', client_socket=None, memory_key=None,
-                 read_semaphore_key=None, write_semaphore_key=None):
+                 read_semaphore_key=None, write_semaphore_key=None,
+                 max_message_size=None, pipe_in=sys.stdin, pipe_out=sys.stdout):
         """Init the server side object for a new connection
         
         Arguments:
         provider -- the TTS API Provider containing all
         functions defined bellow in commands_map
-        client_socket -- socket for communication with client"""
+        client_socket -- socket for communication with client
+        pipe_in, pipe_out -- pipes for method 'pipe'
+        max_message_size -- maximal size of SAY TEXT data in bytes
+        or None for no limit"""
         global log
         logger.debug("Going to create connection")
         self.provider = provider
@@ -60,7 +178,8 @@ class TCPConnection(object):
             self.conn = connection.SocketConnection(socket=client_socket,
                                                     logger=logger, side='server')
         elif method == 'pipe':
-            self.conn = connection.PipeConnection(logger=logger, side='server')
+            self.conn = connection.PipeConnection(pipe_in=pipe_in, pipe_out=pipe_out,
+                                                  logger=logger, side='server')
         elif method == 'shm':
             self.conn = connection.SHMConnection(logger=logger, side='server',
                                                  memory_key=memory_key,
@@ -68,6 +187,7 @@ class TCPConnection(object):
                                                  write_semaphore_key=write_semaphore_key)
         else:
             raise "Unknown method of communication" + method
+        self.conn.max_data_size = max_message_size
     
         self.logger.debug("Connection created")
     
@@ -329,8 +449,11 @@ class TCPConnection(object):
             (ErrorMissingArgument, (402, 'MISSING ARGUMENT')),
             (ErrorInvalidParameter, (403, 'INVALID PARAMETER')),
             (ErrorWrongEncoding, (404, 'ENCODING ERROR')),
+            (ErrorMessageTooLarge, (405, 'MESSAGE TOO LARGE')),
             (DriverError, (500, 'UNKNOWN ERROR IN DRIVER'))
             )
+
+        self._commands = self._compile_commands(self.commands_map)
         
     def _list_drivers_reply(self, result):
         """Reply for list of drivers"""
@@ -344,6 +467,9 @@ class TCPConnection(object):
         
     def _list_voices_reply(self, result):
         """Reply for list of voices"""
+        return _reply_cache.reply('voices', result, self._format_voices)
+
+    def _format_voices(self, result):
         reply = []
         if not isinstance(result, list):
             result = [result]
@@ -358,6 +484,10 @@ class TCPConnection(object):
     
     def _driver_capabilities_reply(self, result):
         """Driver capabilities reply hook"""
+        return _reply_cache.reply('capabilities', result,
+                                  self._format_capabilities)
+
+    def _format_capabilities(self, result):
         capabilities = result.attributes_dictionary()
 
         reply = []
@@ -374,31 +504,43 @@ class TCPConnection(object):
         reply.sort() # just that it is more beautiful when inspected manually
         return reply
         
-    def _cmd_matches(self, command, template):
-        """Compare command and template, return
-        True if they match, otherwise False"""
-        
-        for i in range(0, min(len(command), len(template))):
-            if isinstance (template[i], tuple):
-                if command[i] != 'nil':
-                    try:
-                        template[i][1](command[i])
-                    except:
-                        raise ErrorInvalidArgument                    
-            elif command[i] == template[i]:
-                continue
-            else:
-                return False
-
-        # TODO: This should be done better. When user specifies
-        # more arguments than allowed for a valid command, he
-        # will get back an InvalidCommand error.
-        if len(command) < len(template):
+    def _compile_commands(self, commands_map):
+        """Build a tree of _CommandNode objects from commands_map
+        for _find_command(), return its root"""
+        root = _CommandNode()
+        for template, action in commands_map:
+            node = root
+            for atom in template:
+                if isinstance(atom, tuple):
+                    node = node.argument_child(atom[0], atom[1])
+                else:
+                    # Keywords containing spaces (INDEX MARK) arrive
+                    # as separate words
+                    for keyword in atom.split(' '):
+                        node = node.keyword_child(keyword)
+            if node.action == None:
+                node.action = action
+        return root
+
+    def _find_command(self, command):
+        """Find the action for the command given as a list of words.
+
+        Return a pair (action, arg_dict) where arg_dict contains the
+        converted arguments. Raise ErrorInvalidArgument if the command
+        matches a template except for an argument value,
+        ErrorMissingArgument if it only matches the beginning of a template
+        and ErrorInvalidCommand if it doesn't match at all."""
+        problems = []
+        arguments = []
+        action = self._commands.find(command, 0, arguments, problems)
+        if action != None:
+            return action, dict(arguments)
+        if ErrorInvalidArgument in problems:
+            raise ErrorInvalidArgument
+        elif ErrorMissingArgument in problems:
             raise ErrorMissingArgument
-        elif len(command) > len(template):
-            return False
-                       
-        return True            
+        else:
+            raise ErrorInvalidCommand
 
     def _report_error(self, error):
         """Report error on the connection according to self._errors_map.
@@ -467,30 +609,20 @@ class TCPConnection(object):
                 cmd = '.'
                 pass
             else:
-                data = self.conn.get_data()
+                try:
+                    data = self.conn.get_data()
+                except Error, error:
+                    self._report_error(error)
+                    return
                 # Say text with args from last_cmd and data
                 #self.conn.send_reply(204, 'OK MESSAGE RECEIVED')
                 cmd = self.last_cmd
 
-        for pos in range(0, len(self.commands_map)):
-            # print self.commands_map[pos]
-            try:
-                template, action = self.commands_map[pos]
-                if self._cmd_matches(cmd, template):
-                    break
-            except Error, error: 
-                self._report_error(error)
-                return
-        else:
-            self._report_error(ErrorInvalidCommand())
+        try:
+            action, arg_dict = self._find_command(cmd)
+        except Error, error:
+            self._report_error(error)
             return
-
-        arg_dict = {}
-        for i in range(0, len(template)):
-            atom = template[i]
-            if isinstance(atom, tuple):
-                arg_type = atom[1]
-                arg_dict[atom[0]] = arg_type(cmd[i].rstrip('"').lstrip('"'))
                 
         if not action.has_key('function'):
             self._report_error(ErrorInternal());
@@ -541,7 +673,25 @@ class TCPConnection(object):
             if (not isinstance(result, list)) and (not result == None):
                 result = [result]
             self.conn.send_reply(reply[0], reply[1], result)
-        
+
+    def process_available_input(self):
+        """Read the data waiting on the connection and process all
+        complete lines received so far.
+
+        This is intended for servers which wait for activity on many
+        connections at once and only call it when the client socket is
+        readable. It never blocks waiting for the rest of a line."""
+        try:
+            self.conn.receive_available()
+        except IOError:
+            self._quit()
+            raise ClientGone()
+
+        while self.conn.line_available():
+            self.process_input()
+            if self._closed:
+                raise ClientGone()
+
     def send_audio_event(self, event):
         """Send audio event on the connection.
         WARNING: This is intended to be called asynchronously,
@@ -155,5 +155,7 @@ class AudioEvent(Structure):
         ("pos_text", "Position in text (number of characters)", None),
         ("pos_audio", "Position in audio (number of miliseconds)", None),
         ("message_id", "ID of the corresponding message", None),
-        ("dispatched", "Was the event dispatched already?", False)
+        ("dispatched", "Was the event dispatched already?", False),
+        ("dispatch_error", "Playback position at the time of dispatch minus "
+         "pos_audio (number of miliseconds) or None if not measured", None)
         )